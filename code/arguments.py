@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import List, Optional
 
 
 @dataclass
@@ -26,6 +26,69 @@ class ModelArguments:
             "help": "Pretrained tokenizer name or path if not the same as model_name"
         },
     )
+    reader_quantization: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Set to 'dynamic_int8' to quantize the reader's linear layers for CPU inference."
+        },
+    )
+    exported_reader: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "TorchScript (.pt) or ONNX (.onnx) reader exported by quantization.py, run on CPU instead "
+            "of the eager model. The tokenizer and config still come from model_name_or_path."
+        },
+    )
+    early_exit_heads: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Exit classifiers trained by early_exit.py. When set, windows whose predicted answerability "
+            "falls below early_exit_threshold stop at an intermediate layer (uses the pipelined inference path)."
+        },
+    )
+    early_exit_threshold: float = field(
+        default=0.1,
+        metadata={"help": "Answerability probability below which a window exits early."},
+    )
+    teacher_model_name_or_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Reader to distill into the trained model. Its start/end logits over the train features are "
+            "computed once and stored under teacher_logits_dir. It must share the student's tokenizer."
+        },
+    )
+    teacher_logits_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Where precomputed teacher logits are stored. Defaults to {output_dir}/teacher_logits."},
+    )
+    distill_alpha: float = field(
+        default=0.5,
+        metadata={"help": "Weight of the KL loss against the teacher. The rest goes to the span cross entropy."},
+    )
+    distill_temperature: float = field(
+        default=2.0,
+        metadata={"help": "Softmax temperature applied to both teacher and student logits."},
+    )
+    head_gradient_checkpointing: bool = field(
+        default=False,
+        metadata={
+            "help": "Recompute the conv head blocks of model.Model during backward instead of storing "
+            "their activations. Saves memory at the cost of extra compute while training."
+        },
+    )
+    ensemble_model_names: List[str] = field(
+        default_factory=list,
+        metadata={
+            "help": "Extra reader checkpoints run on the same features as model_name_or_path. Their start/end "
+            "logits are averaged before a single post-processing pass. They must share its tokenizer."
+        },
+    )
+    ensemble_weights: List[float] = field(
+        default_factory=list,
+        metadata={
+            "help": "Logit weights for model_name_or_path followed by ensemble_model_names. Defaults to equal weights."
+        },
+    )
 
 
 @dataclass
@@ -67,6 +130,13 @@ class DataTrainingArguments:
             "help": "When splitting up a long document into chunks, how much stride to take between chunks."
         },
     )
+    window_planner: str = field(
+        default="stride",
+        metadata={
+            "help": "How validation windows are placed: 'stride' overlaps windows by doc_stride, 'sentence' "
+            "cuts at sentence/passage boundaries without overlap (see window_planner.py)."
+        },
+    )
     max_answer_length: int = field(
         default=30,
         metadata={
@@ -90,3 +160,227 @@ class DataTrainingArguments:
     use_faiss: bool = field(
         default=False, metadata={"help": "Whether to build with faiss"}
     )
+    retrieval_type: str = field(
+        default="sparse",
+        metadata={
+            "help": "Which retriever to use: 'sparse' (TF-IDF), 'dense' (bi-encoder) or 'hybrid' (both, fused)."
+        },
+    )
+    dense_encoder_name: Optional[str] = field(
+        default=None,
+        metadata={"help": "Question encoder for dense retrieval (also used for passages by default)."},
+    )
+    dense_passage_encoder_name: Optional[str] = field(
+        default=None,
+        metadata={"help": "Passage encoder for dense retrieval, if different from the question encoder."},
+    )
+    dense_batch_size: int = field(
+        default=64,
+        metadata={"help": "Batch size for encoding passages and questions in dense retrieval."},
+    )
+    dense_shard_size: int = field(
+        default=50000,
+        metadata={"help": "Number of passages per float16 embedding shard in dense retrieval."},
+    )
+    hybrid_fusion: str = field(
+        default="rrf",
+        metadata={"help": "How hybrid retrieval merges candidates: 'rrf' or 'weighted' (normalized scores)."},
+    )
+    rerank_model_name: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Cross-encoder that reranks the retrieved candidates. None disables reranking."
+        },
+    )
+    rerank_candidates: int = field(
+        default=50,
+        metadata={"help": "How many retrieved passages the cross-encoder scores before keeping top_k_retrieval."},
+    )
+    rerank_batch_size: int = field(
+        default=32,
+        metadata={"help": "Number of (question, passage) pairs per cross-encoder forward."},
+    )
+    rerank_margin: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "Stop scoring a question's remaining candidates once its best score leads by this margin, "
+            "and drop passages scoring more than the margin below the best. None disables both."
+        },
+    )
+    window_keep_ratio: float = field(
+        default=1.0,
+        metadata={
+            "help": "Fraction of each question's windows to keep before the reader, ranked by question-term "
+            "overlap (see window_filter.py). 1.0 keeps every window."
+        },
+    )
+    hybrid_sparse_weight: float = field(
+        default=0.5,
+        metadata={"help": "Weight of the sparse retriever in hybrid retrieval (dense gets 1 - weight)."},
+    )
+    retrieval_cache_size: int = field(
+        default=0,
+        metadata={
+            "help": "Maximum number of cached retrieval results (LRU). 0 disables the cache."
+        },
+    )
+    retrieval_cache_ttl: Optional[float] = field(
+        default=None,
+        metadata={"help": "Seconds a cached retrieval result stays valid. None keeps it forever."},
+    )
+    retrieval_cache_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "File to persist the retrieval cache across process restarts."
+        },
+    )
+    answer_cache_size: int = field(
+        default=0,
+        metadata={
+            "help": "Maximum number of cached reader n-best lists (LRU). 0 disables the cache."
+        },
+    )
+    answer_cache_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "File to persist the answer cache across process restarts."
+        },
+    )
+    nbest_format: str = field(
+        default="json",
+        metadata={
+            "help": "How n-best predictions are saved: 'json' (nbest_predictions.json), 'npz' (columnar "
+            "nbest_predictions.npz, much smaller and faster to write and read) or 'both'. "
+            "predictions.json is always written."
+        },
+    )
+    profile: bool = field(
+        default=False,
+        metadata={
+            "help": "Profile the major stages of run_mrc / run_sparse_retrieval (cProfile, tracemalloc, "
+            "torch.profiler for reader inference) and write the results under output_dir/profile."
+        },
+    )
+    profile_top_n: int = field(
+        default=30,
+        metadata={"help": "How many functions / allocation sites to list in the profile summaries."},
+    )
+    instrumentation_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Append the hot-path spans, counters and histograms to this JSON lines file at the end of the run."
+        },
+    )
+    pipelined_inference: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to stream question chunks through retrieval, tokenization, "
+            "reader and post-processing stages running in separate threads."
+        },
+    )
+    pipeline_chunk_size: int = field(
+        default=64,
+        metadata={"help": "Number of questions per chunk in pipelined inference."},
+    )
+    pipeline_queue_size: int = field(
+        default=2,
+        metadata={"help": "Maximum number of chunks waiting between two pipeline stages."},
+    )
+
+
+@dataclass
+class ServingArguments:
+    """
+    Arguments pertaining to the long-lived ODQA serving process (serve.py).
+    """
+
+    host: str = field(
+        default="127.0.0.1", metadata={"help": "Host address the HTTP server binds to."}
+    )
+    port: int = field(default=8000, metadata={"help": "Port the HTTP server listens on."})
+    batch_size: int = field(
+        default=32,
+        metadata={"help": "Maximum number of features per reader forward pass."},
+    )
+    n_best_in_response: int = field(
+        default=5,
+        metadata={"help": "How many n-best answers to include for each question."},
+    )
+    device: Optional[str] = field(
+        default=None,
+        metadata={"help": "torch device for the reader. Defaults to cuda if available."},
+    )
+    micro_batching: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to group concurrent requests into one reader forward pass."
+        },
+    )
+    max_batch_size: int = field(
+        default=16,
+        metadata={"help": "Maximum number of requests in one micro-batch."},
+    )
+    max_batch_wait_ms: float = field(
+        default=5.0,
+        metadata={
+            "help": "How long the first request of a micro-batch waits for others to join."
+        },
+    )
+
+
+@dataclass
+class BenchmarkArguments:
+    """
+    Arguments pertaining to the end-to-end ODQA benchmark (inference_benchmark.py).
+    """
+
+    benchmark_output: str = field(
+        default="./outputs/benchmark/e2e_benchmark.json",
+        metadata={"help": "Where to write this run's benchmark JSON."},
+    )
+    baseline_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "Benchmark JSON of a previous run to compare against."},
+    )
+    save_as_baseline: bool = field(
+        default=False,
+        metadata={"help": "Also write this run's result to baseline_path."},
+    )
+    regression_tolerance: float = field(
+        default=0.1,
+        metadata={
+            "help": "Relative slowdown per stage (or EM/F1 drop in points) reported as a regression."
+        },
+    )
+    fail_on_regression: bool = field(
+        default=False,
+        metadata={"help": "Exit with a non-zero status when a regression is found."},
+    )
+    max_questions: Optional[int] = field(
+        default=None,
+        metadata={"help": "Only benchmark the first N validation questions."},
+    )
+    reader_batch_size: int = field(
+        default=32,
+        metadata={"help": "Number of features per reader forward pass."},
+    )
+    num_threads: Optional[int] = field(
+        default=None,
+        metadata={"help": "torch intra-op threads. None keeps the torch default."},
+    )
+
+
+@dataclass
+class ShardedInferenceArguments:
+    """
+    Arguments pertaining to the multi-process CPU inference launcher (sharded_inference.py).
+    """
+
+    num_workers: int = field(
+        default=2,
+        metadata={"help": "Number of reader processes. Each one handles a contiguous shard of the questions."},
+    )
+    threads_per_worker: Optional[int] = field(
+        default=None,
+        metadata={"help": "torch intra-op threads per worker. Defaults to the CPU count divided by num_workers."},
+    )
@@ -0,0 +1,299 @@
+"""
+retrieval 결과, reader 결과 등을 재사용하기 위한 크기 제한 LRU cache 입니다.
+"""
+
+
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from utils_qa import _column_names, save_predictions, select_rows
+
+
+class LRUCache:
+    def __init__(
+        self,
+        max_size: int = 10000,
+        ttl: Optional[float] = None,
+        path: Optional[str] = None,
+        version: Optional[str] = None,
+    ):
+
+        """
+        Arguments:
+            max_size (int):
+                저장할 최대 entry 수입니다. 넘치면 가장 오래 사용되지 않은 entry부터 제거합니다.
+            ttl (Optional[float]):
+                entry가 유효한 시간(초)입니다. None이면 만료되지 않습니다.
+            path (Optional[str]):
+                주어지면 `save()`/`load()`로 process를 재시작해도 cache를 이어서 사용합니다.
+            version (Optional[str]):
+                cache가 유효한 index/model의 version입니다. 다른 version으로 바뀌면 모든 entry를 비웁니다.
+
+        Note:
+            여러 thread(예: serve.py의 handler)에서 동시에 사용해도 안전합니다.
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.version = version
+
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+            "hit_seconds": 0.0,
+            "miss_seconds": 0.0,
+        }
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            created_at, value = entry
+            if self.ttl is not None and time.time() - created_at > self.ttl:
+                del self._data[key]
+                self._stats["expirations"] += 1
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        # hit/miss 횟수와 각각에 걸린 시간을 함께 기록합니다.
+        t0 = time.perf_counter()
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            self.record(hits=1, hit_seconds=time.perf_counter() - t0)
+            return value
+        value = compute()
+        self.put(key, value)
+        self.record(misses=1, miss_seconds=time.perf_counter() - t0)
+        return value
+
+    def record(self, hits: int = 0, misses: int = 0, hit_seconds: float = 0.0, miss_seconds: float = 0.0) -> None:
+        # batch 단위로 cache를 조회하는 경우 caller가 직접 통계를 기록합니다.
+        with self._lock:
+            self._stats["hits"] += hits
+            self._stats["misses"] += misses
+            self._stats["hit_seconds"] += hit_seconds
+            self._stats["miss_seconds"] += miss_seconds
+
+    def set_version(self, version: Optional[str]) -> None:
+        # index나 모델이 바뀌면 이전 결과는 더 이상 유효하지 않으므로 모두 비웁니다.
+        with self._lock:
+            if self.version is not None and version != self.version and self._data:
+                self._data.clear()
+                self._stats["invalidations"] += 1
+            self.version = version
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self._stats)
+            size = len(self._data)
+        lookups = stats["hits"] + stats["misses"]
+        stats["size"] = size
+        stats["max_size"] = self.max_size
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["avg_hit_ms"] = (
+            stats["hit_seconds"] / stats["hits"] * 1000 if stats["hits"] else 0.0
+        )
+        stats["avg_miss_ms"] = (
+            stats["miss_seconds"] / stats["misses"] * 1000 if stats["misses"] else 0.0
+        )
+        return stats
+
+    def save(self, path: Optional[str] = None) -> None:
+        path = path or self.path
+        if path is None:
+            return
+        with self._lock:
+            state = {"version": self.version, "data": list(self._data.items())}
+        # 저장 중에 중단되어도 기존 파일이 깨지지 않도록 임시 파일에 쓴 뒤 교체합니다.
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as file:
+            pickle.dump(state, file)
+        os.replace(tmp_path, path)
+
+    def load(self, path: Optional[str] = None) -> int:
+        path = path or self.path
+        if path is None or not os.path.isfile(path):
+            return 0
+        with open(path, "rb") as file:
+            state = pickle.load(file)
+        # version이 다른 cache 파일은 불러오지 않습니다.
+        if self.version is not None and state["version"] != self.version:
+            return 0
+        with self._lock:
+            for key, entry in state["data"][-self.max_size :]:
+                self._data[key] = entry
+            self.version = state["version"]
+        return len(self._data)
+
+
+def checkpoint_version(model_name_or_path: str) -> str:
+    # local checkpoint이면 파일 이름/크기/수정 시간으로, hub 모델이면 이름으로 version을 만듭니다.
+    # weight 파일 전체를 hash하지 않으므로 큰 모델도 바로 계산됩니다.
+    h = hashlib.sha1(model_name_or_path.encode("utf-8"))
+    if os.path.isdir(model_name_or_path):
+        for name in sorted(os.listdir(model_name_or_path)):
+            path = os.path.join(model_name_or_path, name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                h.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return h.hexdigest()
+
+
+class AnswerCache:
+    def __init__(self, cache: LRUCache, model_version: str, params: Dict[str, Any]):
+
+        """
+        Arguments:
+            cache (LRUCache):
+                (prediction, n-best list)를 저장할 cache 입니다.
+            model_version (str):
+                reader checkpoint의 version입니다. `checkpoint_version()`으로 만듭니다.
+            params (Dict[str, Any]):
+                max_seq_length, doc_stride, max_answer_length 등 결과에 영향을 주는 전처리/후처리 설정입니다.
+
+        Summary:
+            (question, retrieve된 passage id, reader checkpoint, 전처리/후처리 설정)이 같으면
+            `postprocess_qa_predictions`의 결과도 같으므로, reader forward 없이 cache의 n-best를 돌려줍니다.
+        """
+
+        self.cache = cache
+        # 다른 checkpoint로 만든 cache 파일은 불러오지 않습니다.
+        self.cache.set_version(model_version)
+        self.cache.load()
+        self._params = tuple(sorted(params.items()))
+
+    def key(self, question: str, context_id: Optional[List[int]] = None, context: Optional[str] = None) -> Tuple:
+        # passage id가 없으면(예: 정답 context를 그대로 쓰는 경우) context의 hash를 사용합니다.
+        if context_id is not None:
+            passages = ("ids", tuple(int(i) for i in context_id))
+        else:
+            passages = ("sha1", hashlib.sha1(context.encode("utf-8")).hexdigest())
+        return (question, passages, self.cache.version, self._params)
+
+    def _keys(self, examples) -> List[Tuple]:
+        context_ids = (
+            examples["context_id"] if "context_id" in _column_names(examples) else None
+        )
+        return [
+            self.key(
+                question,
+                context_id=context_ids[i] if context_ids is not None else None,
+                context=examples["context"][i],
+            )
+            for i, question in enumerate(examples["question"])
+        ]
+
+    def lookup(self, examples, record: bool = True) -> Tuple[Dict[int, Tuple[str, List[Dict]]], List[int]]:
+
+        """
+        Arguments:
+            record (bool):
+                False이면 hit/miss 통계에 반영하지 않습니다. (실제 후처리 전에 미리 확인만 하는 경우)
+
+        Returns:
+            (cached, missing): cached는 row index -> (prediction, n-best list), missing은 cache에 없는 row index 목록
+        """
+
+        t0 = time.perf_counter()
+        cached, missing = {}, []
+        for i, key in enumerate(self._keys(examples)):
+            value = self.cache.get(key, _MISSING)
+            if value is _MISSING:
+                missing.append(i)
+            else:
+                cached[i] = value
+        if record:
+            self.cache.record(
+                hits=len(cached),
+                misses=len(missing),
+                hit_seconds=(time.perf_counter() - t0) if cached else 0.0,
+            )
+        return cached, missing
+
+    def store(self, examples, all_predictions: Dict, all_nbest: Dict) -> None:
+        for id_, key in zip(examples["id"], self._keys(examples)):
+            self.cache.put(key, (all_predictions[id_], all_nbest[id_]))
+
+    def postprocess_hook(self, fn: Callable) -> Callable:
+
+        """
+        `QAPipeline.register_hook("postprocess", ...)`에 등록하는 hook 입니다.
+
+        examples 중 cache에 없는 row만 features/predictions로 후처리하고, 나머지는 cache에서 채웁니다.
+        따라서 features는 cache에 없는 examples로만 만들어도 됩니다.
+        """
+
+        def postprocess(examples, features, predictions, output_dir=None, return_nbest=False, **kwargs):
+            cached, missing = self.lookup(examples)
+            new_predictions, new_nbest = {}, {}
+            if missing:
+                missing_examples = select_rows(examples, missing)
+                new_predictions, new_nbest = fn(
+                    missing_examples,
+                    features,
+                    predictions,
+                    output_dir=None,
+                    return_nbest=True,
+                    **kwargs,
+                )
+                self.store(missing_examples, new_predictions, new_nbest)
+
+            all_predictions, all_nbest = OrderedDict(), OrderedDict()
+            for i, id_ in enumerate(examples["id"]):
+                if i in cached:
+                    all_predictions[id_], all_nbest[id_] = cached[i]
+                else:
+                    all_predictions[id_] = new_predictions[id_]
+                    all_nbest[id_] = new_nbest[id_]
+
+            if output_dir is not None:
+                save_predictions(
+                    all_predictions,
+                    all_nbest,
+                    output_dir,
+                    prefix=kwargs.get("prefix"),
+                    nbest_format=kwargs.get("nbest_format", "json"),
+                )
+            if return_nbest:
+                return all_predictions, all_nbest
+            return all_predictions
+
+        return postprocess
+
+    def save(self) -> None:
+        self.cache.save()
+
+    def stats(self) -> Dict[str, float]:
+        return self.cache.stats()
+
+
+_MISSING = object()
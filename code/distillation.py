@@ -0,0 +1,201 @@
+"""
+큰 teacher reader의 start/end logits으로 작은 student reader를 학습하는 knowledge distillation 코드 입니다.
+
+teacher logits은 `prepare_train_features`가 만든 train feature 순서대로 한 번만 계산해
+`{teacher_logits_dir}/logits.npy` (float16, feature 수 x 최대 길이 x 2)에 저장하고, 학습 중에는 memory-map으로 읽습니다.
+train feature의 fingerprint가 같으면 다음 실행에서도 teacher를 다시 실행하지 않습니다.
+
+teacher와 student는 token 위치가 같아야 하므로 같은 tokenizer(vocab)를 사용해야 합니다.
+
+    python train.py --output_dir ./models/student --do_train --model_name_or_path klue/roberta-small \
+        --tokenizer_name klue/roberta-small --teacher_model_name_or_path ./models/train_dataset
+"""
+
+
+import inspect
+import json
+import logging
+import os
+from typing import Optional
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from datasets import Dataset
+from qa_pipeline import _model_device
+from tqdm.auto import tqdm
+from trainer_qa import QuestionAnsweringTrainer
+from utils_qa import NULL_LOGIT
+
+logger = logging.getLogger(__name__)
+
+# train feature에 추가하는 column 이름입니다. teacher logits의 row index 입니다.
+FEATURE_INDEX = "feature_index"
+
+
+def precompute_teacher_logits(
+    teacher,
+    tokenizer,
+    features: Dataset,
+    output_dir: str,
+    teacher_name: str,
+    batch_size: int = 64,
+    return_token_type_ids: bool = False,
+) -> np.ndarray:
+
+    """
+    Arguments:
+        teacher: start/end logits을 첫 두 값으로 반환하는 QA 모델
+        features: `QAPipeline.train_features`의 결과
+        output_dir: logits.npy, meta.json을 저장할 경로
+        teacher_name: meta.json에 남겨 다른 teacher의 logits을 재사용하지 않도록 합니다.
+
+    Returns:
+        (feature 수, 최대 길이, 2) float16 memory-map. feature보다 긴 위치는 NULL_LOGIT 입니다.
+    """
+
+    logits_path = os.path.join(output_dir, "logits.npy")
+    meta_path = os.path.join(output_dir, "meta.json")
+    meta = {
+        "teacher": teacher_name,
+        "features_fingerprint": features._fingerprint,
+        "num_features": len(features),
+    }
+    if os.path.isfile(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            if json.load(f) == meta:
+                print(f"Teacher logits load from {logits_path}")
+                return np.load(logits_path, mmap_mode="r")
+        print("train feature 혹은 teacher가 달라 teacher logits을 다시 계산합니다.")
+
+    os.makedirs(output_dir, exist_ok=True)
+    input_names = ["input_ids", "attention_mask"]
+    if return_token_type_ids and "token_type_ids" in features.column_names:
+        input_names.append("token_type_ids")
+    max_length = max(len(input_ids) for input_ids in features["input_ids"])
+    logits = np.lib.format.open_memmap(
+        logits_path, mode="w+", dtype=np.float16, shape=(len(features), max_length, 2)
+    )
+    logits[:] = NULL_LOGIT
+
+    device = _model_device(teacher)
+    teacher.eval()
+    with torch.no_grad():
+        for start in tqdm(range(0, len(features), batch_size), desc="Teacher logits"):
+            # Dataset[k]는 column 전체를 읽으므로 row 범위를 먼저 자릅니다.
+            rows = features[start : start + batch_size]
+            batch = tokenizer.pad({k: rows[k] for k in input_names}, return_tensors="pt")
+            outputs = teacher(**{k: v.to(device) for k, v in batch.items()})
+            # batch padding 위치는 feature에 없는 token이므로 NULL_LOGIT으로 남깁니다.
+            padding = (batch["attention_mask"] == 0).numpy()
+            length = batch["input_ids"].shape[1]
+            end = start + len(batch["input_ids"])
+            for i, output in enumerate(outputs[:2]):
+                output = output.float().cpu().numpy()
+                output[padding] = NULL_LOGIT
+                logits[start:end, :length, i] = output
+    logits.flush()
+    del logits
+
+    # 모든 logits을 쓴 뒤에 meta.json을 저장하므로, 중간에 중단되면 다음 실행에서 다시 계산합니다.
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=4)
+    print(f"Teacher logits saved to {logits_path}")
+    return np.load(logits_path, mmap_mode="r")
+
+
+def add_feature_index(features: Dataset) -> Dataset:
+    return features.map(
+        lambda batch, indices: {FEATURE_INDEX: indices},
+        batched=True,
+        with_indices=True,
+    )
+
+
+class DistillationTrainer(QuestionAnsweringTrainer):
+    def __init__(
+        self,
+        *args,
+        teacher_logits: Optional[np.ndarray] = None,
+        alpha: float = 0.5,
+        temperature: float = 2.0,
+        **kwargs,
+    ):
+
+        """
+        Arguments:
+            teacher_logits: `precompute_teacher_logits`의 결과
+            alpha (float): KL loss의 비율. 나머지 (1 - alpha)는 정답 위치에 대한 cross entropy 입니다.
+            temperature (float): teacher/student 분포를 부드럽게 만드는 temperature
+
+        Note:
+            train_dataset에는 `add_feature_index`로 feature_index column을 추가해야 합니다.
+        """
+
+        super().__init__(*args, **kwargs)
+        self.teacher_logits = teacher_logits
+        self.alpha = alpha
+        self.temperature = temperature
+        # feature_index는 모델 입력이 아니지만 Trainer가 column을 지우지 않도록 남겨둡니다.
+        self._signature_columns = list(inspect.signature(self.model.forward).parameters) + [
+            "label",
+            "label_ids",
+            FEATURE_INDEX,
+        ]
+
+    def _remove_unused_columns(self, dataset, description=None):
+        # transformers 4.5의 Trainer는 _signature_columns를 보지 않고 model.forward의 signature로만
+        # column을 고르므로, 같은 동작을 하되 feature_index를 남기도록 직접 구현합니다.
+        if not self.args.remove_unused_columns:
+            return dataset
+        columns = [k for k in self._signature_columns if k in dataset.column_names]
+        ignored_columns = sorted(set(dataset.column_names) - set(self._signature_columns))
+        if ignored_columns:
+            dset_description = "" if description is None else f"in the {description} set "
+            logger.info(
+                f"The following columns {dset_description}don't have a corresponding argument in "
+                f"`{self.model.__class__.__name__}.forward` and have been ignored: {', '.join(ignored_columns)}."
+            )
+        dataset.set_format(
+            type=dataset.format["type"], columns=columns, format_kwargs=dataset.format["format_kwargs"]
+        )
+        return dataset
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        feature_index = inputs.pop(FEATURE_INDEX, None)
+        if feature_index is None and self.teacher_logits is not None and model.training:
+            # teacher 없이 조용히 span loss로만 학습하지 않도록 바로 알립니다.
+            raise ValueError(
+                f"teacher_logits이 있지만 batch에 {FEATURE_INDEX} column이 없습니다. "
+                "train_dataset에 add_feature_index를 적용했는지 확인해주세요."
+            )
+        outputs = model(**inputs)
+        hard_loss = outputs["loss"] if isinstance(outputs, dict) else outputs[0]
+        if feature_index is None or self.teacher_logits is None:
+            # 평가 중이거나 teacher가 없는 경우입니다.
+            return (hard_loss, outputs) if return_outputs else hard_loss
+
+        start_logits = outputs["start_logits"] if isinstance(outputs, dict) else outputs[1]
+        end_logits = outputs["end_logits"] if isinstance(outputs, dict) else outputs[2]
+        length = start_logits.shape[1]
+        # memory-map에서 batch에 해당하는 row만 읽습니다.
+        teacher = torch.from_numpy(
+            np.asarray(self.teacher_logits[feature_index.cpu().numpy(), :length], dtype=np.float32)
+        ).to(start_logits.device)
+        if teacher.shape[1] < length:
+            # pad_to_multiple_of 때문에 batch가 저장된 최대 길이보다 길어질 수 있습니다.
+            teacher = F.pad(teacher, (0, 0, 0, length - teacher.shape[1]), value=NULL_LOGIT)
+
+        padding = inputs["attention_mask"] == 0
+        soft_loss = 0.0
+        for student, target in ((start_logits, teacher[..., 0]), (end_logits, teacher[..., 1])):
+            student = student.masked_fill(padding, NULL_LOGIT)
+            soft_loss = soft_loss + F.kl_div(
+                F.log_softmax(student / self.temperature, dim=-1),
+                F.softmax(target / self.temperature, dim=-1),
+                reduction="batchmean",
+            )
+        soft_loss = soft_loss / 2 * self.temperature ** 2
+
+        loss = self.alpha * soft_loss + (1 - self.alpha) * hard_loss
+        return (loss, outputs) if return_outputs else loss
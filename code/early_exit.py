@@ -0,0 +1,396 @@
+"""
+중간 transformer layer에서 window의 answerability를 추정해, 정답이 없을 것이 확실한 window는 계산을 멈추는 early-exit reader 입니다.
+
+top-k 문서를 이어 붙인 context에서 만든 window는 대부분 정답을 포함하지 않습니다.
+exit layer마다 [CLS] hidden state에 linear classifier를 붙여 answerability를 예측하고,
+threshold보다 낮은 window는 남은 layer와 QA head를 건너뜁니다.
+건너뛴 window의 logits은 `utils_qa.NULL_LOGIT`으로 채워 postprocess에서 후보로 사용하지 않으며,
+한 질문의 window가 모두 exit되면 answerability가 가장 높은 window 하나는 끝까지 계산합니다.
+
+exit classifier 학습 (train 질문으로 retrieve한 context의 window, 정답 문자열 포함 여부를 label로 사용):
+    python early_exit.py --model_name_or_path ./models/train_dataset --exit_layers 3 6 --train_heads
+
+threshold별 계산량 절감과 EM/F1 비교 (validation):
+    python early_exit.py --model_name_or_path ./models/train_dataset --thresholds 0.05 0.1 0.2 0.3
+"""
+
+
+import os
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+from instrumentation import METRICS, span
+from qa_pipeline import _model_device, _pad_logits
+from utils_qa import NULL_LOGIT, _column_names, select_rows
+
+STATS_KEYS = ("features", "exited", "recomputed", "layers_run", "layers_total")
+
+
+def window_labels(examples, features) -> np.ndarray:
+    # window의 context 부분에 정답 문자열이 있으면 1 입니다.
+    # retrieve한 context에는 answer_start가 맞지 않으므로 문자열 포함 여부로 판단합니다.
+    id_to_index = {id_: i for i, id_ in enumerate(examples["id"])}
+    labels = np.zeros(len(features["input_ids"]), dtype=np.float32)
+    for row, (example_id, offsets) in enumerate(
+        zip(features["example_id"], features["offset_mapping"])
+    ):
+        offsets = np.asarray(offsets)
+        offsets = offsets[offsets[:, 0] >= 0]
+        if len(offsets) == 0:
+            continue
+        index = id_to_index[example_id]
+        window = examples["context"][index][offsets[0, 0] : offsets[-1, 1]]
+        labels[row] = any(text in window for text in examples["answers"][index]["text"])
+    return labels
+
+
+class EarlyExitReader:
+    def __init__(self, model, tokenizer, exit_layers: Sequence[int], threshold: float = 0.1):
+
+        """
+        Arguments:
+            model:
+                encoder.layer를 가진 BERT/RoBERTa 계열 QA 모델 (AutoModelForQuestionAnswering 혹은 model.Model)
+            tokenizer:
+                feature를 batch로 padding하는 데 사용합니다.
+            exit_layers (Sequence[int]):
+                classifier를 붙일 layer 번호입니다. 1부터 시작하며 마지막 layer는 사용할 수 없습니다.
+            threshold (float):
+                answerability 확률이 이 값보다 낮은 window는 해당 layer에서 계산을 멈춥니다.
+
+        Summary:
+            `QAPipeline.register_hook("predict", reader.predict_hook)`로 등록하면 pipeline.predict를 대신합니다.
+        """
+
+        base = getattr(model, "base_model", None)
+        if not hasattr(getattr(base, "encoder", None), "layer"):
+            raise ValueError("early exit은 encoder.layer를 가진 transformer 모델에서만 사용할 수 있습니다.")
+        self.num_layers = len(base.encoder.layer)
+        assert all(
+            0 < layer < self.num_layers for layer in exit_layers
+        ), f"exit_layers는 1 ~ {self.num_layers - 1} 사이여야 합니다."
+
+        self.model = model
+        self.tokenizer = tokenizer
+        self.exit_layers = sorted(exit_layers)
+        self.threshold = threshold
+        self.heads = nn.ModuleDict(
+            {str(layer): nn.Linear(model.config.hidden_size, 1) for layer in self.exit_layers}
+        )
+        # conv head처럼 qa_logits를 제공하는 모델은 그것을, HF QA 모델은 qa_outputs를 사용합니다.
+        self._qa_logits = getattr(model, "qa_logits", model.qa_outputs)
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        self.stats = dict.fromkeys(STATS_KEYS, 0)
+
+    def compute_saved(self) -> float:
+        # 건너뛴 encoder layer의 비율입니다. (QA head와 exit classifier의 계산량은 무시합니다.)
+        return 1 - self.stats["layers_run"] / max(self.stats["layers_total"], 1)
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        torch.save({"exit_layers": self.exit_layers, "state_dict": self.heads.state_dict()}, path)
+
+    @classmethod
+    def load(cls, path: str, model, tokenizer, threshold: float = 0.1) -> "EarlyExitReader":
+        state = torch.load(path, map_location="cpu")
+        reader = cls(model, tokenizer, state["exit_layers"], threshold)
+        reader.heads.load_state_dict(state["state_dict"])
+        return reader
+
+    def _batches(self, features, batch_size: int):
+        input_names = [
+            k for k in self.tokenizer.model_input_names if k in _column_names(features)
+        ]
+        device = _model_device(self.model)
+        for i in range(0, len(features["input_ids"]), batch_size):
+            batch = self.tokenizer.pad(
+                {k: features[k][i : i + batch_size] for k in input_names},
+                return_tensors="pt",
+            )
+            yield i, {k: v.to(device) for k, v in batch.items()}
+
+    def _embed(self, batch) -> Tuple[torch.Tensor, torch.Tensor]:
+        attention_mask = batch["attention_mask"]
+        hidden_states = self.model.base_model.embeddings(
+            input_ids=batch["input_ids"], token_type_ids=batch.get("token_type_ids")
+        )
+        extended_mask = self.model.get_extended_attention_mask(
+            attention_mask, attention_mask.shape, attention_mask.device
+        )
+        return hidden_states, extended_mask
+
+    def _answerability(self, layer: int, hidden_states: torch.Tensor) -> np.ndarray:
+        logits = self.heads[str(layer)](hidden_states[:, 0]).squeeze(-1)
+        return torch.sigmoid(logits).float().cpu().numpy()
+
+    # ------------------------------------------------------------------- predict
+    def predict_hook(self, fn: Callable) -> Callable:
+        def predict(model, features, batch_size: int = 32):
+            return self.predict(features, batch_size)
+
+        return predict
+
+    def predict(self, features, batch_size: int = 32) -> Tuple[np.ndarray, np.ndarray]:
+
+        """
+        Returns:
+            `QAPipeline.predict`와 같은 (start_logits, end_logits).
+            exit한 window는 모든 위치가 NULL_LOGIT 입니다.
+        """
+
+        num_features = len(features["input_ids"])
+        start_logits: List[np.ndarray] = [None] * num_features
+        end_logits: List[np.ndarray] = [None] * num_features
+        answerability = np.ones(num_features, dtype=np.float32)
+        exited = np.zeros(num_features, dtype=bool)
+        layers_run = 0
+
+        self.model.eval()
+        self.heads.to(_model_device(self.model)).eval()
+        with torch.no_grad():
+            for i, batch in self._batches(features, batch_size):
+                seq_length = batch["input_ids"].shape[1]
+                batch_rows = np.arange(i, i + len(batch["input_ids"]))
+                rows = batch_rows
+                with span("reader.forward"):
+                    hidden_states, extended_mask = self._embed(batch)
+                    for layer_index, layer in enumerate(self.model.base_model.encoder.layer, 1):
+                        hidden_states = layer(hidden_states, attention_mask=extended_mask)[0]
+                        layers_run += len(rows)
+                        if str(layer_index) not in self.heads:
+                            continue
+                        scores = self._answerability(layer_index, hidden_states)
+                        answerability[rows] = scores
+                        keep = scores >= self.threshold
+                        if keep.all():
+                            continue
+                        exited[rows[~keep]] = True
+                        rows = rows[keep]
+                        if len(rows) == 0:
+                            break
+                        keep = torch.from_numpy(keep).to(hidden_states.device)
+                        hidden_states, extended_mask = hidden_states[keep], extended_mask[keep]
+
+                    if len(rows):
+                        logits = self._qa_logits(hidden_states).float().cpu().numpy()
+                        for j, row in enumerate(rows):
+                            start_logits[row] = logits[j, :, 0]
+                            end_logits[row] = logits[j, :, 1]
+                for row in batch_rows[exited[batch_rows]]:
+                    start_logits[row] = end_logits[row] = np.full(seq_length, NULL_LOGIT, dtype=np.float32)
+
+        # 한 질문의 window가 모두 exit되었으면 answerability가 가장 높은 window는 끝까지 계산합니다.
+        completed, fallback = set(), {}
+        for row, example_id in enumerate(features["example_id"]):
+            if not exited[row]:
+                completed.add(example_id)
+            elif example_id not in fallback or answerability[row] > answerability[fallback[example_id]]:
+                fallback[example_id] = row
+        recompute = sorted(row for example_id, row in fallback.items() if example_id not in completed)
+        if recompute:
+            with torch.no_grad():
+                for i, batch in self._batches(select_rows(features, recompute), batch_size):
+                    with span("reader.forward"):
+                        outputs = self.model(**batch)
+                    for j, row in enumerate(recompute[i : i + batch_size]):
+                        start_logits[row] = outputs[0][j].float().cpu().numpy()
+                        end_logits[row] = outputs[1][j].float().cpu().numpy()
+            exited[recompute] = False
+            layers_run += len(recompute) * self.num_layers
+
+        num_exited = int(exited.sum())
+        for key, value in zip(
+            STATS_KEYS,
+            (num_features, num_exited, len(recompute), layers_run, num_features * self.num_layers),
+        ):
+            self.stats[key] += value
+        METRICS.count("reader.features", num_features)
+        METRICS.count("reader.early_exit.exited", num_exited)
+        return _pad_logits(start_logits), _pad_logits(end_logits)
+
+    # --------------------------------------------------------------------- train
+    def _cls_states(self, features, batch_size: int) -> Dict[int, np.ndarray]:
+        # 마지막 exit layer까지만 계산하며, exit layer별 [CLS] hidden state를 모읍니다.
+        states = {layer: [] for layer in self.exit_layers}
+        layers = self.model.base_model.encoder.layer[: self.exit_layers[-1]]
+        self.model.eval()
+        with torch.no_grad():
+            for _, batch in self._batches(features, batch_size):
+                hidden_states, extended_mask = self._embed(batch)
+                for layer_index, layer in enumerate(layers, 1):
+                    hidden_states = layer(hidden_states, attention_mask=extended_mask)[0]
+                    if layer_index in states:
+                        states[layer_index].append(hidden_states[:, 0].float().cpu())
+        return {layer: torch.cat(chunks) for layer, chunks in states.items()}
+
+    def train_heads(
+        self,
+        features,
+        labels: np.ndarray,
+        batch_size: int = 32,
+        epochs: int = 5,
+        learning_rate: float = 1e-3,
+    ) -> Dict[int, Dict[str, float]]:
+
+        """
+        Arguments:
+            features: `prepare_validation_features`의 결과
+            labels (np.ndarray): feature별 정답 포함 여부 (`window_labels`)
+
+        Returns:
+            exit layer별로 현재 threshold에서 정답 window를 남기는 비율(positive_recall)과
+            정답이 없는 window를 건너뛰는 비율(negative_exit_rate)
+
+        Note:
+            reader는 고정하고 classifier만 학습하므로 [CLS] hidden state를 한 번만 계산해 재사용합니다.
+        """
+
+        states = self._cls_states(features, batch_size)
+        targets = torch.from_numpy(labels.astype(np.float32))
+        num_positive = float(targets.sum())
+        # 정답이 있는 window가 훨씬 적으므로 positive의 loss에 weight를 줍니다.
+        loss_fct = nn.BCEWithLogitsLoss(
+            pos_weight=torch.tensor((len(targets) - num_positive) / max(num_positive, 1.0))
+        )
+
+        report = {}
+        for layer in self.exit_layers:
+            head = self.heads[str(layer)].cpu().train()
+            optimizer = torch.optim.Adam(head.parameters(), lr=learning_rate)
+            inputs = states[layer]
+            for _ in range(epochs):
+                permutation = torch.randperm(len(inputs))
+                for start in range(0, len(inputs), 256):
+                    index = permutation[start : start + 256]
+                    loss = loss_fct(head(inputs[index]).squeeze(-1), targets[index])
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+
+            with torch.no_grad():
+                keep = torch.sigmoid(head(inputs).squeeze(-1)).numpy() >= self.threshold
+            positive = labels > 0
+            report[layer] = {
+                "positive_recall": round(float(keep[positive].mean()) if positive.any() else 1.0, 4),
+                "negative_exit_rate": round(float((~keep[~positive]).mean()) if (~positive).any() else 0.0, 4),
+            }
+            print(f"[exit layer {layer}] {report[layer]}")
+        self.heads.to(_model_device(self.model)).eval()
+        return report
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import time
+
+    from arguments import DataTrainingArguments, ModelArguments
+    from datasets import load_from_disk
+    from inference import build_retriever, load_reader
+    from qa_pipeline import QAPipeline, uses_token_type_ids
+    from transformers import EvalPrediction
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("--model_name_or_path", type=str, required=True, help="")
+    parser.add_argument(
+        "--dataset_name", default="../data/train_dataset", type=str, help=""
+    )
+    parser.add_argument("--heads_path", default=None, type=str, help="기본값: {model_name_or_path}/early_exit_heads.pt")
+    parser.add_argument("--exit_layers", nargs="+", default=[3, 6], type=int, help="")
+    parser.add_argument("--train_heads", action="store_true", help="")
+    parser.add_argument("--max_train_questions", default=1000, type=int, help="")
+    parser.add_argument("--thresholds", nargs="+", default=[0.05, 0.1, 0.2, 0.3], type=float, help="")
+    parser.add_argument("--top_k_retrieval", default=10, type=int, help="")
+    parser.add_argument("--max_questions", default=None, type=int, help="")
+    parser.add_argument("--batch_size", default=32, type=int, help="")
+    args = parser.parse_args()
+
+    heads_path = args.heads_path or os.path.join(args.model_name_or_path, "early_exit_heads.pt")
+    tokenizer, model = load_reader(ModelArguments(model_name_or_path=args.model_name_or_path))
+    model.to("cuda" if torch.cuda.is_available() else "cpu").eval()
+
+    data_args = DataTrainingArguments(
+        dataset_name=args.dataset_name, top_k_retrieval=args.top_k_retrieval
+    )
+    retriever = build_retriever(tokenizer.tokenize, data_args)
+    pipeline = QAPipeline(
+        tokenizer,
+        data_args,
+        min(data_args.max_seq_length, tokenizer.model_max_length),
+        ["id", "question", "context", "answers"],
+        return_token_type_ids=uses_token_type_ids(model.config),
+    )
+    datasets = load_from_disk(args.dataset_name)
+
+    def retrieved_examples(dataset) -> Dict:
+        _, doc_indices = retriever.get_relevant_doc_bulk(dataset["question"], k=args.top_k_retrieval)
+        return {
+            "id": dataset["id"],
+            "question": dataset["question"],
+            "context": [
+                " ".join(retriever.contexts[pid] for pid in indices)
+                for indices in doc_indices
+            ],
+            "answers": dataset["answers"],
+        }
+
+    if args.train_heads:
+        train = datasets["train"]
+        train = train.select(range(min(args.max_train_questions, len(train))))
+        examples = retrieved_examples(train)
+        features = pipeline.prepare_validation_features(examples)
+        reader = EarlyExitReader(model, tokenizer, args.exit_layers, threshold=min(args.thresholds))
+        reader.train_heads(features, window_labels(examples, features), batch_size=args.batch_size)
+        reader.save(heads_path)
+        print(f"Saved exit classifiers to {heads_path}")
+    else:
+        reader = EarlyExitReader.load(heads_path, model, tokenizer)
+
+    validation = datasets["validation"]
+    if args.max_questions is not None:
+        validation = validation.select(range(min(args.max_questions, len(validation))))
+    examples = retrieved_examples(validation)
+    features = pipeline.prepare_validation_features(examples)
+    positive = window_labels(examples, features) > 0
+    print(
+        f"{len(validation)} questions, {len(positive)} windows, "
+        f"{positive.mean() * 100:.1f}% windows contain an answer string"
+    )
+
+    def evaluate(predict: Callable) -> dict:
+        t0 = time.perf_counter()
+        predictions = predict()
+        elapsed = time.perf_counter() - t0
+        all_predictions = pipeline.postprocess(examples, features, predictions)
+        metrics = pipeline.compute_metrics(
+            EvalPrediction(
+                predictions=[{"id": k, "prediction_text": v} for k, v in all_predictions.items()],
+                label_ids=[
+                    {"id": id_, "answers": answers}
+                    for id_, answers in zip(examples["id"], examples["answers"])
+                ],
+            )
+        )
+        metrics["seconds"] = round(elapsed, 3)
+        metrics["exited"] = predictions[0][:, 0] <= NULL_LOGIT
+        return metrics
+
+    base = evaluate(lambda: pipeline.predict(model, features, batch_size=args.batch_size))
+    print(f"[full] EM {base['exact_match']:.2f} F1 {base['f1']:.2f} {base['seconds']} s")
+    for threshold in args.thresholds:
+        reader.threshold = threshold
+        reader.reset_stats()
+        metrics = evaluate(lambda: reader.predict(features, batch_size=args.batch_size))
+        exited = metrics["exited"]
+        print(
+            f"[threshold {threshold}] EM {metrics['exact_match']:.2f} ({metrics['exact_match'] - base['exact_match']:+.2f}) "
+            f"F1 {metrics['f1']:.2f} ({metrics['f1'] - base['f1']:+.2f}) "
+            f"exited {exited.mean() * 100:.1f}% windows "
+            f"(answer windows kept {(~exited[positive]).mean() * 100:.1f}%), "
+            f"layers saved {reader.compute_saved() * 100:.1f}%, "
+            f"{metrics['seconds']} s ({base['seconds'] / max(metrics['seconds'], 1e-9):.2f}x)"
+        )
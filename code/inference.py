@@ -5,12 +5,15 @@ Open-Domain Question Answering 을 수행하는 inference 코드 입니다.
 """
 
 
+import dataclasses
 import logging
 import sys
-from typing import Callable, Dict, List, NoReturn, Tuple
+from typing import Callable, List, NoReturn, Optional, Tuple, Union
 
 import numpy as np
+import pandas as pd
 from arguments import DataTrainingArguments, ModelArguments
+from cache import AnswerCache, LRUCache, checkpoint_version
 from datasets import (
     Dataset,
     DatasetDict,
@@ -18,21 +21,31 @@ from datasets import (
     Sequence,
     Value,
     load_from_disk,
-    load_metric,
 )
-from retrieval import SparseRetrieval
+from early_exit import EarlyExitReader
+from instrumentation import export as export_instrumentation
+from model import Model
+from pipelined_inference import run_pipelined_inference
+from profiling import profile_stage
+from qa_pipeline import QAPipeline, uses_token_type_ids
+from quantization import ExportedReader, quantize_dynamic
+from reader_ensemble import EnsembleReader
+from rerank import CrossEncoderReranker
+from retrieval import BaseRetrieval, DenseRetrieval, HybridRetrieval, SparseRetrieval
 from trainer_qa import QuestionAnsweringTrainer
 from transformers import (
     AutoConfig,
     AutoModelForQuestionAnswering,
     AutoTokenizer,
     DataCollatorWithPadding,
-    EvalPrediction,
     HfArgumentParser,
+    PreTrainedModel,
+    PreTrainedTokenizerFast,
     TrainingArguments,
     set_seed,
 )
-from utils_qa import check_no_error, postprocess_qa_predictions
+from utils_qa import check_no_error, select_rows
+from window_filter import WindowFilter
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +60,11 @@ def main():
     model_args, data_args, training_args = parser.parse_args_into_dataclasses()
 
     training_args.do_train = True
+    # 양자화/export된 reader는 CPU에서만 실행되므로 Trainer가 GPU로 옮기지 않게 합니다.
+    # training_args.device는 처음 접근할 때 정해지므로 다른 코드보다 먼저 설정합니다.
+    if is_cpu_only_reader(model_args) and not training_args.no_cuda:
+        logger.warning("reader_quantization/exported_reader는 CPU에서만 실행되므로 no_cuda를 사용합니다.")
+        training_args.no_cuda = True
 
     print(f"model is from {model_args.model_name_or_path}")
     print(f"data is from {data_args.dataset_name}")
@@ -67,6 +85,81 @@ def main():
     datasets = load_from_disk(data_args.dataset_name)
     print(datasets)
 
+    # retrieval -> tokenization -> reader -> post-processing 을 chunk 단위로 겹쳐서 실행합니다.
+    # export된 reader와 early exit은 Trainer로 실행할 수 없으므로 항상 이 경로를 사용합니다.
+    pipelined = (
+        data_args.pipelined_inference
+        or model_args.exported_reader is not None
+        or model_args.early_exit_heads is not None
+    )
+    if pipelined:
+        check_pipelined_args(data_args)
+
+    tokenizer, model = load_reader(model_args)
+
+    if pipelined:
+        hooks = []
+        window_filter = build_window_filter(tokenizer, data_args)
+        if window_filter is not None:
+            hooks.append(("windows", window_filter.windows_hook))
+        if model_args.early_exit_heads is not None:
+            early_exit = EarlyExitReader.load(
+                model_args.early_exit_heads, model, tokenizer, model_args.early_exit_threshold
+            )
+            hooks.append(("predict", early_exit.predict_hook))
+        # eval_retrieval=False 이면 retrieval 없이 dataset의 context로 reader만 평가합니다.
+        retriever = build_retriever(tokenizer.tokenize, data_args) if data_args.eval_retrieval else None
+        metrics = run_pipelined_inference(
+            retriever, tokenizer, model, datasets["validation"], training_args, data_args, hooks
+        )
+        if metrics:
+            print(metrics)
+        if window_filter is not None:
+            print(f"window filter: {window_filter.stats}")
+        if model_args.early_exit_heads is not None:
+            print(f"early exit: {early_exit.stats}, {early_exit.compute_saved() * 100:.1f}% layers saved")
+        export_instrumentation(data_args.instrumentation_path)
+        return
+
+    # True일 경우 : run passage retrieval
+    if data_args.eval_retrieval:
+        with profile_stage(
+            "retrieval",
+            training_args.output_dir,
+            enabled=data_args.profile,
+            top_n=data_args.profile_top_n,
+        ):
+            datasets = run_sparse_retrieval(
+                tokenizer.tokenize, datasets, training_args, data_args,
+            )
+
+    # eval or predict mrc model
+    if training_args.do_eval or training_args.do_predict:
+        run_mrc(data_args, training_args, model_args, datasets, tokenizer, model)
+
+    # 단계별 소요 시간(span), feature 수 등을 JSON lines로 남깁니다.
+    export_instrumentation(data_args.instrumentation_path)
+
+
+def is_cpu_only_reader(model_args: ModelArguments) -> bool:
+    # dynamic int8 양자화 모듈과 TorchScript/ONNX export는 CUDA에서 실행할 수 없습니다.
+    return model_args.reader_quantization is not None or model_args.exported_reader is not None
+
+
+def check_pipelined_args(data_args: DataTrainingArguments) -> None:
+    # pipelined 경로에서 지원하지 않는 옵션은 무시하지 않고 바로 알립니다.
+    if data_args.answer_cache_size > 0:
+        raise ValueError(
+            "answer_cache_size는 pipelined inference (pipelined_inference, exported_reader, early_exit_heads)에서 지원하지 않습니다."
+        )
+    if data_args.profile:
+        # 단계들이 별도의 thread에서 실행되므로 cProfile로는 main thread만 보입니다.
+        raise ValueError(
+            "profile은 pipelined inference (pipelined_inference, exported_reader, early_exit_heads)에서 지원하지 않습니다."
+        )
+
+
+def load_reader(model_args: ModelArguments) -> Tuple[PreTrainedTokenizerFast, PreTrainedModel]:
     # AutoConfig를 이용하여 pretrained model 과 tokenizer를 불러옵니다.
     # argument로 원하는 모델 이름을 설정하면 옵션을 바꿀 수 있습니다.
     config = AutoConfig.from_pretrained(
@@ -80,21 +173,134 @@ def main():
         else model_args.model_name_or_path,
         use_fast=True,
     )
-    model = AutoModelForQuestionAnswering.from_pretrained(
+    # export된 reader는 tokenizer와 config만 원래 모델에서 가져옵니다.
+    if model_args.exported_reader is not None:
+        if model_args.ensemble_model_names:
+            raise ValueError("exported_reader는 ensemble_model_names와 함께 사용할 수 없습니다.")
+        return tokenizer, ExportedReader(model_args.exported_reader, config)
+    if model_args.ensemble_model_names and model_args.early_exit_heads is not None:
+        raise ValueError("early_exit_heads는 ensemble_model_names와 함께 사용할 수 없습니다.")
+
+    # train.py의 conv head 모델은 AutoModel로 불러올 수 없으므로 config.architectures로 구분합니다.
+    model_cls = (
+        Model
+        if getattr(config, "architectures", None) == [Model.__name__]
+        else AutoModelForQuestionAnswering
+    )
+    model = model_cls.from_pretrained(
         model_args.model_name_or_path,
         from_tf=bool(".ckpt" in model_args.model_name_or_path),
         config=config,
     )
+    if model_args.reader_quantization == "dynamic_int8":
+        model = quantize_dynamic(model)
+    elif model_args.reader_quantization is not None:
+        raise ValueError(f"지원하지 않는 reader_quantization 입니다: {model_args.reader_quantization}")
+    if not model_args.ensemble_model_names:
+        return tokenizer, model
+
+    # 같은 feature를 모든 reader에 넣으므로 vocab이 같은 checkpoint만 앙상블할 수 있습니다.
+    models = [model]
+    for name in model_args.ensemble_model_names:
+        member_tokenizer, member = load_reader(
+            dataclasses.replace(
+                model_args,
+                model_name_or_path=name,
+                config_name=None,
+                tokenizer_name=None,
+                ensemble_model_names=[],
+            )
+        )
+        if member_tokenizer.get_vocab() != tokenizer.get_vocab():
+            raise ValueError(f"{name}의 tokenizer가 {model_args.model_name_or_path}와 달라 앙상블할 수 없습니다.")
+        models.append(member)
+    return tokenizer, EnsembleReader(models, model_args.ensemble_weights or None)
 
-    # True일 경우 : run passage retrieval
-    if data_args.eval_retrieval:
-        datasets = run_sparse_retrieval(
-            tokenizer.tokenize, datasets, training_args, data_args,
+
+def build_retriever(
+    tokenize_fn: Callable[[str], List[str]],
+    data_args: DataTrainingArguments,
+    data_path: str = "../data",
+    context_path: str = "wikipedia_documents.json",
+) -> Union[BaseRetrieval, HybridRetrieval]:
+    cache = None
+    if data_args.retrieval_cache_size > 0:
+        cache = LRUCache(
+            max_size=data_args.retrieval_cache_size,
+            ttl=data_args.retrieval_cache_ttl,
+            path=data_args.retrieval_cache_path,
+        )
+    assert data_args.retrieval_type in ("sparse", "dense", "hybrid"), "retrieval_type은 sparse, dense, hybrid 중 하나입니다."
+
+    sparse, dense = None, None
+    if data_args.retrieval_type in ("sparse", "hybrid"):
+        sparse = SparseRetrieval(
+            tokenize_fn=tokenize_fn,
+            data_path=data_path,
+            context_path=context_path,
+            cache=cache,
+        )
+        sparse.get_sparse_embedding()
+    if data_args.retrieval_type in ("dense", "hybrid"):
+        assert data_args.dense_encoder_name is not None, "dense retrieval에는 --dense_encoder_name이 필요합니다."
+        # hybrid에서는 두 retriever가 같은 cache를 쓰면 version이 서로를 지우므로 sparse에만 cache를 둡니다.
+        dense = DenseRetrieval(
+            data_args.dense_encoder_name,
+            data_args.dense_passage_encoder_name,
+            data_path=data_path,
+            context_path=context_path,
+            cache=cache if sparse is None else None,
+            batch_size=data_args.dense_batch_size,
+            shard_size=data_args.dense_shard_size,
+        )
+        dense.get_dense_embedding()
+
+    for retriever in (sparse, dense):
+        if retriever is not None and data_args.use_faiss:
+            retriever.build_faiss(num_clusters=data_args.num_clusters)
+
+    if sparse is not None and dense is not None:
+        return HybridRetrieval(
+            sparse,
+            dense,
+            fusion=data_args.hybrid_fusion,
+            sparse_weight=data_args.hybrid_sparse_weight,
+            num_candidates=max(50, data_args.top_k_retrieval),
         )
+    return sparse if sparse is not None else dense
+
+
+def build_window_filter(tokenizer, data_args: DataTrainingArguments) -> Optional[WindowFilter]:
+    if data_args.window_keep_ratio >= 1.0:
+        return None
+    return WindowFilter(tokenizer, data_args.window_keep_ratio)
+
+
+def build_answer_cache(
+    model_args: ModelArguments,
+    data_args: DataTrainingArguments,
+    max_seq_length: int,
+) -> Optional[AnswerCache]:
+    if data_args.answer_cache_size <= 0:
+        return None
+    return AnswerCache(
+        LRUCache(max_size=data_args.answer_cache_size, path=data_args.answer_cache_path),
+        ensemble_version(model_args),
+        {
+            "max_seq_length": max_seq_length,
+            "doc_stride": data_args.doc_stride,
+            "max_answer_length": data_args.max_answer_length,
+        },
+    )
 
-    # eval or predict mrc model
-    if training_args.do_eval or training_args.do_predict:
-        run_mrc(data_args, training_args, model_args, datasets, tokenizer, model)
+
+def ensemble_version(model_args: ModelArguments) -> str:
+    # 앙상블이면 모든 checkpoint와 weight가 같을 때만 cache를 재사용합니다.
+    version = checkpoint_version(model_args.model_name_or_path)
+    if not model_args.ensemble_model_names:
+        return version
+    versions = [version] + [checkpoint_version(name) for name in model_args.ensemble_model_names]
+    return ":".join(versions + [str(weight) for weight in model_args.ensemble_weights])
 
 
 def run_sparse_retrieval(
@@ -107,24 +313,31 @@ def run_sparse_retrieval(
 ) -> DatasetDict:
 
     # Query에 맞는 Passage들을 Retrieval 합니다.
-    retriever = SparseRetrieval(
-        tokenize_fn=tokenize_fn, data_path=data_path, context_path=context_path
+    retriever = build_retriever(
+        tokenize_fn, data_args, data_path=data_path, context_path=context_path
     )
-    retriever.get_sparse_embedding()
+
+    # reranking을 하면 더 많은 후보를 가져온 뒤 cross-encoder로 top_k_retrieval개만 남깁니다.
+    topk = data_args.top_k_retrieval
+    if data_args.rerank_model_name is not None:
+        topk = max(data_args.rerank_candidates, topk)
 
     if data_args.use_faiss:
-        retriever.build_faiss(num_clusters=data_args.num_clusters)
-        df = retriever.retrieve_faiss(
-            datasets["validation"], topk=data_args.top_k_retrieval
-        )
+        df = retriever.retrieve_faiss(datasets["validation"], topk=topk)
     else:
-        df = retriever.retrieve(datasets["validation"], topk=data_args.top_k_retrieval)
+        df = retriever.retrieve(datasets["validation"], topk=topk)
+    retriever.save_cache()
+
+    if data_args.rerank_model_name is not None:
+        df = rerank_retrieved(df, retriever.contexts, data_args)
 
     # test data 에 대해선 정답이 없으므로 id question context 로만 데이터셋이 구성됩니다.
+    # context_id(retrieve된 passage id)는 answer cache의 key로 사용됩니다.
     if training_args.do_predict:
         f = Features(
             {
                 "context": Value(dtype="string", id=None),
+                "context_id": Sequence(Value(dtype="int64", id=None)),
                 "id": Value(dtype="string", id=None),
                 "question": Value(dtype="string", id=None),
             }
@@ -143,6 +356,7 @@ def run_sparse_retrieval(
                     id=None,
                 ),
                 "context": Value(dtype="string", id=None),
+                "context_id": Sequence(Value(dtype="int64", id=None)),
                 "id": Value(dtype="string", id=None),
                 "question": Value(dtype="string", id=None),
             }
@@ -151,6 +365,32 @@ def run_sparse_retrieval(
     return datasets
 
 
+def rerank_retrieved(
+    df: pd.DataFrame, contexts: List[str], data_args: DataTrainingArguments
+) -> pd.DataFrame:
+    reranker = CrossEncoderReranker(
+        data_args.rerank_model_name,
+        batch_size=data_args.rerank_batch_size,
+        max_length=data_args.max_seq_length,
+        margin=data_args.rerank_margin,
+    )
+    _, doc_indices, stats = reranker.rerank(
+        df["question"].tolist(),
+        df["context_id"].tolist(),
+        lambda pid: contexts[pid],
+        topk=data_args.top_k_retrieval,
+    )
+    print(
+        f"rerank: scored {stats['scored']} / {stats['candidates']} candidates, "
+        f"kept {stats['kept']} passages ({stats['kept'] / max(len(df), 1):.2f} per question)"
+    )
+
+    df = df.copy()
+    df["context_id"] = doc_indices
+    df["context"] = [" ".join(contexts[pid] for pid in indices) for indices in doc_indices]
+    return df
+
+
 def run_mrc(
     data_args: DataTrainingArguments,
     training_args: TrainingArguments,
@@ -160,71 +400,51 @@ def run_mrc(
     model,
 ) -> NoReturn:
 
-    # eval 혹은 prediction에서만 사용함
-    column_names = datasets["validation"].column_names
-
-    question_column_name = "question" if "question" in column_names else column_names[0]
-    context_column_name = "context" if "context" in column_names else column_names[1]
-    answer_column_name = "answers" if "answers" in column_names else column_names[2]
-
-    # Padding에 대한 옵션을 설정합니다.
-    # (question|context) 혹은 (context|question)로 세팅 가능합니다.
-    pad_on_right = tokenizer.padding_side == "right"
-
     # 오류가 있는지 확인합니다.
     last_checkpoint, max_seq_length = check_no_error(
         data_args, training_args, datasets, tokenizer
     )
 
-    # Validation preprocessing / 전처리를 진행합니다.
-    def prepare_validation_features(examples):
-        # truncation과 padding(length가 짧을때만)을 통해 toknization을 진행하며, stride를 이용하여 overflow를 유지합니다.
-        # 각 example들은 이전의 context와 조금씩 겹치게됩니다.
-        tokenized_examples = tokenizer(
-            examples[question_column_name if pad_on_right else context_column_name],
-            examples[context_column_name if pad_on_right else question_column_name],
-            truncation="only_second" if pad_on_right else "only_first",
-            max_length=max_seq_length,
-            stride=data_args.doc_stride,
-            return_overflowing_tokens=True,
-            return_offsets_mapping=True,
-            # return_token_type_ids=False, # roberta모델을 사용할 경우 False, bert를 사용할 경우 True로 표기해야합니다.
-            padding="max_length" if data_args.pad_to_max_length else False,
+    # 전처리/후처리는 train.py와 같은 pipeline을 사용합니다.
+    # eval 혹은 prediction에서만 사용함
+    pipeline = QAPipeline(
+        tokenizer,
+        data_args,
+        max_seq_length,
+        datasets["validation"].column_names,
+        return_token_type_ids=uses_token_type_ids(model.config),
+    )
+    # 질문과 겹치는 단어가 적은 window는 Trainer.predict에 넣기 전에 버립니다.
+    window_filter = build_window_filter(tokenizer, data_args)
+    if window_filter is not None:
+        pipeline.register_hook("windows", window_filter.windows_hook)
+
+    # answer cache를 사용하면 cache에 없는 question만 reader에 넣고, 나머지는 후처리 단계에서 채웁니다.
+    eval_examples = datasets["validation"]
+    reader_examples = eval_examples
+    answer_cache = build_answer_cache(model_args, data_args, max_seq_length)
+    if answer_cache is not None:
+        _, missing = answer_cache.lookup(eval_examples, record=False)
+        pipeline.register_hook("postprocess", answer_cache.postprocess_hook)
+        print(
+            f"answer cache: {len(eval_examples) - len(missing)} / {len(eval_examples)} questions cached"
         )
-
-        # 길이가 긴 context가 등장할 경우 truncate를 진행해야하므로, 해당 데이터셋을 찾을 수 있도록 mapping 가능한 값이 필요합니다.
-        sample_mapping = tokenized_examples.pop("overflow_to_sample_mapping")
-
-        # evaluation을 위해, prediction을 context의 substring으로 변환해야합니다.
-        # corresponding example_id를 유지하고 offset mappings을 저장해야합니다.
-        tokenized_examples["example_id"] = []
-
-        for i in range(len(tokenized_examples["input_ids"])):
-            # sequence id를 설정합니다 (to know what is the context and what is the question).
-            sequence_ids = tokenized_examples.sequence_ids(i)
-            context_index = 1 if pad_on_right else 0
-
-            # 하나의 example이 여러개의 span을 가질 수 있습니다.
-            sample_index = sample_mapping[i]
-            tokenized_examples["example_id"].append(examples["id"][sample_index])
-
-            # context의 일부가 아닌 offset_mapping을 None으로 설정하여 토큰 위치가 컨텍스트의 일부인지 여부를 쉽게 판별할 수 있습니다.
-            tokenized_examples["offset_mapping"][i] = [
-                (o if sequence_ids[k] == context_index else None)
-                for k, o in enumerate(tokenized_examples["offset_mapping"][i])
-            ]
-        return tokenized_examples
-
-    eval_dataset = datasets["validation"]
+        if not missing:
+            run_cached_mrc(training_args, pipeline, eval_examples)
+            answer_cache.save()
+            return
+        reader_examples = select_rows(eval_examples, missing)
 
     # Validation Feature 생성
-    eval_dataset = eval_dataset.map(
-        prepare_validation_features,
-        batched=True,
-        num_proc=data_args.preprocessing_num_workers,
-        remove_columns=column_names,
-        load_from_cache_file=not data_args.overwrite_cache,
-    )
+    with profile_stage(
+        "features",
+        training_args.output_dir,
+        enabled=data_args.profile,
+        top_n=data_args.profile_top_n,
+    ):
+        eval_dataset = pipeline.validation_features(reader_examples)
+    if window_filter is not None:
+        print(f"window filter: {len(eval_dataset)} features after keeping {data_args.window_keep_ratio:.0%} of windows")
 
     # Data collator
     # flag가 True이면 이미 max length로 padding된 상태입니다.
@@ -233,43 +453,6 @@ def run_mrc(
         tokenizer, pad_to_multiple_of=8 if training_args.fp16 else None
     )
 
-    # Post-processing:
-    def post_processing_function(
-        examples,
-        features,
-        predictions: Tuple[np.ndarray, np.ndarray],
-        training_args: TrainingArguments,
-    ) -> EvalPrediction:
-        # Post-processing: start logits과 end logits을 original context의 정답과 match시킵니다.
-        predictions = postprocess_qa_predictions(
-            examples=examples,
-            features=features,
-            predictions=predictions,
-            max_answer_length=data_args.max_answer_length,
-            output_dir=training_args.output_dir,
-        )
-        # Metric을 구할 수 있도록 Format을 맞춰줍니다.
-        formatted_predictions = [
-            {"id": k, "prediction_text": v} for k, v in predictions.items()
-        ]
-
-        if training_args.do_predict:
-            return formatted_predictions
-        elif training_args.do_eval:
-            references = [
-                {"id": ex["id"], "answers": ex[answer_column_name]}
-                for ex in datasets["validation"]
-            ]
-
-            return EvalPrediction(
-                predictions=formatted_predictions, label_ids=references
-            )
-
-    metric = load_metric("squad")
-
-    def compute_metrics(p: EvalPrediction) -> Dict:
-        return metric.compute(predictions=p.predictions, references=p.label_ids)
-
     print("init trainer...")
     # Trainer 초기화
     trainer = QuestionAnsweringTrainer(
@@ -277,20 +460,27 @@ def run_mrc(
         args=training_args,
         train_dataset=None,
         eval_dataset=eval_dataset,
-        eval_examples=datasets["validation"],
+        eval_examples=eval_examples,
         tokenizer=tokenizer,
         data_collator=data_collator,
-        post_process_function=post_processing_function,
-        compute_metrics=compute_metrics,
+        post_process_function=pipeline.post_processing_function,
+        compute_metrics=pipeline.compute_metrics,
     )
 
     logger.info("*** Evaluate ***")
 
     #### eval dataset & eval example - predictions.json 생성됨
     if training_args.do_predict:
-        predictions = trainer.predict(
-            test_dataset=eval_dataset, test_examples=datasets["validation"]
-        )
+        with profile_stage(
+            "predict",
+            training_args.output_dir,
+            enabled=data_args.profile,
+            use_torch=True,
+            top_n=data_args.profile_top_n,
+        ):
+            predictions = trainer.predict(
+                test_dataset=eval_dataset, test_examples=eval_examples
+            )
 
         # predictions.json 은 postprocess_qa_predictions() 호출시 이미 저장됩니다.
         print(
@@ -298,12 +488,41 @@ def run_mrc(
         )
 
     if training_args.do_eval:
-        metrics = trainer.evaluate()
+        with profile_stage(
+            "evaluate",
+            training_args.output_dir,
+            enabled=data_args.profile,
+            use_torch=True,
+            top_n=data_args.profile_top_n,
+        ):
+            metrics = trainer.evaluate()
         metrics["eval_samples"] = len(eval_dataset)
 
         trainer.log_metrics("test", metrics)
         trainer.save_metrics("test", metrics)
 
+    if answer_cache is not None:
+        answer_cache.save()
+
+
+def run_cached_mrc(
+    training_args: TrainingArguments, pipeline: QAPipeline, eval_examples: Dataset
+) -> NoReturn:
+    # 모든 question이 answer cache에 있으면 reader forward 없이 후처리 hook만 실행합니다.
+    empty = (np.zeros((0, 0), dtype=np.float32), np.zeros((0, 0), dtype=np.float32))
+    if training_args.do_predict:
+        pipeline.post_processing_function(eval_examples, {}, empty, training_args)
+        print(
+            "No metric can be presented because there is no correct answer given. Job done!"
+        )
+
+    if training_args.do_eval:
+        metrics = pipeline.compute_metrics(
+            pipeline.post_processing_function(eval_examples, {}, empty, training_args)
+        )
+        metrics["eval_samples"] = 0
+        print(f"***** test metrics *****\n{metrics}")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,213 @@
+"""
+retrieval -> feature 생성 -> reader -> 후처리 전체를 단계별로 측정하는 end-to-end benchmark 코드 입니다.
+
+GPU 없이도 작은 모델로 실행할 수 있으며, 단계별 시간/처리량/메모리와 EM/F1을 JSON으로 저장하고
+이전에 저장한 baseline JSON과 비교합니다.
+
+    python inference_benchmark.py --model_name_or_path <작은 reader 모델> --dataset_name ../data/train_dataset \
+        --baseline_path ./outputs/benchmark/baseline.json --save_as_baseline
+
+    # 이후 변경 사항 확인
+    python inference_benchmark.py --model_name_or_path <작은 reader 모델> --dataset_name ../data/train_dataset \
+        --baseline_path ./outputs/benchmark/baseline.json --fail_on_regression
+"""
+
+
+import json
+import logging
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+import torch
+from arguments import BenchmarkArguments, DataTrainingArguments, ModelArguments
+from datasets import load_from_disk
+from inference import build_retriever, load_reader
+from memory_usage import peak_rss_mb, reset_peak_rss, rss_mb
+from qa_pipeline import QAPipeline, uses_token_type_ids
+from transformers import EvalPrediction, HfArgumentParser
+
+logger = logging.getLogger(__name__)
+
+
+def measure(stages: Dict[str, Dict], name: str, num_items: int, fn: Callable, *args):
+    # 단계 하나를 실행하며 wall time, 처리량, 시작 시점 RSS와 단계 중 peak RSS를 기록합니다.
+    reset_peak_rss()
+    rss_before = rss_mb()
+    t0 = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - t0
+    stages[name] = {
+        "seconds": round(elapsed, 4),
+        "items": num_items,
+        "items_per_sec": round(num_items / max(elapsed, 1e-9), 2),
+        "rss_before_mb": round(rss_before, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    print(f"[{name}] {stages[name]}")
+    return result
+
+
+def compare(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+
+    """
+    Returns:
+        baseline보다 tolerance(상대 비율) 이상 느려진 단계와, tolerance * 100 point 이상 떨어진 metric 목록
+    """
+
+    regressions = []
+    for name, stage in result["stages"].items():
+        base = baseline["stages"].get(name)
+        if base is None or base["seconds"] <= 0:
+            continue
+        ratio = stage["seconds"] / base["seconds"]
+        print(f"{name:>12}: {base['seconds']:.4f}s -> {stage['seconds']:.4f}s ({ratio:.2f}x)")
+        if ratio > 1 + tolerance:
+            regressions.append(f"{name} {ratio:.2f}x slower")
+
+    for name, value in result["metrics"].items():
+        base = baseline["metrics"].get(name)
+        if base is None:
+            continue
+        print(f"{name:>12}: {base:.2f} -> {value:.2f} ({value - base:+.2f})")
+        if value < base - tolerance * 100:
+            regressions.append(f"{name} dropped {base - value:.2f} points")
+    return regressions
+
+
+def main():
+    parser = HfArgumentParser((ModelArguments, DataTrainingArguments, BenchmarkArguments))
+    model_args, data_args, benchmark_args = parser.parse_args_into_dataclasses()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+    )
+    if benchmark_args.num_threads is not None:
+        torch.set_num_threads(benchmark_args.num_threads)
+
+    validation = load_from_disk(data_args.dataset_name)["validation"]
+    if benchmark_args.max_questions is not None:
+        validation = validation.select(range(min(benchmark_args.max_questions, len(validation))))
+    num_questions = len(validation)
+
+    stages = {}
+    tokenizer, model = measure(stages, "load_reader", 1, load_reader, model_args)
+    model.to("cpu")
+    model.eval()
+    retriever = measure(
+        stages, "load_index", 1, build_retriever, tokenizer.tokenize, data_args
+    )
+
+    pipeline = QAPipeline(
+        tokenizer,
+        data_args,
+        min(data_args.max_seq_length, tokenizer.model_max_length),
+        ["id", "question", "context", "answers"],
+        return_token_type_ids=uses_token_type_ids(model.config),
+    )
+
+    def retrieve() -> Dict:
+        search = (
+            retriever.get_relevant_doc_bulk_faiss
+            if data_args.use_faiss
+            else retriever.get_relevant_doc_bulk
+        )
+        _, doc_indices = search(validation["question"], k=data_args.top_k_retrieval)
+        return {
+            "id": validation["id"],
+            "question": validation["question"],
+            "context": [
+                " ".join(retriever.contexts[pid] for pid in indices)
+                for indices in doc_indices
+            ],
+            "answers": validation["answers"],
+        }
+
+    examples = measure(stages, "retrieval", num_questions, retrieve)
+    features = measure(
+        stages, "features", num_questions, pipeline.prepare_validation_features, examples
+    )
+    num_features = len(features["input_ids"])
+    predictions = measure(
+        stages,
+        "reader",
+        num_features,
+        lambda: pipeline.predict(model, features, batch_size=benchmark_args.reader_batch_size),
+    )
+    all_predictions = measure(
+        stages,
+        "postprocess",
+        num_questions,
+        lambda: pipeline.postprocess(examples, features, predictions),
+    )
+
+    metrics = pipeline.compute_metrics(
+        EvalPrediction(
+            predictions=[{"id": k, "prediction_text": v} for k, v in all_predictions.items()],
+            label_ids=[
+                {"id": id_, "answers": answers}
+                for id_, answers in zip(examples["id"], examples["answers"])
+            ],
+        )
+    )
+    end_to_end = sum(
+        stages[name]["seconds"] for name in ("retrieval", "features", "reader", "postprocess")
+    )
+
+    result = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "model_name_or_path": model_args.model_name_or_path,
+            "dataset_name": data_args.dataset_name,
+            "retrieval_type": data_args.retrieval_type,
+            "use_faiss": data_args.use_faiss,
+            "top_k_retrieval": data_args.top_k_retrieval,
+            "max_seq_length": pipeline.max_seq_length,
+            "doc_stride": data_args.doc_stride,
+            "reader_batch_size": benchmark_args.reader_batch_size,
+            "num_threads": torch.get_num_threads(),
+        },
+        "platform": platform.platform(),
+        "num_questions": num_questions,
+        "num_features": num_features,
+        "stages": stages,
+        "end_to_end": {
+            "seconds": round(end_to_end, 4),
+            "questions_per_sec": round(num_questions / max(end_to_end, 1e-9), 2),
+        },
+        "metrics": {k: round(float(v), 4) for k, v in metrics.items()},
+    }
+    print(json.dumps(result["end_to_end"]), json.dumps(result["metrics"]))
+
+    os.makedirs(os.path.dirname(os.path.abspath(benchmark_args.benchmark_output)), exist_ok=True)
+    with open(benchmark_args.benchmark_output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=4)
+
+    regressions = []
+    baseline_path = benchmark_args.baseline_path
+    if baseline_path is not None and os.path.isfile(baseline_path) and not benchmark_args.save_as_baseline:
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"Compare with baseline {baseline_path} ({baseline['created_at']})")
+        regressions = compare(result, baseline, benchmark_args.regression_tolerance)
+        for regression in regressions:
+            logger.warning(f"Regression: {regression}")
+
+    if benchmark_args.save_as_baseline and baseline_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+        print(f"Saved baseline to {baseline_path}")
+
+    if regressions and benchmark_args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+hot path의 소요 시간과 횟수를 기록하는 가벼운 instrumentation 모듈 입니다.
+
+    from instrumentation import METRICS, span
+
+    with span("retrieval.transform"):
+        query_vec = tfidfv.transform(queries)
+    METRICS.count("retrieval.queries", len(queries))
+
+    METRICS.export_jsonl("metrics.jsonl")   # metric 하나당 JSON 한 줄
+    METRICS.prometheus_text()               # Prometheus text exposition format
+
+event를 하나씩 저장하지 않고 (count, sum, min, max, bucket별 count)만 누적하므로
+항상 켜두어도 span 하나에 수 μs 정도만 추가됩니다.
+"""
+
+
+import bisect
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# 초 단위 latency histogram의 bucket 상한입니다. (마지막은 +Inf)
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum", "min", "max")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        # bucket 상한으로 근사한 quantile 입니다.
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    def __init__(self, enabled: bool = True, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+
+        """
+        Arguments:
+            enabled (bool):
+                False이면 span/count/observe가 아무것도 기록하지 않습니다.
+            buckets (Tuple[float, ...]):
+                histogram bucket 상한(초)입니다.
+
+        Note:
+            여러 thread(예: serve.py의 handler, pipelined_inference의 stage)에서 동시에 사용해도 안전합니다.
+        """
+
+        self.enabled = enabled
+        self.buckets = buckets
+        self._counters: Dict[str, float] = {}
+        self._histograms: Dict[str, _Histogram] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        # 이름 붙은 구간의 소요 시간(초)을 `name` histogram에 기록합니다.
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0)
+
+    def count(self, name: str, value: float = 1) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = _Histogram(self.buckets)
+            histogram.observe(value)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self) -> List[Dict]:
+        with self._lock:
+            records = [
+                {"type": "counter", "name": name, "value": value}
+                for name, value in sorted(self._counters.items())
+            ]
+            for name, h in sorted(self._histograms.items()):
+                records.append(
+                    {
+                        "type": "histogram",
+                        "name": name,
+                        "count": h.count,
+                        "sum": round(h.sum, 6),
+                        "mean": round(h.sum / h.count, 6) if h.count else 0.0,
+                        "min": round(h.min, 6) if h.count else 0.0,
+                        "max": round(h.max, 6) if h.count else 0.0,
+                        "p50": round(h.quantile(0.5), 6),
+                        "p95": round(h.quantile(0.95), 6),
+                        "p99": round(h.quantile(0.99), 6),
+                        "buckets": dict(zip([*map(str, h.buckets), "+Inf"], h.counts)),
+                    }
+                )
+        return records
+
+    def export_jsonl(self, path: str, mode: str = "a") -> None:
+        # 실행마다 같은 파일에 이어서 쓸 수 있도록 각 줄에 기록 시각을 남깁니다.
+        timestamp = time.time()
+        with open(path, mode, encoding="utf-8") as f:
+            for record in self.snapshot():
+                f.write(json.dumps({"timestamp": timestamp, **record}, ensure_ascii=False) + "\n")
+
+    def prometheus_text(self, prefix: str = "odqa") -> str:
+        lines = []
+        for record in self.snapshot():
+            name = _prometheus_name(prefix, record["name"])
+            if record["type"] == "counter":
+                lines.append(f"# TYPE {name}_total counter")
+                lines.append(f"{name}_total {record['value']}")
+                continue
+            name = f"{name}_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in record["buckets"].items():
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum {record['sum']}")
+            lines.append(f"{name}_count {record['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def _prometheus_name(prefix: str, name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", f"{prefix}_{name}")
+
+
+# process 전체에서 공유하는 기본 registry 입니다.
+METRICS = Metrics()
+
+
+def span(name: str):
+    return METRICS.span(name)
+
+
+def export(path: Optional[str]) -> None:
+    if path is not None:
+        METRICS.export_jsonl(path)
@@ -0,0 +1,42 @@
+"""
+benchmark 코드들이 공유하는 process memory(RSS) 측정 함수 입니다.
+
+무거운 package를 import하지 않으므로 model.py 처럼 retrieval과 관계없는 코드에서도 사용할 수 있습니다.
+"""
+
+
+import platform
+import resource
+
+
+def reset_peak_rss() -> None:
+    # Linux에서는 /proc/self/clear_refs에 5를 쓰면 peak RSS(VmHWM)가 현재 값으로 초기화됩니다.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # /proc이 없으면 process 전체의 peak를 사용합니다. (macOS는 byte, Linux는 KB 단위)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if platform.system() == "Darwin" else peak / 1024
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
@@ -0,0 +1,234 @@
+"""
+train.py 에서 학습하는 Roberta + conv head QA 모델 입니다.
+
+inference.py, quantization.py 에서도 불러올 수 있도록 train.py 에서 분리했습니다.
+저장된 checkpoint의 config.architectures가 ["Model"]이면 inference.py의 `load_reader`가 이 class로 불러옵니다.
+
+conv head의 구현별(permute를 반복하는 기존 방식 / channels_last fused / + gradient checkpointing)
+peak activation memory와 학습 step 시간 비교:
+    python model.py --seq_len 384 --batch_size 16
+"""
+
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn import CrossEntropyLoss
+from torch.utils.checkpoint import checkpoint
+from transformers.modeling_outputs import QuestionAnsweringModelOutput
+from transformers.models.roberta.modeling_roberta import RobertaModel, RobertaPreTrainedModel
+
+
+class Model(RobertaPreTrainedModel):
+    def __init__(self, config):
+        super().__init__(config)
+        self.num_labels = config.num_labels
+
+        self.roberta = RobertaModel(config, add_pooling_layer=False)
+        self.qa_outputs = nn.Linear(config.hidden_size, config.num_labels)
+        self.conv1 = nn.Conv1d(
+            in_channels=config.hidden_size,
+            out_channels=config.hidden_size*2,
+            kernel_size=3,
+            padding=1
+        )
+        self.conv2 = nn.Conv1d(
+            in_channels=config.hidden_size*2,
+            out_channels=config.hidden_size,
+            kernel_size=1,
+        )
+        self.layer_norm = nn.LayerNorm(config.hidden_size)
+        # True이면 학습 중 conv block의 activation을 저장하지 않고 backward 때 다시 계산합니다.
+        self.head_gradient_checkpointing = getattr(config, "head_gradient_checkpointing", False)
+        self.init_weights()
+
+    def _conv_block(self, hidden_states):
+        # hidden_states: (B, L, H). head 전체에서 hidden 축이 마지막인 layout을 유지합니다.
+        # (B, H, 1, L) view는 channels_last 4D tensor와 memory 배치가 같으므로 transpose 복사 없이 conv2d에 넣습니다.
+        out = F.conv2d(
+            hidden_states.transpose(1, 2).unsqueeze(2),
+            self.conv1.weight.unsqueeze(2),
+            self.conv1.bias,
+            padding=(0, 1),
+        )
+        # channels_last 출력은 memory 상 (B, L, 2H) 이므로 kernel 1인 conv2는 linear로 계산합니다.
+        out = F.linear(out.squeeze(2).transpose(1, 2), self.conv2.weight.squeeze(-1), self.conv2.bias)
+        # linear의 backward는 출력을 쓰지 않으므로 relu는 항상 in-place로 계산합니다.
+        out = torch.relu_(out)
+        # relu의 backward에는 출력이 필요하므로 residual은 gradient를 계산하지 않을 때만 in-place로 더합니다.
+        if torch.is_grad_enabled():
+            out = out + hidden_states
+        else:
+            out += hidden_states
+        return self.layer_norm(out)
+
+    def qa_logits(self, sequence_output):
+        # encoder 출력 (B, L, H) 에서 (B, L, num_labels) logits을 계산합니다. early_exit.py도 이 함수를 사용합니다.
+        for _ in range(5):
+            if self.head_gradient_checkpointing and self.training:
+                sequence_output = checkpoint(self._conv_block, sequence_output)
+            else:
+                sequence_output = self._conv_block(sequence_output)
+        return self.qa_outputs(sequence_output)
+
+    def forward(
+        self,
+        input_ids=None,
+        attention_mask=None,
+        token_type_ids=None,
+        position_ids=None,
+        head_mask=None,
+        inputs_embeds=None,
+        start_positions=None,
+        end_positions=None,
+        output_attentions=None,
+        output_hidden_states=None,
+        return_dict=None,
+    ):
+        return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+
+        outputs = self.roberta(
+            input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+            position_ids=position_ids,
+            head_mask=head_mask,
+            inputs_embeds=inputs_embeds,
+            output_attentions=output_attentions,
+            output_hidden_states=output_hidden_states,
+            return_dict=return_dict,
+        )
+
+        logits = self.qa_logits(outputs[0])
+        start_logits, end_logits = logits.split(1, dim=-1)
+        start_logits = start_logits.squeeze(-1)
+        end_logits = end_logits.squeeze(-1)
+
+        total_loss = None
+        if start_positions is not None and end_positions is not None:
+            # If we are on multi-GPU, split add a dimension
+            if len(start_positions.size()) > 1:
+                start_positions = start_positions.squeeze(-1)
+            if len(end_positions.size()) > 1:
+                end_positions = end_positions.squeeze(-1)
+            # sometimes the start/end positions are outside our model inputs, we ignore these terms
+            ignored_index = start_logits.size(1)
+            start_positions.clamp_(0, ignored_index)
+            end_positions.clamp_(0, ignored_index)
+
+            loss_fct = CrossEntropyLoss(ignore_index=ignored_index)
+            start_loss = loss_fct(start_logits, start_positions)
+            end_loss = loss_fct(end_logits, end_positions)
+            total_loss = (start_loss + end_loss) / 2
+
+        if not return_dict:
+            output = (start_logits, end_logits) + outputs[2:]
+            return ((total_loss,) + output) if total_loss is not None else output
+
+        return QuestionAnsweringModelOutput(
+            loss=total_loss,
+            start_logits=start_logits,
+            end_logits=end_logits,
+            hidden_states=outputs.hidden_states,
+            attentions=outputs.attentions,
+        )
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import time
+
+    from memory_usage import peak_rss_mb, reset_peak_rss
+    from transformers import RobertaConfig
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("--seq_len", default=384, type=int, help="")
+    parser.add_argument("--batch_size", default=16, type=int, help="")
+    parser.add_argument("--hidden_size", default=768, type=int, help="")
+    parser.add_argument("--steps", default=10, type=int, help="")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str, help="")
+    args = parser.parse_args()
+
+    # head만 측정하므로 encoder는 1 layer로 만들고 사용하지 않습니다.
+    config = RobertaConfig(hidden_size=args.hidden_size, num_hidden_layers=1, num_labels=2)
+    model = Model(config).to(args.device).train()
+
+    def reference_head(hidden_states):
+        # layout 수정만 반영한 기존 구현입니다. 반복마다 (B, H, L) <-> (B, L, H) 복사가 일어납니다.
+        hidden_states = hidden_states.permute(0, 2, 1)
+        for _ in range(5):
+            out = model.conv2(model.conv1(hidden_states))
+            out = hidden_states + torch.relu(out)
+            hidden_states = model.layer_norm(out.permute(0, 2, 1)).permute(0, 2, 1)
+        return model.qa_outputs(hidden_states.permute(0, 2, 1))
+
+    def memory_mb() -> float:
+        if args.device.startswith("cuda"):
+            return torch.cuda.memory_allocated() / 1024 / 1024
+        return peak_rss_mb()
+
+    def peak_memory_mb() -> float:
+        if args.device.startswith("cuda"):
+            return torch.cuda.max_memory_allocated() / 1024 / 1024
+        return peak_rss_mb()
+
+    def reset_peak_memory() -> None:
+        if args.device.startswith("cuda"):
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            reset_peak_rss()
+
+    def synchronize() -> None:
+        if args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+
+    hidden_states = torch.randn(
+        args.batch_size, args.seq_len, args.hidden_size, device=args.device, requires_grad=True
+    )
+    with torch.no_grad():
+        expected = reference_head(hidden_states)
+        print(f"max |logit diff| fused vs reference: {(model.qa_logits(hidden_states) - expected).abs().max().item():.2e}")
+
+    results = {}
+    for name, head, use_checkpoint in (
+        ("reference", reference_head, False),
+        ("fused", model.qa_logits, False),
+        ("fused+checkpoint", model.qa_logits, True),
+    ):
+        model.head_gradient_checkpointing = use_checkpoint
+        # 첫 step은 kernel 선택, allocator warm-up 때문에 측정에서 제외합니다.
+        head(hidden_states).sum().backward()
+        model.zero_grad(set_to_none=True)
+        hidden_states.grad = None
+        synchronize()
+
+        # CPU에서는 RSS의 peak를 사용하므로 allocator가 재사용하는 memory만큼 작게 측정될 수 있습니다.
+        reset_peak_memory()
+        before = memory_mb()
+        logits = head(hidden_states)
+        synchronize()
+        activation_mb = peak_memory_mb() - before
+        logits.sum().backward()
+        del logits
+
+        synchronize()
+        t0 = time.perf_counter()
+        for _ in range(args.steps):
+            model.zero_grad(set_to_none=True)
+            hidden_states.grad = None
+            head(hidden_states).sum().backward()
+        synchronize()
+        results[name] = {
+            "activation_mb": round(activation_mb, 1),
+            "step_ms": round((time.perf_counter() - t0) / args.steps * 1000, 2),
+        }
+
+    print(f"batch {args.batch_size}, seq_len {args.seq_len}, hidden {args.hidden_size}, device {args.device}")
+    base = results["reference"]
+    for name, result in results.items():
+        print(
+            f"[{name}] activation {result['activation_mb']} MiB "
+            f"({result['activation_mb'] / max(base['activation_mb'], 1e-9):.2f}x) "
+            f"step {result['step_ms']} ms ({result['step_ms'] / base['step_ms']:.2f}x)"
+        )
@@ -0,0 +1,302 @@
+"""
+retrieval -> tokenization -> reader -> post-processing 을 question chunk 단위로 겹쳐서 실행하는 inference 코드 입니다.
+
+각 단계는 별도의 worker thread에서 실행되고 단계 사이는 크기가 제한된 queue로 연결되므로,
+CPU에서 도는 retrieval/tokenization이 reader의 forward와 동시에 진행되며 첫 결과도 빨리 나옵니다.
+(tokenizers, torch, scipy의 무거운 연산은 GIL을 놓기 때문에 thread로도 충분히 겹쳐집니다.)
+
+    python inference.py --output_dir ./outputs/test_dataset/ --dataset_name ../data/test_dataset/ \
+        --model_name_or_path ./models/train_dataset/ --do_predict --pipelined_inference
+"""
+
+
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from arguments import DataTrainingArguments
+from datasets import Dataset
+from instrumentation import span
+from qa_pipeline import QAPipeline, uses_token_type_ids
+from rerank import CrossEncoderReranker
+from retrieval import SparseRetrieval
+from transformers import EvalPrediction, TrainingArguments
+from utils_qa import save_predictions
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class _StageFailure:
+    def __init__(self, stage: str, error: BaseException):
+        self.stage = stage
+        self.error = error
+
+
+def run_stages(
+    source: Iterable,
+    stages: List[Tuple[str, Callable]],
+    queue_size: int = 2,
+    busy_time: Dict[str, float] = None,
+) -> Iterator:
+
+    """
+    Arguments:
+        source (Iterable):
+            첫 단계에 들어갈 item들입니다. 별도의 thread에서 순회합니다.
+        stages (List[Tuple[str, Callable]]):
+            (이름, 함수) 목록입니다. 각 함수는 이전 단계의 결과 하나를 받아 다음 단계로 넘길 값을 반환합니다.
+        queue_size (int):
+            단계 사이에 쌓일 수 있는 최대 item 수입니다. 느린 단계가 있으면 앞 단계가 여기서 기다립니다.
+        busy_time (Dict[str, float], optional):
+            주어지면 각 단계가 실제로 일한 시간(초)을 누적합니다.
+
+    Returns:
+        마지막 단계의 결과를 source 순서대로 내보내는 iterator
+
+    Note:
+        한 단계에서 exception이 발생하면 나머지 단계를 멈추고 caller 쪽에서 다시 raise 합니다.
+    """
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+
+    def put(q: queue.Queue, item) -> bool:
+        # 다른 단계가 실패해서 stop이 설정되면 더 이상 기다리지 않습니다.
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q: queue.Queue):
+        # put과 마찬가지로 stop이 설정되면 더 이상 기다리지 않고 _END를 반환합니다.
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def feed():
+        try:
+            for item in source:
+                if not put(queues[0], item):
+                    return
+        except BaseException as e:
+            put(queues[0], _StageFailure("source", e))
+            return
+        put(queues[0], _END)
+
+    def work(name: str, fn: Callable, q_in: queue.Queue, q_out: queue.Queue):
+        while True:
+            item = get(q_in)
+            if item is _END or isinstance(item, _StageFailure):
+                put(q_out, item)
+                return
+            try:
+                t0 = time.perf_counter()
+                with span(f"pipelined.{name}"):
+                    result = fn(item)
+                if busy_time is not None:
+                    busy_time[name] = busy_time.get(name, 0.0) + time.perf_counter() - t0
+            except BaseException as e:
+                put(q_out, _StageFailure(name, e))
+                return
+            if not put(q_out, result):
+                return
+
+    threads = [threading.Thread(target=feed, name="stage-source", daemon=True)]
+    for i, (name, fn) in enumerate(stages):
+        threads.append(
+            threading.Thread(
+                target=work,
+                args=(name, fn, queues[i], queues[i + 1]),
+                name=f"stage-{name}",
+                daemon=True,
+            )
+        )
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _END:
+                return
+            if isinstance(item, _StageFailure):
+                raise RuntimeError(f"pipeline stage '{item.stage}' failed") from item.error
+            yield item
+    finally:
+        stop.set()
+
+
+def run_pipelined_inference(
+    retriever: Optional[SparseRetrieval],
+    tokenizer,
+    model,
+    dataset: Dataset,
+    training_args: TrainingArguments,
+    data_args: DataTrainingArguments,
+    hooks: Iterable[Tuple[str, Callable]] = (),
+) -> Dict:
+
+    """
+    Arguments:
+        retriever:
+            embedding 준비 (use_faiss인 경우 build_faiss()까지)가 끝난 retriever 입니다.
+            None이면 (eval_retrieval=False) retrieval 없이 dataset의 context를 그대로 사용합니다.
+        dataset:
+            question, id (eval인 경우 answers까지)를 가진 validation/test dataset 입니다.
+            retriever가 None이면 context column도 있어야 합니다.
+        hooks:
+            내부 QAPipeline에 등록할 (stage, hook) 목록입니다. (예: early_exit의 predict hook)
+
+    Summary:
+        `run_sparse_retrieval` + `run_mrc`와 같은 결과(predictions.json, nbest_predictions.json)를 만들지만,
+        question chunk 단위로 단계를 겹쳐서 실행합니다. do_eval인 경우 EM/F1을 계산해 반환합니다.
+    """
+
+    has_answers = "answers" in dataset.column_names
+    if retriever is None and "context" not in dataset.column_names:
+        raise ValueError("eval_retrieval=False 이면 dataset에 context column이 있어야 합니다.")
+    pipeline = QAPipeline(
+        tokenizer,
+        data_args,
+        min(data_args.max_seq_length, tokenizer.model_max_length),
+        ["id", "question", "context"],
+        return_token_type_ids=uses_token_type_ids(model.config),
+    )
+    for stage, hook in hooks:
+        pipeline.register_hook(stage, hook)
+    model.to(training_args.device)
+    model.eval()
+
+    chunk_size = data_args.pipeline_chunk_size
+    topk = data_args.top_k_retrieval
+
+    # reranking을 하면 retrieve 단계에서 더 많은 후보를 가져온 뒤 cross-encoder로 top_k_retrieval개만 남깁니다.
+    # retrieval을 하지 않는 경우에는 run_sparse_retrieval 경로와 같이 reranking도 하지 않습니다.
+    reranker = None
+    if retriever is not None and data_args.rerank_model_name is not None:
+        reranker = CrossEncoderReranker(
+            data_args.rerank_model_name,
+            batch_size=data_args.rerank_batch_size,
+            max_length=data_args.max_seq_length,
+            margin=data_args.rerank_margin,
+        )
+        topk = max(data_args.rerank_candidates, topk)
+
+    def chunks():
+        for start in range(0, len(dataset), chunk_size):
+            yield dataset[start : start + chunk_size]
+
+    def retrieve(batch):
+        if retriever is None:
+            # gold context로 reader만 평가합니다.
+            examples = {k: batch[k] for k in ("id", "question", "context")}
+            if has_answers:
+                examples["answers"] = batch["answers"]
+            return examples
+        if data_args.use_faiss:
+            _, doc_indices = retriever.get_relevant_doc_bulk_faiss(
+                batch["question"], k=topk
+            )
+        else:
+            _, doc_indices = retriever.get_relevant_doc_bulk(batch["question"], k=topk)
+        if reranker is not None:
+            _, doc_indices, _ = reranker.rerank(
+                batch["question"],
+                doc_indices,
+                lambda pid: retriever.contexts[pid],
+                topk=data_args.top_k_retrieval,
+            )
+        examples = {
+            "id": batch["id"],
+            "question": batch["question"],
+            "context": [
+                " ".join(retriever.contexts[pid] for pid in indices)
+                for indices in doc_indices
+            ],
+        }
+        if has_answers:
+            examples["answers"] = batch["answers"]
+        return examples
+
+    def tokenize(examples):
+        return examples, pipeline.prepare_validation_features(examples)
+
+    def read(item):
+        examples, features = item
+        predictions = pipeline.predict(
+            model, features, batch_size=training_args.per_device_eval_batch_size
+        )
+        return examples, features, predictions
+
+    def postprocess(item):
+        examples, features, predictions = item
+        return examples, pipeline.postprocess(
+            examples, features, predictions, output_dir=None, return_nbest=True
+        )
+
+    all_predictions, all_nbest = {}, {}
+    references = []
+    busy_time = {}
+    first_result = None
+
+    t0 = time.perf_counter()
+    for examples, (predictions, nbest) in run_stages(
+        chunks(),
+        [
+            ("retrieve", retrieve),
+            ("tokenize", tokenize),
+            ("reader", read),
+            ("postprocess", postprocess),
+        ],
+        queue_size=data_args.pipeline_queue_size,
+        busy_time=busy_time,
+    ):
+        if first_result is None:
+            first_result = time.perf_counter() - t0
+            logger.info(f"First {len(predictions)} predictions ready in {first_result:.3f} s")
+        all_predictions.update(predictions)
+        all_nbest.update(nbest)
+        if has_answers:
+            references.extend(
+                {"id": id_, "answers": answers}
+                for id_, answers in zip(examples["id"], examples["answers"])
+            )
+    elapsed = time.perf_counter() - t0
+    if retriever is not None:
+        retriever.save_cache()
+
+    logger.info(
+        f"Pipelined inference over {len(dataset)} questions done in {elapsed:.3f} s "
+        f"(first result {first_result or 0:.3f} s, stage busy time "
+        + ", ".join(f"{k}={v:.3f}s" for k, v in busy_time.items())
+        + ")"
+    )
+
+    os.makedirs(training_args.output_dir, exist_ok=True)
+    save_predictions(
+        all_predictions, all_nbest, training_args.output_dir, nbest_format=data_args.nbest_format
+    )
+
+    metrics = {}
+    if training_args.do_eval and has_answers:
+        metrics = pipeline.compute_metrics(
+            EvalPrediction(
+                predictions=[
+                    {"id": k, "prediction_text": v} for k, v in all_predictions.items()
+                ],
+                label_ids=references,
+            )
+        )
+        logger.info(f"Pipelined inference metrics: {metrics}")
+    return metrics
@@ -0,0 +1,110 @@
+"""
+`--profile` 옵션으로 켜는 단계별 profiling 코드 입니다.
+
+단계마다 `{output_dir}/profile/` 아래에 다음 파일을 남깁니다.
+    {stage}.prof           cProfile 결과 (snakeviz, flameprof 등으로 flamegraph를 그릴 수 있습니다)
+    {stage}_cpu.txt        cumulative time 기준 상위 N개 함수
+    {stage}_alloc.txt      (trace_memory 사용 시) tracemalloc 기준 상위 N개 할당 위치와 peak 메모리
+    {stage}.folded         (torch profiler 사용 시) flamegraph.pl 에 바로 넣을 수 있는 collapsed stack
+    {stage}_trace.json     (torch profiler 사용 시) chrome://tracing, Perfetto에서 볼 수 있는 trace
+"""
+
+
+import cProfile
+import io
+import os
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from typing import Iterator
+
+import torch
+
+
+@contextmanager
+def profile_stage(
+    name: str,
+    output_dir: str,
+    enabled: bool = False,
+    use_torch: bool = False,
+    top_n: int = 30,
+    trace_memory: bool = True,
+) -> Iterator[None]:
+
+    """
+    Arguments:
+        name (str): 단계 이름. 파일 이름으로 사용됩니다.
+        output_dir (str): 결과를 저장할 경로. `profile/` 하위 폴더에 저장합니다.
+        enabled (bool): False이면 아무것도 하지 않습니다.
+        use_torch (bool):
+            True이면 torch.profiler로 operator 단위 시간도 기록합니다.
+            모든 event를 memory에 쌓으므로 학습 전체처럼 긴 단계에는 사용하지 마세요.
+        top_n (int): 요약 파일에 남길 함수/할당 위치 수
+        trace_memory (bool):
+            True이면 tracemalloc으로 할당 위치와 peak 메모리를 기록합니다.
+            모든 할당마다 stack을 저장해 몇 배 느려지므로 학습처럼 긴 단계에서는 끄세요.
+    """
+
+    if not enabled:
+        yield
+        return
+
+    profile_dir = os.path.join(output_dir, "profile")
+    os.makedirs(profile_dir, exist_ok=True)
+
+    # 이미 다른 단계가 tracemalloc을 켜둔 경우(중첩된 단계)에는 그 단계가 끄도록 둡니다.
+    started_tracemalloc = trace_memory and not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(25)
+    # reset_peak은 Python 3.9부터 있습니다. 3.8에서 중첩된 단계의 peak은 바깥 단계 시작부터의 값입니다.
+    if trace_memory and hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+
+    torch_profiler = None
+    if use_torch:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        torch_profiler = torch.profiler.profile(
+            activities=activities, record_shapes=True, profile_memory=True, with_stack=True
+        )
+        torch_profiler.__enter__()
+
+    cpu_profiler = cProfile.Profile()
+    cpu_profiler.enable()
+    try:
+        yield
+    finally:
+        cpu_profiler.disable()
+        if torch_profiler is not None:
+            torch_profiler.__exit__(None, None, None)
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+        prefix = os.path.join(profile_dir, name)
+        cpu_profiler.dump_stats(f"{prefix}.prof")
+        stream = io.StringIO()
+        pstats.Stats(cpu_profiler, stream=stream).sort_stats("cumulative").print_stats(top_n)
+        with open(f"{prefix}_cpu.txt", "w", encoding="utf-8") as f:
+            f.write(stream.getvalue())
+
+        if trace_memory:
+            with open(f"{prefix}_alloc.txt", "w", encoding="utf-8") as f:
+                f.write(f"peak traced memory: {peak / 1024 / 1024:.1f} MiB\n\n")
+                for stat in snapshot.statistics("lineno")[:top_n]:
+                    f.write(f"{stat}\n")
+
+        if torch_profiler is not None:
+            torch_profiler.export_chrome_trace(f"{prefix}_trace.json")
+            torch_profiler.export_stacks(f"{prefix}.folded", "self_cpu_time_total")
+            with open(f"{prefix}_torch.txt", "w", encoding="utf-8") as f:
+                f.write(
+                    torch_profiler.key_averages().table(
+                        sort_by="self_cpu_time_total", row_limit=top_n
+                    )
+                )
+
+        print(f"[profile] {name}: saved to {prefix}*")
@@ -0,0 +1,421 @@
+"""
+train.py 와 inference.py 가 함께 사용하는 MRC 전처리/후처리 pipeline 입니다.
+
+tokenize -> windows -> predict -> postprocess 의 각 단계는 batch 단위로 동작하며,
+`QAPipeline.register_hook`으로 단계마다 caching, 병렬화 같은 기능을 끼워 넣을 수 있습니다.
+"""
+
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from arguments import DataTrainingArguments
+from datasets import Dataset, load_metric
+from instrumentation import METRICS, span
+from transformers import EvalPrediction, TrainingArguments
+from utils_qa import (
+    _column_names,
+    postprocess_qa_predictions,
+    validation_features_schema,
+)
+from window_planner import WINDOW_PLANNERS, plan_validation_windows
+
+# pipeline을 구성하는 단계들입니다. hook은 이 이름으로 등록합니다.
+STAGES = ("tokenize", "windows", "predict", "postprocess")
+
+
+def uses_token_type_ids(config) -> bool:
+    """
+    모델이 token_type_ids를 사용하는지 판별합니다.
+
+    klue/roberta 처럼 BertTokenizer를 쓰지만 type_vocab_size가 1인 모델에
+    token_type_ids를 넘기면 embedding index 오류가 발생하므로, tokenizer가 아닌 config를 기준으로 정합니다.
+    """
+    return getattr(config, "type_vocab_size", 0) > 1
+
+
+def _model_device(model) -> torch.device:
+    # TorchScript/ONNX wrapper처럼 parameter가 없는 모델은 CPU에서 실행합니다.
+    try:
+        return next(model.parameters()).device
+    except (AttributeError, StopIteration):
+        return torch.device("cpu")
+
+
+class QAPipeline:
+    def __init__(
+        self,
+        tokenizer,
+        data_args: DataTrainingArguments,
+        max_seq_length: int,
+        column_names: List[str],
+        return_token_type_ids: Optional[bool] = None,
+    ):
+
+        """
+        Arguments:
+            tokenizer:
+                Fast tokenizer 여야 합니다. (offset mapping, overflow를 사용합니다.)
+
+            data_args:
+                doc_stride, pad_to_max_length, max_answer_length 등의 설정을 가져옵니다.
+
+            max_seq_length:
+                `check_no_error`에서 tokenizer의 최대 길이로 보정된 값입니다.
+
+            column_names:
+                원본 dataset의 column 이름들입니다. question/context/answer column을 찾는 데 사용합니다.
+
+            return_token_type_ids:
+                None이면 tokenizer의 model_input_names를 따릅니다.
+                모델 config로부터 정하려면 `uses_token_type_ids(config)`를 넘겨주세요.
+
+        Summary:
+            train/validation feature 생성, 모델 예측, 후처리를 하나의 객체로 묶습니다.
+        """
+
+        self.tokenizer = tokenizer
+        self.data_args = data_args
+        self.max_seq_length = max_seq_length
+
+        self.question_column_name = (
+            "question" if "question" in column_names else column_names[0]
+        )
+        self.context_column_name = (
+            "context" if "context" in column_names else column_names[1]
+        )
+        self.answer_column_name = (
+            "answers" if "answers" in column_names else column_names[2]
+        )
+
+        # Padding에 대한 옵션을 설정합니다.
+        # (question|context) 혹은 (context|question)로 세팅 가능합니다.
+        self.pad_on_right = tokenizer.padding_side == "right"
+
+        if return_token_type_ids is None:
+            return_token_type_ids = "token_type_ids" in tokenizer.model_input_names
+        self.return_token_type_ids = return_token_type_ids
+
+        self._hooks: Dict[str, List[Callable]] = {stage: [] for stage in STAGES}
+        self._metric = None
+
+    def register_hook(self, stage: str, hook: Callable[[Callable], Callable]) -> None:
+
+        """
+        Arguments:
+            stage (str):
+                "tokenize", "windows", "predict", "postprocess" 중 하나입니다.
+            hook (Callable[[Callable], Callable]):
+                해당 단계의 함수를 받아 같은 signature의 함수를 반환합니다.
+                먼저 등록한 hook이 가장 안쪽에서 감싸집니다.
+
+        Note:
+            hook은 batch 단위로 호출되므로, 결과를 cache에서 바로 돌려주거나
+            batch를 나누어 여러 worker에 보내는 등의 기능을 구현할 수 있습니다.
+        """
+
+        assert stage in STAGES, f"stage는 {STAGES} 중 하나여야 합니다."
+        self._hooks[stage].append(hook)
+
+    def _run(self, stage: str, fn: Callable, *args, **kwargs):
+        for hook in self._hooks[stage]:
+            fn = hook(fn)
+        with span(f"qa_pipeline.{stage}"):
+            return fn(*args, **kwargs)
+
+    # ------------------------------------------------------------------ tokenize
+    def tokenize(self, examples):
+        return self._run("tokenize", self._tokenize, examples)
+
+    def tokenize_validation(self, examples):
+        # validation window는 window_planner 설정에 따라 문장 경계에 맞춰 나눌 수 있습니다.
+        if self.data_args.window_planner not in WINDOW_PLANNERS:
+            raise ValueError(f"지원하지 않는 window_planner 입니다: {self.data_args.window_planner}")
+        if self.data_args.window_planner == "sentence":
+            return self._run("tokenize", self._plan_windows, examples)
+        return self.tokenize(examples)
+
+    def _tokenize(self, examples):
+        # truncation과 padding(length가 짧을때만)을 통해 toknization을 진행하며, stride를 이용하여 overflow를 유지합니다.
+        # 각 example들은 이전의 context와 조금씩 겹치게됩니다.
+        pad_on_right = self.pad_on_right
+        return self.tokenizer(
+            examples[self.question_column_name if pad_on_right else self.context_column_name],
+            examples[self.context_column_name if pad_on_right else self.question_column_name],
+            truncation="only_second" if pad_on_right else "only_first",
+            max_length=self.max_seq_length,
+            stride=self.data_args.doc_stride,
+            return_overflowing_tokens=True,
+            return_offsets_mapping=True,
+            return_token_type_ids=self.return_token_type_ids,
+            padding="max_length" if self.data_args.pad_to_max_length else False,
+        )
+
+    def _plan_windows(self, examples):
+        return plan_validation_windows(
+            self.tokenizer,
+            examples[self.question_column_name],
+            examples[self.context_column_name],
+            self.max_seq_length,
+            self.data_args.doc_stride,
+            pad_on_right=self.pad_on_right,
+            return_token_type_ids=self.return_token_type_ids,
+            padding="max_length" if self.data_args.pad_to_max_length else False,
+        )
+
+    # ------------------------------------------------------------------- windows
+    def prepare_train_features(self, examples):
+        tokenized_examples = self.tokenize(examples)
+        return self._run("windows", self._train_windows, examples, tokenized_examples)
+
+    def prepare_validation_features(self, examples):
+        tokenized_examples = self.tokenize_validation(examples)
+        return self._run(
+            "windows", self._validation_windows, examples, tokenized_examples
+        )
+
+    def _train_windows(self, examples, tokenized_examples):
+        pad_on_right = self.pad_on_right
+
+        # 길이가 긴 context가 등장할 경우 truncate를 진행해야하므로, 해당 데이터셋을 찾을 수 있도록 mapping 가능한 값이 필요합니다.
+        sample_mapping = tokenized_examples.pop("overflow_to_sample_mapping")
+        # token의 캐릭터 단위 position를 찾을 수 있도록 offset mapping을 사용합니다.
+        # start_positions과 end_positions을 찾는데 도움을 줄 수 있습니다.
+        offset_mapping = tokenized_examples.pop("offset_mapping")
+
+        # 데이터셋에 "start position", "enc position" label을 부여합니다.
+        tokenized_examples["start_positions"] = []
+        tokenized_examples["end_positions"] = []
+
+        for i, offsets in enumerate(offset_mapping):
+            input_ids = tokenized_examples["input_ids"][i]
+            cls_index = input_ids.index(self.tokenizer.cls_token_id)  # cls index
+
+            # sequence id를 설정합니다 (to know what is the context and what is the question).
+            sequence_ids = tokenized_examples.sequence_ids(i)
+
+            # 하나의 example이 여러개의 span을 가질 수 있습니다.
+            sample_index = sample_mapping[i]
+            answers = examples[self.answer_column_name][sample_index]
+
+            # answer가 없을 경우 cls_index를 answer로 설정합니다(== example에서 정답이 없는 경우 존재할 수 있음).
+            if len(answers["answer_start"]) == 0:
+                tokenized_examples["start_positions"].append(cls_index)
+                tokenized_examples["end_positions"].append(cls_index)
+            else:
+                # text에서 정답의 Start/end character index
+                start_char = answers["answer_start"][0]
+                end_char = start_char + len(answers["text"][0])
+
+                # text에서 current span의 Start token index
+                token_start_index = 0
+                while sequence_ids[token_start_index] != (1 if pad_on_right else 0):
+                    token_start_index += 1
+
+                # text에서 current span의 End token index
+                token_end_index = len(input_ids) - 1
+                while sequence_ids[token_end_index] != (1 if pad_on_right else 0):
+                    token_end_index -= 1
+
+                # 정답이 span을 벗어났는지 확인합니다(정답이 없는 경우 CLS index로 label되어있음).
+                if not (
+                    offsets[token_start_index][0] <= start_char
+                    and offsets[token_end_index][1] >= end_char
+                ):
+                    tokenized_examples["start_positions"].append(cls_index)
+                    tokenized_examples["end_positions"].append(cls_index)
+                else:
+                    # token_start_index 및 token_end_index를 answer의 끝으로 이동합니다.
+                    # Note: answer가 마지막 단어인 경우 last offset을 따라갈 수 있습니다(edge case).
+                    while (
+                        token_start_index < len(offsets)
+                        and offsets[token_start_index][0] <= start_char
+                    ):
+                        token_start_index += 1
+                    tokenized_examples["start_positions"].append(token_start_index - 1)
+                    while offsets[token_end_index][1] >= end_char:
+                        token_end_index -= 1
+                    tokenized_examples["end_positions"].append(token_end_index + 1)
+        return tokenized_examples
+
+    def _validation_windows(self, examples, tokenized_examples):
+        # 길이가 긴 context가 등장할 경우 truncate를 진행해야하므로, 해당 데이터셋을 찾을 수 있도록 mapping 가능한 값이 필요합니다.
+        sample_mapping = tokenized_examples.pop("overflow_to_sample_mapping")
+
+        # evaluation을 위해, prediction을 context의 substring으로 변환해야합니다.
+        # corresponding example_id를 유지하고 offset mappings을 저장해야합니다.
+        tokenized_examples["example_id"] = []
+        tokenized_examples["context_mask"] = []
+        context_index = 1 if self.pad_on_right else 0
+
+        for i in range(len(tokenized_examples["input_ids"])):
+            # sequence id를 설정합니다 (to know what is the context and what is the question).
+            sequence_ids = tokenized_examples.sequence_ids(i)
+
+            # 하나의 example이 여러개의 span을 가질 수 있습니다.
+            sample_index = sample_mapping[i]
+            tokenized_examples["example_id"].append(examples["id"][sample_index])
+
+            # context에 속하는 token 위치를 boolean mask로 한 번에 계산하고, context가 아닌 offset은 -1로 채웁니다.
+            # (None이 섞인 nested list보다 Arrow에 쓰고 읽는 비용이 훨씬 적습니다.)
+            context_mask = np.array(sequence_ids, dtype=object) == context_index
+            offsets = np.asarray(tokenized_examples["offset_mapping"][i], dtype=np.int32)
+            offsets[~context_mask] = -1
+            tokenized_examples["offset_mapping"][i] = offsets
+            tokenized_examples["context_mask"].append(context_mask)
+        return tokenized_examples
+
+    def train_features(self, dataset: Dataset) -> Dataset:
+        # dataset에서 train feature를 생성합니다.
+        return dataset.map(
+            self.prepare_train_features,
+            batched=True,
+            num_proc=self.data_args.preprocessing_num_workers,
+            remove_columns=dataset.column_names,
+            load_from_cache_file=not self.data_args.overwrite_cache,
+        )
+
+    def validation_features(self, dataset: Dataset) -> Dataset:
+        # Validation Feature 생성
+        return dataset.map(
+            self.prepare_validation_features,
+            batched=True,
+            num_proc=self.data_args.preprocessing_num_workers,
+            remove_columns=dataset.column_names,
+            load_from_cache_file=not self.data_args.overwrite_cache,
+            features=validation_features_schema(
+                with_token_type_ids=self.return_token_type_ids
+            ),
+        )
+
+    # ------------------------------------------------------------------- predict
+    def predict(self, model, features, batch_size: int = 32) -> Tuple[np.ndarray, np.ndarray]:
+
+        """
+        Arguments:
+            model:
+                start/end logits을 (tuple 혹은 ModelOutput의) 첫 두 값으로 반환하는 QA 모델입니다.
+            features:
+                `prepare_validation_features`의 결과 (Dataset 혹은 dict 형태의 batch)
+            batch_size (int):
+                한 번의 forward에 넣을 feature 수입니다.
+
+        Returns:
+            (start_logits, end_logits): feature 수 x 최대 길이의 array.
+            Trainer와 동일하게 길이가 짧은 feature는 -100으로 padding 됩니다.
+
+        Note:
+            Trainer 없이 모델을 직접 실행해야 하는 serving 등의 경로에서 사용합니다.
+        """
+
+        return self._run("predict", self._predict, model, features, batch_size)
+
+    def _predict(self, model, features, batch_size: int = 32):
+        input_names = [
+            k for k in self.tokenizer.model_input_names if k in _column_names(features)
+        ]
+        num_features = len(features["input_ids"])
+        device = _model_device(model)
+        METRICS.count("reader.features", num_features)
+
+        start_logits, end_logits = [], []
+        if hasattr(model, "eval"):
+            model.eval()
+        with torch.no_grad():
+            for i in range(0, num_features, batch_size):
+                batch = self.tokenizer.pad(
+                    {k: features[k][i : i + batch_size] for k in input_names},
+                    return_tensors="pt",
+                )
+                with span("reader.forward"):
+                    outputs = model(**{k: v.to(device) for k, v in batch.items()})
+                    start_logits.extend(outputs[0].float().cpu().numpy())
+                    end_logits.extend(outputs[1].float().cpu().numpy())
+
+        return _pad_logits(start_logits), _pad_logits(end_logits)
+
+    # --------------------------------------------------------------- postprocess
+    def postprocess(self, examples, features, predictions, output_dir: Optional[str] = None, **kwargs):
+        # Post-processing: start logits과 end logits을 original context의 정답과 match시킵니다.
+        # postprocess hook도 같은 형식으로 저장하도록 nbest_format을 kwargs로 넘깁니다.
+        kwargs.setdefault("nbest_format", self.data_args.nbest_format)
+        return self._run(
+            "postprocess",
+            self._postprocess,
+            examples,
+            features,
+            predictions,
+            output_dir=output_dir,
+            **kwargs,
+        )
+
+    def _postprocess(self, examples, features, predictions, output_dir=None, **kwargs):
+        return postprocess_qa_predictions(
+            examples=examples,
+            features=features,
+            predictions=predictions,
+            max_answer_length=self.data_args.max_answer_length,
+            output_dir=output_dir,
+            **kwargs,
+        )
+
+    def post_processing_function(
+        self,
+        examples,
+        features,
+        predictions: Tuple[np.ndarray, np.ndarray],
+        training_args: TrainingArguments,
+    ):
+        '''
+        `QuestionAnsweringTrainer`의 post_process_function 입니다.
+        <<EXCUTION ONLY WHEN do_eval or do_predict>>
+
+        Dataset({
+            features: ['__index_level_0__', 'answers', 'context', 'document_id', 'id', 'question', 'title'],
+            num_rows: 240
+        })
+        Dataset({
+            features: ['attention_mask', 'context_mask', 'example_id', 'input_ids', 'offset_mapping'],
+            num_rows: 474
+        })
+        (array, array, dtype) -> array.shape : (features_num_rows, max_seq_length)
+        '''
+
+        predictions = self.postprocess(
+            examples, features, predictions, output_dir=training_args.output_dir
+        )
+        # Metric을 구할 수 있도록 Format을 맞춰줍니다.
+        formatted_predictions = [
+            {"id": k, "prediction_text": v} for k, v in predictions.items()
+        ]
+        if training_args.do_predict:
+            # formatted_predictions : [{'id': 'mrc-0-003264', 'prediction_text': '각하 견해를 내었다. 소수의'}, ...]
+            return formatted_predictions
+
+        elif training_args.do_eval:
+            # references : [{'id': 'mrc-0-003264', 'answers': {'answer_start': [284], 'text': ['한보철강']}}, ...]
+            references = [
+                {"id": id_, "answers": answers}
+                for id_, answers in zip(
+                    examples["id"], examples[self.answer_column_name]
+                )
+            ]
+            return EvalPrediction(
+                predictions=formatted_predictions, label_ids=references
+            )
+
+    def compute_metrics(self, p: EvalPrediction) -> Dict:
+        # Exact Match, F1
+        if self._metric is None:
+            self._metric = load_metric("squad")
+        return self._metric.compute(predictions=p.predictions, references=p.label_ids)
+
+
+def _pad_logits(rows: List[np.ndarray], padding_index: float = -100.0) -> np.ndarray:
+    # batch마다 길이가 다른 logits을 Trainer와 같은 방식(-100 padding)으로 하나의 array로 합칩니다.
+    max_length = max((len(row) for row in rows), default=0)
+    padded = np.full((len(rows), max_length), padding_index, dtype=np.float32)
+    for i, row in enumerate(rows):
+        padded[i, : len(row)] = row
+    return padded
@@ -0,0 +1,251 @@
+"""
+CPU inference를 위한 reader 양자화 / export 코드 입니다.
+
+    - dynamic int8 quantization: nn.Linear의 weight를 int8로 바꾸고 activation은 실행 중에 양자화합니다.
+    - TorchScript / ONNX export: sequence 길이와 batch 크기가 바뀌어도 실행되는 graph로 저장합니다.
+
+tokenizer와 후처리는 바뀌지 않으며, QAPipeline.predict에 그대로 넘겨 사용할 수 있습니다.
+train.py의 conv head 모델(model.Model)도 inference.load_reader로 불러와 같은 방법으로 export합니다.
+
+fp32 대비 EM/F1 변화와 처리량 비교 (validation의 정답 context 사용):
+    python quantization.py --model_name_or_path ./models/train_dataset --export torchscript --num_threads 4
+"""
+
+
+import os
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn as nn
+from qa_pipeline import uses_token_type_ids
+
+
+def quantize_dynamic(model: nn.Module) -> nn.Module:
+    # CPU에서만 실행할 수 있으므로 먼저 CPU로 옮깁니다.
+    model = model.to("cpu").eval()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def reader_input_names(config) -> List[str]:
+    names = ["input_ids", "attention_mask"]
+    if uses_token_type_ids(config):
+        names.append("token_type_ids")
+    return names
+
+
+class _TupleOutput(nn.Module):
+    # trace/export가 가능하도록 keyword argument와 ModelOutput 대신 위치 인자와 tuple을 사용합니다.
+    def __init__(self, model: nn.Module, input_names: List[str]):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        outputs = self.model(**dict(zip(self.input_names, inputs)), return_dict=False)
+        return outputs[0], outputs[1]
+
+
+def _example_inputs(tokenizer, input_names: List[str], max_seq_length: int):
+    encoded = tokenizer(
+        ["질문"] * 2,
+        ["문맥 " * max_seq_length] * 2,
+        truncation="only_second",
+        max_length=max_seq_length,
+        padding="max_length",
+        return_tensors="pt",
+    )
+    return tuple(encoded[name] for name in input_names)
+
+
+def export_torchscript(model: nn.Module, tokenizer, path: str, max_seq_length: int = 384) -> str:
+    input_names = reader_input_names(model.config)
+    wrapper = _TupleOutput(model.to("cpu").eval(), input_names)
+    with torch.no_grad():
+        traced = torch.jit.trace(
+            wrapper, _example_inputs(tokenizer, input_names, max_seq_length), strict=False
+        )
+    traced = torch.jit.freeze(traced.eval())
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    torch.jit.save(traced, path)
+    return path
+
+
+def export_onnx(model: nn.Module, tokenizer, path: str, max_seq_length: int = 384) -> str:
+    # dynamic int8 모델은 ONNX로 내보낼 수 없으므로 fp32 모델을 내보낸 뒤
+    # 필요하면 onnxruntime.quantization.quantize_dynamic으로 양자화하세요.
+    input_names = reader_input_names(model.config)
+    wrapper = _TupleOutput(model.to("cpu").eval(), input_names)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes.update({"start_logits": {0: "batch", 1: "sequence"}, "end_logits": {0: "batch", 1: "sequence"}})
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    torch.onnx.export(
+        wrapper,
+        _example_inputs(tokenizer, input_names, max_seq_length),
+        path,
+        input_names=input_names,
+        output_names=["start_logits", "end_logits"],
+        dynamic_axes=dynamic_axes,
+        opset_version=13,
+    )
+    return path
+
+
+def max_logit_diff(model: nn.Module, reader, tokenizer, seq_lengths: List[int]) -> Dict[int, float]:
+    # trace에 사용한 길이와 다른 길이도 넣어 export된 graph의 sequence 축이 고정되지 않았는지 확인합니다.
+    input_names = reader_input_names(model.config)
+    model = model.to("cpu").eval()
+    diffs = {}
+    for seq_length in seq_lengths:
+        inputs = dict(zip(input_names, _example_inputs(tokenizer, input_names, seq_length)))
+        with torch.no_grad():
+            expected = model(**inputs, return_dict=False)[:2]
+            actual = reader(**inputs)
+        diffs[seq_length] = max(
+            (e - a).abs().max().item() for e, a in zip(expected, actual)
+        )
+    return diffs
+
+
+class ExportedReader:
+    def __init__(self, path: str, config, num_threads: Optional[int] = None):
+
+        """
+        Arguments:
+            path (str):
+                `export_torchscript`(.pt) 혹은 `export_onnx`(.onnx)로 저장한 파일입니다.
+            config:
+                원래 모델의 config 입니다. 입력 이름과 token_type_ids 사용 여부를 정하는 데 사용합니다.
+            num_threads (Optional[int]):
+                ONNX Runtime의 intra-op thread 수입니다. TorchScript는 torch.set_num_threads를 따릅니다.
+
+        Summary:
+            QAPipeline.predict에서 HF 모델처럼 `model(**inputs)`로 호출할 수 있도록 감싼 CPU reader 입니다.
+        """
+
+        self.config = config
+        self.input_names = reader_input_names(config)
+        self.is_onnx = path.endswith(".onnx")
+        if self.is_onnx:
+            # onnxruntime은 ONNX 모델을 사용할 때만 필요합니다.
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(
+                path, options, providers=["CPUExecutionProvider"]
+            )
+        else:
+            self.module = torch.jit.load(path, map_location="cpu").eval()
+
+    def __call__(self, **inputs):
+        if self.is_onnx:
+            start_logits, end_logits = self.session.run(
+                None, {name: inputs[name].cpu().numpy() for name in self.input_names}
+            )
+            return torch.from_numpy(start_logits), torch.from_numpy(end_logits)
+        return self.module(*[inputs[name].cpu() for name in self.input_names])
+
+    def to(self, device) -> "ExportedReader":
+        # export된 graph는 CPU에서만 실행합니다.
+        return self
+
+    def eval(self) -> "ExportedReader":
+        return self
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import time
+
+    from arguments import DataTrainingArguments, ModelArguments
+    from datasets import load_from_disk
+    from inference import load_reader
+    from qa_pipeline import QAPipeline
+    from transformers import EvalPrediction
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("--model_name_or_path", type=str, required=True, help="")
+    parser.add_argument(
+        "--dataset_name", default="../data/train_dataset", type=str, help=""
+    )
+    parser.add_argument(
+        "--export", default="none", choices=["none", "torchscript", "onnx"], help=""
+    )
+    parser.add_argument("--export_dir", default="./models/exported", type=str, help="")
+    parser.add_argument("--num_threads", default=None, type=int, help="")
+    parser.add_argument("--max_questions", default=None, type=int, help="")
+    parser.add_argument("--batch_size", default=32, type=int, help="")
+
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    tokenizer, model = load_reader(ModelArguments(model_name_or_path=args.model_name_or_path))
+    model.to("cpu").eval()
+
+    data_args = DataTrainingArguments()
+    pipeline = QAPipeline(
+        tokenizer,
+        data_args,
+        min(data_args.max_seq_length, tokenizer.model_max_length),
+        ["id", "question", "context", "answers"],
+        return_token_type_ids=uses_token_type_ids(model.config),
+    )
+
+    validation = load_from_disk(args.dataset_name)["validation"]
+    if args.max_questions is not None:
+        validation = validation.select(range(min(args.max_questions, len(validation))))
+    examples = validation[:]
+    # 모든 reader가 같은 feature를 사용하므로 tokenize는 한 번만 합니다.
+    features = pipeline.prepare_validation_features(examples)
+    num_features = len(features["input_ids"])
+
+    def evaluate(reader) -> dict:
+        t0 = time.perf_counter()
+        predictions = pipeline.predict(reader, features, batch_size=args.batch_size)
+        elapsed = time.perf_counter() - t0
+        all_predictions = pipeline.postprocess(examples, features, predictions)
+        metrics = pipeline.compute_metrics(
+            EvalPrediction(
+                predictions=[{"id": k, "prediction_text": v} for k, v in all_predictions.items()],
+                label_ids=[
+                    {"id": id_, "answers": answers}
+                    for id_, answers in zip(examples["id"], examples["answers"])
+                ],
+            )
+        )
+        metrics["features_per_sec"] = round(num_features / elapsed, 2)
+        return metrics
+
+    readers = {"fp32": model}
+    if args.export == "torchscript":
+        path = export_torchscript(
+            model, tokenizer, os.path.join(args.export_dir, "reader.pt"), pipeline.max_seq_length
+        )
+        readers["torchscript"] = ExportedReader(path, model.config)
+    elif args.export == "onnx":
+        path = export_onnx(
+            model, tokenizer, os.path.join(args.export_dir, "reader.onnx"), pipeline.max_seq_length
+        )
+        readers["onnx"] = ExportedReader(path, model.config, num_threads=args.num_threads)
+    for name in ("torchscript", "onnx"):
+        if name in readers:
+            diffs = max_logit_diff(
+                model, readers[name], tokenizer, [pipeline.max_seq_length // 2, pipeline.max_seq_length]
+            )
+            print(f"[{name}] max |logit diff| vs fp32 by seq_length: {diffs}")
+    # quantize_dynamic은 새 모델을 만들므로 export가 끝난 뒤에 수행합니다.
+    readers["dynamic_int8"] = quantize_dynamic(model)
+
+    results = {name: evaluate(reader) for name, reader in readers.items()}
+    base = results["fp32"]
+    print(f"{num_features} features, torch threads {torch.get_num_threads()}")
+    for name, metrics in results.items():
+        print(
+            f"[{name}] EM {metrics['exact_match']:.2f} ({metrics['exact_match'] - base['exact_match']:+.2f}) "
+            f"F1 {metrics['f1']:.2f} ({metrics['f1'] - base['f1']:+.2f}) "
+            f"{metrics['features_per_sec']} features/s "
+            f"({metrics['features_per_sec'] / base['features_per_sec']:.2f}x)"
+        )
@@ -0,0 +1,56 @@
+"""
+같은 tokenizer를 쓰는 여러 reader의 start/end logits을 가중 평균하는 logit-level 앙상블 입니다.
+
+retrieval, tokenize, feature 생성은 한 번만 하고 feature batch마다 모든 reader를 실행한 뒤
+평균 logits으로 postprocess_qa_predictions를 한 번만 수행합니다.
+Trainer, QAPipeline.predict 모두 하나의 QA 모델처럼 사용할 수 있습니다.
+
+    python inference.py --output_dir ./outputs/test_dataset/ --dataset_name ../data/test_dataset/ \
+        --model_name_or_path ./models/a --ensemble_model_names ./models/b ./models/c --ensemble_weights 1.0 0.5 0.5 --do_predict
+"""
+
+
+from typing import List, Optional, Sequence
+
+import torch.nn as nn
+from qa_pipeline import uses_token_type_ids
+
+
+class EnsembleReader(nn.Module):
+    def __init__(self, models: Sequence[nn.Module], weights: Optional[Sequence[float]] = None):
+
+        """
+        Arguments:
+            models:
+                start/end logits을 첫 두 값으로 반환하는 QA 모델들입니다. 모두 같은 tokenizer로 학습되어야 합니다.
+            weights:
+                모델별 가중치입니다. None이면 모두 같은 가중치를 사용하며, 합이 1이 되도록 정규화합니다.
+
+        Note:
+            config는 첫 번째 모델의 것을 사용합니다.
+            token_type_ids는 type_vocab_size가 1보다 큰 모델에만 넘깁니다.
+        """
+
+        super().__init__()
+        weights = [1.0] * len(models) if not weights else list(weights)
+        assert len(weights) == len(models), "ensemble 모델 수와 weight 수가 같아야 합니다."
+        total = sum(weights)
+        self.models = nn.ModuleList(models)
+        self.weights: List[float] = [weight / total for weight in weights]
+        self.config = models[0].config
+        self._uses_token_type_ids = [uses_token_type_ids(model.config) for model in models]
+
+    def forward(self, input_ids=None, attention_mask=None, token_type_ids=None):
+        # Trainer가 signature로 입력 column을 고르므로 **kwargs 대신 입력 이름을 명시합니다.
+        start_logits, end_logits = None, None
+        for model, weight, use_token_type_ids in zip(
+            self.models, self.weights, self._uses_token_type_ids
+        ):
+            inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if use_token_type_ids and token_type_ids is not None:
+                inputs["token_type_ids"] = token_type_ids
+            outputs = model(**inputs)
+            start, end = outputs[0].float() * weight, outputs[1].float() * weight
+            start_logits = start if start_logits is None else start_logits + start
+            end_logits = end if end_logits is None else end_logits + end
+        return start_logits, end_logits
@@ -0,0 +1,238 @@
+"""
+retrieval로 가져온 top-N passage를 cross-encoder로 다시 점수 매겨 top-k'만 reader에 넘기는 reranking 코드 입니다.
+
+reader는 이어붙인 context 길이에 비례해 feature를 만들기 때문에,
+passage 수를 줄이면 reader의 연산량이 그만큼 줄어듭니다.
+
+reranking 전/후의 reader feature 수와 EM/F1 비교:
+    python rerank.py --model_name_or_path ./models/train_dataset --rerank_model_name <cross-encoder> \
+        --dataset_name ../data/train_dataset --candidates 50 --topk 3
+"""
+
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+
+class CrossEncoderReranker:
+    def __init__(
+        self,
+        model_name_or_path: str,
+        batch_size: int = 32,
+        max_length: int = 384,
+        chunk_size: int = 10,
+        margin: Optional[float] = None,
+        device: Optional[str] = None,
+    ):
+
+        """
+        Arguments:
+            model_name_or_path:
+                (question, passage) 쌍을 입력받는 sequence classification 모델입니다.
+                label이 하나이면 그 logit을, 여러 개이면 마지막 label(관련 있음)의 logit을 score로 사용합니다.
+            batch_size:
+                한 번의 forward에 넣을 (question, passage) 쌍의 수입니다.
+            chunk_size:
+                한 번에 score를 매길 후보 수입니다. retrieval 순위가 높은 후보부터 chunk_size개씩 처리합니다.
+            margin:
+                None이 아니면, 지금까지 가장 높은 score가 나머지 후보보다 margin 이상 높은 question은
+                남은 후보를 더 보지 않고(early termination), 최고 score에서 margin 이상 낮은 후보는 버립니다(pruning).
+        """
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=True)
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = AutoModelForSequenceClassification.from_pretrained(
+            model_name_or_path
+        ).to(self.device)
+        self.model.eval()
+
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.chunk_size = chunk_size
+        self.margin = margin
+
+    @torch.no_grad()
+    def score(self, questions: List[str], passages: List[str]) -> np.ndarray:
+        # 길이가 비슷한 쌍끼리 batch를 만들어 padding을 줄입니다.
+        order = np.argsort([len(p) for p in passages])
+        scores = np.empty(len(passages), dtype=np.float32)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            inputs = self.tokenizer(
+                [questions[i] for i in batch],
+                [passages[i] for i in batch],
+                truncation="only_second",
+                max_length=self.max_length,
+                padding=True,
+                return_tensors="pt",
+            ).to(self.device)
+            logits = self.model(**inputs)[0]
+            scores[batch] = logits[:, -1].float().cpu().numpy()
+        return scores
+
+    def rerank(
+        self,
+        questions: List[str],
+        doc_indices: List[List[int]],
+        get_context: Callable[[int], str],
+        topk: int,
+    ) -> Tuple[List[List[float]], List[List[int]], Dict[str, int]]:
+
+        """
+        Arguments:
+            questions: question 목록
+            doc_indices: question마다 retrieval 순위대로 정렬된 후보 passage id
+            get_context: passage id -> passage text
+            topk: question마다 남길 최대 passage 수
+
+        Returns:
+            (scores, indices, stats): question마다 cross-encoder score 순으로 정렬된 top-k' 결과와,
+            후보 수(candidates)와 실제로 score를 매긴 수(scored), 남긴 수(kept)
+        """
+
+        scored = [{} for _ in questions]
+        active = list(range(len(questions)))
+        num_candidates = max((len(indices) for indices in doc_indices), default=0)
+
+        for start in range(0, num_candidates, self.chunk_size):
+            # 아직 끝나지 않은 모든 question의 다음 chunk를 한 번에 batch로 처리합니다.
+            pairs = [
+                (qid, pid)
+                for qid in active
+                for pid in doc_indices[qid][start : start + self.chunk_size]
+                if pid >= 0
+            ]
+            if not pairs:
+                break
+            scores = self.score(
+                [questions[qid] for qid, _ in pairs],
+                [get_context(pid) for _, pid in pairs],
+            )
+            for (qid, pid), s in zip(pairs, scores):
+                scored[qid][pid] = float(s)
+
+            if self.margin is not None:
+                active = [qid for qid in active if not self._confident(scored[qid])]
+
+        all_scores, all_indices = [], []
+        for candidates in scored:
+            ranked = sorted(candidates.items(), key=lambda x: x[1], reverse=True)[:topk]
+            if self.margin is not None and ranked:
+                ranked = [(pid, s) for pid, s in ranked if s >= ranked[0][1] - self.margin]
+            all_scores.append([s for _, s in ranked])
+            all_indices.append([pid for pid, _ in ranked])
+
+        stats = {
+            "candidates": sum(sum(pid >= 0 for pid in indices) for indices in doc_indices),
+            "scored": sum(len(candidates) for candidates in scored),
+            "kept": sum(len(indices) for indices in all_indices),
+        }
+        return all_scores, all_indices, stats
+
+    def _confident(self, candidates: Dict[int, float]) -> bool:
+        if len(candidates) < 2:
+            return False
+        top = sorted(candidates.values(), reverse=True)
+        return top[0] - top[1] >= self.margin
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    from arguments import DataTrainingArguments, ModelArguments
+    from datasets import load_from_disk
+    from inference import load_reader
+    from qa_pipeline import QAPipeline, uses_token_type_ids
+    from retrieval import SparseRetrieval
+    from transformers import EvalPrediction
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("--model_name_or_path", type=str, required=True, help="")
+    parser.add_argument("--rerank_model_name", type=str, required=True, help="")
+    parser.add_argument(
+        "--dataset_name", default="../data/train_dataset", type=str, help=""
+    )
+    parser.add_argument("--data_path", default="../data", type=str, help="")
+    parser.add_argument(
+        "--context_path", default="wikipedia_documents.json", type=str, help=""
+    )
+    parser.add_argument("--candidates", default=50, type=int, help="")
+    parser.add_argument("--topk", default=3, type=int, help="")
+    parser.add_argument("--baseline_topk", default=10, type=int, help="")
+    parser.add_argument("--margin", default=None, type=float, help="")
+
+    args = parser.parse_args()
+
+    tokenizer, model = load_reader(ModelArguments(model_name_or_path=args.model_name_or_path))
+    model.to("cuda" if torch.cuda.is_available() else "cpu")
+    model.eval()
+
+    data_args = DataTrainingArguments()
+    pipeline = QAPipeline(
+        tokenizer,
+        data_args,
+        min(data_args.max_seq_length, tokenizer.model_max_length),
+        ["id", "question", "context", "answers"],
+        return_token_type_ids=uses_token_type_ids(model.config),
+    )
+
+    validation = load_from_disk(args.dataset_name)["validation"]
+    retriever = SparseRetrieval(
+        tokenize_fn=tokenizer.tokenize,
+        data_path=args.data_path,
+        context_path=args.context_path,
+    )
+    retriever.get_sparse_embedding()
+    _, doc_indices = retriever.get_relevant_doc_bulk(
+        validation["question"], k=max(args.candidates, args.baseline_topk)
+    )
+
+    reranker = CrossEncoderReranker(args.rerank_model_name, margin=args.margin)
+    _, reranked, rerank_stats = reranker.rerank(
+        validation["question"],
+        [indices[: args.candidates] for indices in doc_indices],
+        lambda pid: retriever.contexts[pid],
+        topk=args.topk,
+    )
+
+    def evaluate(indices_per_question: List[List[int]]) -> Dict:
+        examples = {
+            "id": validation["id"],
+            "question": validation["question"],
+            "context": [
+                " ".join(retriever.contexts[pid] for pid in indices)
+                for indices in indices_per_question
+            ],
+            "answers": validation["answers"],
+        }
+        features = pipeline.prepare_validation_features(examples)
+        predictions = pipeline.predict(model, features)
+        all_predictions = pipeline.postprocess(examples, features, predictions)
+        metrics = pipeline.compute_metrics(
+            EvalPrediction(
+                predictions=[
+                    {"id": k, "prediction_text": v} for k, v in all_predictions.items()
+                ],
+                label_ids=[
+                    {"id": id_, "answers": answers}
+                    for id_, answers in zip(examples["id"], examples["answers"])
+                ],
+            )
+        )
+        metrics["reader_features"] = len(features["input_ids"])
+        return metrics
+
+    baseline = evaluate([indices[: args.baseline_topk] for indices in doc_indices])
+    reranked_metrics = evaluate(reranked)
+
+    print(f"[retrieve top-{args.baseline_topk}]", baseline)
+    print(f"[retrieve top-{args.candidates} -> rerank top-{args.topk}]", reranked_metrics)
+    print("rerank", rerank_stats)
+    print(
+        "reader compute saved: "
+        f"{1 - reranked_metrics['reader_features'] / baseline['reader_features']:.1%}"
+    )
@@ -1,3 +1,5 @@
+import concurrent.futures
+import hashlib
 import json
 import os
 import pickle
@@ -8,35 +10,62 @@ from typing import List, NoReturn, Optional, Tuple, Union
 import faiss
 import numpy as np
 import pandas as pd
+import torch
 from datasets import Dataset, concatenate_datasets, load_from_disk
 from sklearn.feature_extraction.text import TfidfVectorizer
 from tqdm.auto import tqdm
+from transformers import AutoConfig, AutoModel, AutoTokenizer
+
+from cache import LRUCache
+from instrumentation import METRICS, span
 
 
 @contextmanager
 def timer(name):
+    # 사람이 보는 실행(예: __main__)을 위한 timer 입니다. 시간은 instrumentation에도 기록됩니다.
     t0 = time.time()
-    yield
+    with span(name):
+        yield
     print(f"[{name}] done in {time.time() - t0:.3f} s")
 
 
-class SparseRetrieval:
+def normalize_query(query: str) -> str:
+    # TfidfVectorizer는 소문자로 바꾼 뒤 tokenize 하므로, 공백이나 대소문자만 다른 query는 같은 결과를 냅니다.
+    return " ".join(query.lower().split())
+
+
+def _index_version(*paths: str) -> str:
+    # embedding 파일이 다시 만들어지면 크기나 수정 시각이 바뀌므로 이를 index의 version으로 사용합니다.
+    digest = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(
+            f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+        )
+    return digest.hexdigest()[:16]
+
+
+def load_contexts(data_path: str, context_path: str) -> List[str]:
+    with open(os.path.join(data_path, context_path), "r", encoding="utf-8") as f:
+        wiki = json.load(f)
+    # set 은 매번 순서가 바뀌므로 dict로 순서를 유지하며 중복을 제거합니다.
+    return list(dict.fromkeys([v["text"] for v in wiki.values()]))
+
+
+class BaseRetrieval:
+    # 하위 class에서 지정합니다. retrieve의 progress bar와 assertion 메시지에 사용합니다.
+    name: str  # 예: "Sparse"
+    embedding_method: str  # embedding을 만들거나 불러오는 메소드 이름
+
     def __init__(
         self,
-        tokenize_fn,
         data_path: Optional[str] = "../data/",
         context_path: Optional[str] = "wikipedia_documents.json",
+        cache: Optional[LRUCache] = None,
     ) -> NoReturn:
 
         """
         Arguments:
-            tokenize_fn:
-                기본 text를 tokenize해주는 함수입니다.
-                아래와 같은 함수들을 사용할 수 있습니다.
-                - lambda x: x.split(' ')
-                - Huggingface Tokenizer
-                - konlpy.tag의 Mecab
-
             data_path:
                 데이터가 보관되어 있는 경로입니다.
 
@@ -45,28 +74,279 @@ class SparseRetrieval:
 
             data_path/context_path가 존재해야합니다.
 
+            cache:
+                주어지면 (정규화된 query, topk, index version)을 key로 검색 결과를 재사용합니다.
+                embedding이 다시 만들어지면 version이 바뀌어 이전 결과는 자동으로 버려집니다.
+
         Summary:
-            Passage 파일을 불러오고 TfidfVectorizer를 선언하는 기능을 합니다.
+            SparseRetrieval, DenseRetrieval이 공유하는 passage 목록, 검색 결과 cache와 `retrieve` interface 입니다.
+            하위 class는 embedding 생성, `build_faiss`와 `_get_relevant_doc*` 메소드를 구현합니다.
         """
 
         self.data_path = data_path
-        with open(os.path.join(data_path, context_path), "r", encoding="utf-8") as f:
-            wiki = json.load(f)
-
-        self.contexts = list(
-            dict.fromkeys([v["text"] for v in wiki.values()])
-        )  # set 은 매번 순서가 바뀌므로
+        self.contexts = load_contexts(data_path, context_path)
         print(f"Lengths of unique contexts : {len(self.contexts)}")
         self.ids = list(range(len(self.contexts)))
 
+        self.p_embedding = None  # 하위 class의 embedding 메소드로 생성합니다.
+        self.indexer = None  # build_faiss()로 생성합니다.
+
+        self.cache = cache
+        self.index_version = None  # embedding을 만들거나 불러올 때 설정합니다.
+        self.faiss_name = None  # build_faiss()에서 설정합니다.
+
+    def _set_index_version(self, index_version: str) -> NoReturn:
+        self.index_version = index_version
+        if self.cache is not None:
+            self.cache.load()
+            self.cache.set_version(self.index_version)
+
+    def build_faiss(self, num_clusters=64) -> NoReturn:
+        raise NotImplementedError
+
+    def retrieve(
+        self, query_or_dataset: Union[str, Dataset], topk: Optional[int] = 1
+    ) -> Union[Tuple[List, List], pd.DataFrame]:
+
+        """
+        Arguments:
+            query_or_dataset (Union[str, Dataset]):
+                str이나 Dataset으로 이루어진 Query를 받습니다.
+                str 형태인 하나의 query만 받으면 `get_relevant_doc`을 통해 유사도를 구합니다.
+                Dataset 형태는 query를 포함한 HF.Dataset을 받습니다.
+                이 경우 `get_relevant_doc_bulk`를 통해 유사도를 구합니다.
+            topk (Optional[int], optional): Defaults to 1.
+                상위 몇 개의 passage를 사용할 것인지 지정합니다.
+
+        Returns:
+            1개의 Query를 받는 경우  -> Tuple(List, List)
+            다수의 Query를 받는 경우 -> pd.DataFrame: [description]
+
+        Note:
+            다수의 Query를 받는 경우,
+                Ground Truth가 있는 Query (train/valid) -> 기존 Ground Truth Passage를 같이 반환합니다.
+                Ground Truth가 없는 Query (test) -> Retrieval한 Passage만 반환합니다.
+        """
+
+        assert self.p_embedding is not None, f"{self.embedding_method}() 메소드를 먼저 수행해줘야합니다."
+        return self._retrieve(
+            query_or_dataset,
+            topk,
+            self.get_relevant_doc,
+            self.get_relevant_doc_bulk,
+            "query exhaustive search",
+        )
+
+    def retrieve_faiss(
+        self, query_or_dataset: Union[str, Dataset], topk: Optional[int] = 1
+    ) -> Union[Tuple[List, List], pd.DataFrame]:
+
+        """
+        Note:
+            retrieve와 같은 기능을 하지만 faiss.indexer를 사용합니다.
+        """
+
+        assert self.indexer is not None, "build_faiss()를 먼저 수행해주세요."
+        return self._retrieve(
+            query_or_dataset,
+            topk,
+            self.get_relevant_doc_faiss,
+            self.get_relevant_doc_bulk_faiss,
+            "query faiss search",
+        )
+
+    def _retrieve(self, query_or_dataset, topk: int, search, search_bulk, timer_name: str):
+        if isinstance(query_or_dataset, str):
+            doc_scores, doc_indices = search(query_or_dataset, k=topk)
+            print("[Search query]\n", query_or_dataset, "\n")
+
+            for i in range(topk):
+                print(f"Top-{i+1} passage with score {doc_scores[i]:4f}")
+                print(self.contexts[doc_indices[i]])
+
+            return (doc_scores, [self.contexts[doc_indices[i]] for i in range(topk)])
+
+        elif isinstance(query_or_dataset, Dataset):
+
+            # Retrieve한 Passage를 pd.DataFrame으로 반환합니다.
+            total = []
+            with timer(timer_name):
+                doc_scores, doc_indices = search_bulk(query_or_dataset["question"], k=topk)
+            for idx, example in enumerate(
+                tqdm(query_or_dataset, desc=f"{self.name} retrieval: ")
+            ):
+                tmp = {
+                    # Query와 해당 id를 반환합니다.
+                    "question": example["question"],
+                    "id": example["id"],
+                    # Retrieve한 Passage의 id, context를 반환합니다.
+                    "context_id": doc_indices[idx],
+                    "context": " ".join(
+                        [self.contexts[pid] for pid in doc_indices[idx]]
+                    ),
+                }
+                if "context" in example.keys() and "answers" in example.keys():
+                    # validation 데이터를 사용하면 ground_truth context와 answer도 반환합니다.
+                    tmp["original_context"] = example["context"]
+                    tmp["answers"] = example["answers"]
+                total.append(tmp)
+
+            return pd.DataFrame(total)
+
+    def _cache_key(self, method: str, query: str, k: int) -> Tuple:
+        return (method, normalize_query(query), k, self.index_version)
+
+    def _cached_bulk(self, method: str, compute, queries: List, k: int) -> Tuple[List, List]:
+
+        """
+        Summary:
+            cache에 없는 query만 모아서 한 번에 `compute`하고, 나머지는 cache에서 가져옵니다.
+            같은 batch 안에서 중복되는 query도 한 번만 계산합니다.
+        """
+
+        t0 = time.perf_counter()
+        keys = [self._cache_key(method, query, k) for query in queries]
+        results = [self.cache.get(key) for key in keys]
+        todo = {}
+        for key, query, result in zip(keys, queries, results):
+            if result is None and key not in todo:
+                todo[key] = query
+        num_hits = sum(result is not None for result in results)
+        hit_seconds = time.perf_counter() - t0
+
+        if todo:
+            t0 = time.perf_counter()
+            doc_scores, doc_indices = compute(list(todo.values()), k=k)
+            computed = dict(zip(todo.keys(), zip(doc_scores, doc_indices)))
+            for key, result in computed.items():
+                self.cache.put(key, result)
+            results = [
+                result if result is not None else computed[key]
+                for key, result in zip(keys, results)
+            ]
+            self.cache.record(
+                misses=len(queries) - num_hits,
+                miss_seconds=time.perf_counter() - t0,
+            )
+        self.cache.record(hits=num_hits, hit_seconds=hit_seconds)
+
+        return [list(r[0]) for r in results], [list(r[1]) for r in results]
+
+    def save_cache(self) -> NoReturn:
+        # cache에 path가 지정된 경우 다음 실행에서도 사용할 수 있도록 저장합니다.
+        if self.cache is not None:
+            self.cache.save()
+
+    def get_relevant_doc(self, query: str, k: Optional[int] = 1) -> Tuple[List, List]:
+
+        """
+        `_get_relevant_doc`의 결과를 cache가 있으면 재사용합니다.
+        """
+
+        if self.cache is None:
+            return self._get_relevant_doc(query, k=k)
+        return self.cache.get_or_compute(
+            self._cache_key("exhaustive", query, k),
+            lambda: self._get_relevant_doc(query, k=k),
+        )
+
+    def get_relevant_doc_bulk(
+        self, queries: List, k: Optional[int] = 1
+    ) -> Tuple[List, List]:
+
+        """
+        `_get_relevant_doc_bulk`의 결과를 cache가 있으면 query 단위로 재사용합니다.
+        """
+
+        if self.cache is None:
+            return self._get_relevant_doc_bulk(queries, k=k)
+        return self._cached_bulk("exhaustive", self._get_relevant_doc_bulk, queries, k)
+
+    def get_relevant_doc_faiss(
+        self, query: str, k: Optional[int] = 1
+    ) -> Tuple[List, List]:
+
+        """
+        `_get_relevant_doc_faiss`의 결과를 cache가 있으면 재사용합니다.
+        """
+
+        if self.cache is None:
+            return self._get_relevant_doc_faiss(query, k=k)
+        return self.cache.get_or_compute(
+            self._cache_key(self.faiss_name, query, k),
+            lambda: self._get_relevant_doc_faiss(query, k=k),
+        )
+
+    def get_relevant_doc_bulk_faiss(
+        self, queries: List, k: Optional[int] = 1
+    ) -> Tuple[List, List]:
+
+        """
+        `_get_relevant_doc_bulk_faiss`의 결과를 cache가 있으면 query 단위로 재사용합니다.
+        """
+
+        if self.cache is None:
+            return self._get_relevant_doc_bulk_faiss(queries, k=k)
+        return self._cached_bulk(
+            self.faiss_name, self._get_relevant_doc_bulk_faiss, queries, k
+        )
+
+    # 하나의 query는 기본적으로 bulk 검색을 그대로 사용합니다.
+    def _get_relevant_doc(self, query: str, k: Optional[int] = 1) -> Tuple[List, List]:
+        doc_scores, doc_indices = self._get_relevant_doc_bulk([query], k=k)
+        return doc_scores[0], doc_indices[0]
+
+    def _get_relevant_doc_faiss(
+        self, query: str, k: Optional[int] = 1
+    ) -> Tuple[List, List]:
+        doc_scores, doc_indices = self._get_relevant_doc_bulk_faiss([query], k=k)
+        return doc_scores[0], doc_indices[0]
+
+    def _get_relevant_doc_bulk(
+        self, queries: List, k: Optional[int] = 1
+    ) -> Tuple[List, List]:
+        raise NotImplementedError
+
+    def _get_relevant_doc_bulk_faiss(
+        self, queries: List, k: Optional[int] = 1
+    ) -> Tuple[List, List]:
+        raise NotImplementedError
+
+
+class SparseRetrieval(BaseRetrieval):
+    name = "Sparse"
+    embedding_method = "get_sparse_embedding"
+
+    def __init__(
+        self,
+        tokenize_fn,
+        data_path: Optional[str] = "../data/",
+        context_path: Optional[str] = "wikipedia_documents.json",
+        cache: Optional[LRUCache] = None,
+    ) -> NoReturn:
+
+        """
+        Arguments:
+            tokenize_fn:
+                기본 text를 tokenize해주는 함수입니다.
+                아래와 같은 함수들을 사용할 수 있습니다.
+                - lambda x: x.split(' ')
+                - Huggingface Tokenizer
+                - konlpy.tag의 Mecab
+
+            나머지 Arguments는 BaseRetrieval과 같습니다.
+
+        Summary:
+            Passage 파일을 불러오고 TfidfVectorizer를 선언하는 기능을 합니다.
+        """
+
+        super().__init__(data_path, context_path, cache)
+
         # Transform by vectorizer
         self.tfidfv = TfidfVectorizer(
             tokenizer=tokenize_fn, ngram_range=(1, 2), max_features=50000,
         )
 
-        self.p_embedding = None  # get_sparse_embedding()로 생성합니다
-        self.indexer = None  # build_faiss()로 생성합니다.
-
     def get_sparse_embedding(self) -> NoReturn:
 
         """
@@ -98,6 +378,8 @@ class SparseRetrieval:
                 pickle.dump(self.tfidfv, file)
             print("Embedding pickle saved.")
 
+        self._set_index_version(_index_version(emd_path, tfidfv_path))
+
     def build_faiss(self, num_clusters=64) -> NoReturn:
 
         """
@@ -116,6 +398,7 @@ class SparseRetrieval:
 
         indexer_name = f"faiss_clusters{num_clusters}.index"
         indexer_path = os.path.join(self.data_path, indexer_name)
+        self.faiss_name = indexer_name
         if os.path.isfile(indexer_path):
             print("Load Saved Faiss Indexer.")
             self.indexer = faiss.read_index(indexer_path)
@@ -135,73 +418,7 @@ class SparseRetrieval:
             faiss.write_index(self.indexer, indexer_path)
             print("Faiss Indexer Saved.")
 
-    def retrieve(
-        self, query_or_dataset: Union[str, Dataset], topk: Optional[int] = 1
-    ) -> Union[Tuple[List, List], pd.DataFrame]:
-
-        """
-        Arguments:
-            query_or_dataset (Union[str, Dataset]):
-                str이나 Dataset으로 이루어진 Query를 받습니다.
-                str 형태인 하나의 query만 받으면 `get_relevant_doc`을 통해 유사도를 구합니다.
-                Dataset 형태는 query를 포함한 HF.Dataset을 받습니다.
-                이 경우 `get_relevant_doc_bulk`를 통해 유사도를 구합니다.
-            topk (Optional[int], optional): Defaults to 1.
-                상위 몇 개의 passage를 사용할 것인지 지정합니다.
-
-        Returns:
-            1개의 Query를 받는 경우  -> Tuple(List, List)
-            다수의 Query를 받는 경우 -> pd.DataFrame: [description]
-
-        Note:
-            다수의 Query를 받는 경우,
-                Ground Truth가 있는 Query (train/valid) -> 기존 Ground Truth Passage를 같이 반환합니다.
-                Ground Truth가 없는 Query (test) -> Retrieval한 Passage만 반환합니다.
-        """
-
-        assert self.p_embedding is not None, "get_sparse_embedding() 메소드를 먼저 수행해줘야합니다."
-
-        if isinstance(query_or_dataset, str):
-            doc_scores, doc_indices = self.get_relevant_doc(query_or_dataset, k=topk)
-            print("[Search query]\n", query_or_dataset, "\n")
-
-            for i in range(topk):
-                print(f"Top-{i+1} passage with score {doc_scores[i]:4f}")
-                print(self.contexts[doc_indices[i]])
-
-            return (doc_scores, [self.contexts[doc_indices[i]] for i in range(topk)])
-
-        elif isinstance(query_or_dataset, Dataset):
-
-            # Retrieve한 Passage를 pd.DataFrame으로 반환합니다.
-            total = []
-            with timer("query exhaustive search"):
-                doc_scores, doc_indices = self.get_relevant_doc_bulk(
-                    query_or_dataset["question"], k=topk
-                )
-            for idx, example in enumerate(
-                tqdm(query_or_dataset, desc="Sparse retrieval: ")
-            ):
-                tmp = {
-                    # Query와 해당 id를 반환합니다.
-                    "question": example["question"],
-                    "id": example["id"],
-                    # Retrieve한 Passage의 id, context를 반환합니다.
-                    "context_id": doc_indices[idx],
-                    "context": " ".join(
-                        [self.contexts[pid] for pid in doc_indices[idx]]
-                    ),
-                }
-                if "context" in example.keys() and "answers" in example.keys():
-                    # validation 데이터를 사용하면 ground_truth context와 answer도 반환합니다.
-                    tmp["original_context"] = example["context"]
-                    tmp["answers"] = example["answers"]
-                total.append(tmp)
-
-            cqas = pd.DataFrame(total)
-            return cqas
-
-    def get_relevant_doc(self, query: str, k: Optional[int] = 1) -> Tuple[List, List]:
+    def _get_relevant_doc(self, query: str, k: Optional[int] = 1) -> Tuple[List, List]:
 
         """
         Arguments:
@@ -213,23 +430,25 @@ class SparseRetrieval:
             vocab 에 없는 이상한 단어로 query 하는 경우 assertion 발생 (예) 뙣뙇?
         """
 
-        with timer("transform"):
+        METRICS.count("retrieval.sparse.queries")
+        with span("retrieval.sparse.transform"):
             query_vec = self.tfidfv.transform([query])
         assert (
             np.sum(query_vec) != 0
         ), "오류가 발생했습니다. 이 오류는 보통 query에 vectorizer의 vocab에 없는 단어만 존재하는 경우 발생합니다."
 
-        with timer("query ex search"):
+        with span("retrieval.sparse.score"):
             result = query_vec * self.p_embedding.T
-        if not isinstance(result, np.ndarray):
-            result = result.toarray()
+            if not isinstance(result, np.ndarray):
+                result = result.toarray()
 
-        sorted_result = np.argsort(result.squeeze())[::-1]
-        doc_score = result.squeeze()[sorted_result].tolist()[:k]
-        doc_indices = sorted_result.tolist()[:k]
+        with span("retrieval.sparse.topk"):
+            sorted_result = np.argsort(result.squeeze())[::-1]
+            doc_score = result.squeeze()[sorted_result].tolist()[:k]
+            doc_indices = sorted_result.tolist()[:k]
         return doc_score, doc_indices
 
-    def get_relevant_doc_bulk(
+    def _get_relevant_doc_bulk(
         self, queries: List, k: Optional[int] = 1
     ) -> Tuple[List, List]:
 
@@ -243,93 +462,28 @@ class SparseRetrieval:
             vocab 에 없는 이상한 단어로 query 하는 경우 assertion 발생 (예) 뙣뙇?
         """
 
-        query_vec = self.tfidfv.transform(queries)
+        METRICS.count("retrieval.sparse.queries", len(queries))
+        with span("retrieval.sparse.transform"):
+            query_vec = self.tfidfv.transform(queries)
         assert (
             np.sum(query_vec) != 0
         ), "오류가 발생했습니다. 이 오류는 보통 query에 vectorizer의 vocab에 없는 단어만 존재하는 경우 발생합니다."
 
-        result = query_vec * self.p_embedding.T
-        if not isinstance(result, np.ndarray):
-            result = result.toarray()
-        doc_scores = []
-        doc_indices = []
-        for i in range(result.shape[0]):
-            sorted_result = np.argsort(result[i, :])[::-1]
-            doc_scores.append(result[i, :][sorted_result].tolist()[:k])
-            doc_indices.append(sorted_result.tolist()[:k])
+        with span("retrieval.sparse.score"):
+            result = query_vec * self.p_embedding.T
+            if not isinstance(result, np.ndarray):
+                result = result.toarray()
+
+        with span("retrieval.sparse.topk"):
+            doc_scores = []
+            doc_indices = []
+            for i in range(result.shape[0]):
+                sorted_result = np.argsort(result[i, :])[::-1]
+                doc_scores.append(result[i, :][sorted_result].tolist()[:k])
+                doc_indices.append(sorted_result.tolist()[:k])
         return doc_scores, doc_indices
 
-    def retrieve_faiss(
-        self, query_or_dataset: Union[str, Dataset], topk: Optional[int] = 1
-    ) -> Union[Tuple[List, List], pd.DataFrame]:
-
-        """
-        Arguments:
-            query_or_dataset (Union[str, Dataset]):
-                str이나 Dataset으로 이루어진 Query를 받습니다.
-                str 형태인 하나의 query만 받으면 `get_relevant_doc`을 통해 유사도를 구합니다.
-                Dataset 형태는 query를 포함한 HF.Dataset을 받습니다.
-                이 경우 `get_relevant_doc_bulk`를 통해 유사도를 구합니다.
-            topk (Optional[int], optional): Defaults to 1.
-                상위 몇 개의 passage를 사용할 것인지 지정합니다.
-
-        Returns:
-            1개의 Query를 받는 경우  -> Tuple(List, List)
-            다수의 Query를 받는 경우 -> pd.DataFrame: [description]
-
-        Note:
-            다수의 Query를 받는 경우,
-                Ground Truth가 있는 Query (train/valid) -> 기존 Ground Truth Passage를 같이 반환합니다.
-                Ground Truth가 없는 Query (test) -> Retrieval한 Passage만 반환합니다.
-            retrieve와 같은 기능을 하지만 faiss.indexer를 사용합니다.
-        """
-
-        assert self.indexer is not None, "build_faiss()를 먼저 수행해주세요."
-
-        if isinstance(query_or_dataset, str):
-            doc_scores, doc_indices = self.get_relevant_doc_faiss(
-                query_or_dataset, k=topk
-            )
-            print("[Search query]\n", query_or_dataset, "\n")
-
-            for i in range(topk):
-                print("Top-%d passage with score %.4f" % (i + 1, doc_scores[i]))
-                print(self.contexts[doc_indices[i]])
-
-            return (doc_scores, [self.contexts[doc_indices[i]] for i in range(topk)])
-
-        elif isinstance(query_or_dataset, Dataset):
-
-            # Retrieve한 Passage를 pd.DataFrame으로 반환합니다.
-            queries = query_or_dataset["question"]
-            total = []
-
-            with timer("query faiss search"):
-                doc_scores, doc_indices = self.get_relevant_doc_bulk_faiss(
-                    queries, k=topk
-                )
-            for idx, example in enumerate(
-                tqdm(query_or_dataset, desc="Sparse retrieval: ")
-            ):
-                tmp = {
-                    # Query와 해당 id를 반환합니다.
-                    "question": example["question"],
-                    "id": example["id"],
-                    # Retrieve한 Passage의 id, context를 반환합니다.
-                    "context_id": doc_indices[idx],
-                    "context": " ".join(
-                        [self.contexts[pid] for pid in doc_indices[idx]]
-                    ),
-                }
-                if "context" in example.keys() and "answers" in example.keys():
-                    # validation 데이터를 사용하면 ground_truth context와 answer도 반환합니다.
-                    tmp["original_context"] = example["context"]
-                    tmp["answers"] = example["answers"]
-                total.append(tmp)
-
-            return pd.DataFrame(total)
-
-    def get_relevant_doc_faiss(
+    def _get_relevant_doc_faiss(
         self, query: str, k: Optional[int] = 1
     ) -> Tuple[List, List]:
 
@@ -343,18 +497,20 @@ class SparseRetrieval:
             vocab 에 없는 이상한 단어로 query 하는 경우 assertion 발생 (예) 뙣뙇?
         """
 
-        query_vec = self.tfidfv.transform([query])
+        METRICS.count("retrieval.sparse.queries")
+        with span("retrieval.sparse.transform"):
+            query_vec = self.tfidfv.transform([query])
         assert (
             np.sum(query_vec) != 0
         ), "오류가 발생했습니다. 이 오류는 보통 query에 vectorizer의 vocab에 없는 단어만 존재하는 경우 발생합니다."
 
         q_emb = query_vec.toarray().astype(np.float32)
-        with timer("query faiss search"):
+        with span("retrieval.sparse.faiss_search"):
             D, I = self.indexer.search(q_emb, k)
 
         return D.tolist()[0], I.tolist()[0]
 
-    def get_relevant_doc_bulk_faiss(
+    def _get_relevant_doc_bulk_faiss(
         self, queries: List, k: Optional[int] = 1
     ) -> Tuple[List, List]:
 
@@ -368,20 +524,525 @@ class SparseRetrieval:
             vocab 에 없는 이상한 단어로 query 하는 경우 assertion 발생 (예) 뙣뙇?
         """
 
-        query_vecs = self.tfidfv.transform(queries)
+        METRICS.count("retrieval.sparse.queries", len(queries))
+        with span("retrieval.sparse.transform"):
+            query_vecs = self.tfidfv.transform(queries)
         assert (
             np.sum(query_vecs) != 0
         ), "오류가 발생했습니다. 이 오류는 보통 query에 vectorizer의 vocab에 없는 단어만 존재하는 경우 발생합니다."
 
         q_embs = query_vecs.toarray().astype(np.float32)
-        D, I = self.indexer.search(q_embs, k)
+        with span("retrieval.sparse.faiss_search"):
+            D, I = self.indexer.search(q_embs, k)
 
         return D.tolist(), I.tolist()
 
 
+
+
+class DenseRetrieval(BaseRetrieval):
+    name = "Dense"
+    embedding_method = "get_dense_embedding"
+
+    def __init__(
+        self,
+        q_encoder_name_or_path: str,
+        p_encoder_name_or_path: Optional[str] = None,
+        data_path: Optional[str] = "../data/",
+        context_path: Optional[str] = "wikipedia_documents.json",
+        cache: Optional[LRUCache] = None,
+        batch_size: int = 64,
+        max_length: int = 384,
+        shard_size: int = 50000,
+        device: Optional[str] = None,
+    ) -> NoReturn:
+
+        """
+        Arguments:
+            q_encoder_name_or_path:
+                question을 encoding할 bi-encoder 입니다. (예: 학습된 DPR question encoder, 작은 BERT)
+                [CLS] token의 마지막 hidden state를 embedding으로 사용합니다.
+
+            p_encoder_name_or_path:
+                passage를 encoding할 encoder 입니다. None이면 q_encoder와 같은 모델을 사용합니다.
+
+            batch_size:
+                passage/question을 encoding할 때의 batch 크기입니다.
+
+            max_length:
+                passage를 encoding할 때 자를 최대 token 수입니다.
+
+            shard_size:
+                embedding shard 하나에 들어가는 passage 수입니다.
+
+            나머지 Arguments는 BaseRetrieval과 같습니다.
+
+        Summary:
+            Passage embedding은 `get_dense_embedding()`에서 한 번만 계산해 float16 .npy shard로 저장하고,
+            이후에는 memory-map으로 불러와 검색합니다.
+            `retrieve` / `retrieve_faiss` 등의 interface와 검색 결과 cache는 BaseRetrieval의 것을 사용합니다.
+        """
+
+        super().__init__(data_path, context_path, cache)
+
+        self.q_encoder_name = q_encoder_name_or_path
+        self.p_encoder_name = p_encoder_name_or_path or q_encoder_name_or_path
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.shard_size = shard_size
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+
+        self.tokenizer = AutoTokenizer.from_pretrained(self.q_encoder_name, use_fast=True)
+        self.q_encoder = AutoModel.from_pretrained(self.q_encoder_name).to(self.device)
+        self.q_encoder.eval()
+
+        # local encoder는 절대 경로로 구분하고, 이름이 같은 다른 encoder와 섞이지 않도록 directory에 hash를 붙입니다.
+        self.p_encoder_key = (
+            os.path.abspath(self.p_encoder_name)
+            if os.path.isdir(self.p_encoder_name)
+            else self.p_encoder_name
+        )
+        embedding_name = os.path.basename(os.path.normpath(self.p_encoder_name))
+        digest = hashlib.sha1(self.p_encoder_key.encode()).hexdigest()[:8]
+        self.embedding_dir = os.path.join(data_path, f"dense_embedding_{embedding_name}_{digest}")
+
+    @torch.no_grad()
+    def _encode(self, encoder, tokenizer, texts: List[str], max_length: int) -> np.ndarray:
+        embeddings = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = tokenizer(
+                texts[start : start + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=max_length,
+                return_tensors="pt",
+            ).to(self.device)
+            outputs = encoder(**batch)
+            embeddings.append(outputs[0][:, 0].float().cpu().numpy())
+        return np.concatenate(embeddings).astype(np.float32)
+
+    def _encode_queries(self, queries: List[str]) -> np.ndarray:
+        METRICS.count("retrieval.dense.queries", len(queries))
+        with span("retrieval.dense.encode"):
+            return self._encode(
+                self.q_encoder, self.tokenizer, queries, self.tokenizer.model_max_length
+            )
+
+    def _passage_dim(self) -> int:
+        if self.p_encoder_name == self.q_encoder_name:
+            return self.q_encoder.config.hidden_size
+        return AutoConfig.from_pretrained(self.p_encoder_name).hidden_size
+
+    def get_dense_embedding(self) -> NoReturn:
+
+        """
+        Summary:
+            Passage embedding을 shard_size개씩 계산해
+            `{data_path}/dense_embedding_{encoder}_{hash}/shard_{i}.npy`에 float16으로 저장합니다.
+            모든 shard를 쓴 뒤에 meta.json을 저장하므로, 중간에 중단된 embedding은 다시 만듭니다.
+            이미 저장된 embedding이 있으면 memory-map으로 불러오기만 합니다.
+            meta.json의 encoder, max_length, passage 수, dim 중 하나라도 다르면 embedding을 다시 만듭니다.
+        """
+
+        meta_path = os.path.join(self.embedding_dir, "meta.json")
+        meta = None
+        if os.path.isfile(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            expected = {
+                "encoder": self.p_encoder_key,
+                "max_length": self.max_length,
+                "num_passages": len(self.contexts),
+                "dim": self._passage_dim(),
+            }
+            changed = [key for key, value in expected.items() if meta.get(key) != value]
+            missing = [
+                name
+                for name in meta.get("shards", [])
+                if not os.path.isfile(os.path.join(self.embedding_dir, name))
+            ]
+            if changed:
+                print(f"{', '.join(changed)} 설정이 달라 dense embedding을 다시 만듭니다.")
+                meta = None
+            elif missing:
+                print(f"shard {len(missing)}개가 없어 dense embedding을 다시 만듭니다.")
+                meta = None
+
+        if meta is None:
+            print("Build dense passage embedding")
+            meta = self._build_dense_embedding(meta_path)
+        else:
+            print("Dense embedding load.")
+
+        shard_paths = [os.path.join(self.embedding_dir, name) for name in meta["shards"]]
+        self.p_embedding = [np.load(path, mmap_mode="r") for path in shard_paths]
+        print(f"{meta['num_passages']} passages, dim {meta['dim']}, {len(shard_paths)} shards")
+
+        self._set_index_version(_index_version(meta_path, *shard_paths))
+
+    def _build_dense_embedding(self, meta_path: str) -> dict:
+        os.makedirs(self.embedding_dir, exist_ok=True)
+        # 이전 embedding의 meta, shard와 그것으로 만든 faiss index는 새 embedding과 맞지 않으므로 지웁니다.
+        # meta.json을 먼저 지워 중간에 중단되어도 이전 meta로 새 shard를 읽지 않게 합니다.
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+        for name in os.listdir(self.embedding_dir):
+            if name.endswith(".index") or (name.startswith("shard_") and name.endswith(".npy")):
+                os.remove(os.path.join(self.embedding_dir, name))
+
+        if self.p_encoder_name == self.q_encoder_name:
+            p_tokenizer, p_encoder = self.tokenizer, self.q_encoder
+        else:
+            p_tokenizer = AutoTokenizer.from_pretrained(self.p_encoder_name, use_fast=True)
+            p_encoder = AutoModel.from_pretrained(self.p_encoder_name).to(self.device)
+            p_encoder.eval()
+        dim = p_encoder.config.hidden_size
+
+        shards = []
+        for shard_id, start in enumerate(range(0, len(self.contexts), self.shard_size)):
+            texts = self.contexts[start : start + self.shard_size]
+            name = f"shard_{shard_id:03d}.npy"
+            shard = np.lib.format.open_memmap(
+                os.path.join(self.embedding_dir, name),
+                mode="w+",
+                dtype=np.float16,
+                shape=(len(texts), dim),
+            )
+            # shard 전체를 memory에 올리지 않고 batch 단위로 바로 파일에 씁니다.
+            for offset in tqdm(
+                range(0, len(texts), self.batch_size), desc=f"Dense embedding {name}"
+            ):
+                batch = texts[offset : offset + self.batch_size]
+                shard[offset : offset + len(batch)] = self._encode(
+                    p_encoder, p_tokenizer, batch, self.max_length
+                )
+            shard.flush()
+            del shard
+            shards.append(name)
+
+        meta = {
+            "encoder": self.p_encoder_key,
+            "max_length": self.max_length,
+            "num_passages": len(self.contexts),
+            "dim": dim,
+            "shards": shards,
+        }
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=4)
+        print("Dense embedding saved.")
+        return meta
+
+    def _iter_shards(self, block_size: int = 16384):
+        # float16 shard를 block 단위로 float32로 바꿔가며 (시작 passage id, embedding)을 반환합니다.
+        offset = 0
+        for shard in self.p_embedding:
+            for start in range(0, len(shard), block_size):
+                yield offset + start, np.asarray(
+                    shard[start : start + block_size], dtype=np.float32
+                )
+            offset += len(shard)
+
+    def build_faiss(self, num_clusters=64) -> NoReturn:
+
+        """
+        Summary:
+            inner product 기준의 IVF indexer를 만들고 저장합니다.
+            학습은 일부 embedding으로만 하고, 추가는 shard block 단위로 하므로
+            전체 embedding을 한 번에 float32로 올리지 않습니다.
+        """
+
+        assert self.p_embedding is not None, "get_dense_embedding()을 먼저 수행해주세요."
+
+        indexer_name = f"faiss_ip_clusters{num_clusters}.index"
+        indexer_path = os.path.join(self.embedding_dir, indexer_name)
+        self.faiss_name = f"dense_{indexer_name}"
+        if os.path.isfile(indexer_path):
+            print("Load Saved Faiss Indexer.")
+            self.indexer = faiss.read_index(indexer_path)
+            return
+
+        emb_dim = self.p_embedding[0].shape[-1]
+        num_passages = sum(len(shard) for shard in self.p_embedding)
+        if num_passages < num_clusters * 39:
+            # cluster 학습에 필요한 수보다 passage가 적으면 exhaustive inner product로 충분합니다.
+            self.indexer = faiss.IndexFlatIP(emb_dim)
+        else:
+            quantizer = faiss.IndexFlatIP(emb_dim)
+            self.indexer = faiss.IndexIVFFlat(
+                quantizer, emb_dim, num_clusters, faiss.METRIC_INNER_PRODUCT
+            )
+            train_size = min(num_passages, num_clusters * 256)
+            train_embs = []
+            for _, emb in self._iter_shards():
+                train_embs.append(emb)
+                if sum(len(e) for e in train_embs) >= train_size:
+                    break
+            self.indexer.train(np.concatenate(train_embs)[:train_size])
+
+        for _, emb in self._iter_shards():
+            self.indexer.add(emb)
+        faiss.write_index(self.indexer, indexer_path)
+        print("Faiss Indexer Saved.")
+
+    def _cache_key(self, method: str, query: str, k: int) -> Tuple:
+        # dense encoder는 대소문자를 구분할 수 있으므로 공백만 정규화합니다.
+        return (method, " ".join(query.split()), k, self.index_version)
+
+    def _search_shards(self, q_embs: np.ndarray, k: int) -> Tuple[List, List]:
+        # shard block마다 top-k 후보를 구한 뒤 합쳐서 최종 top-k를 고릅니다.
+        top_scores = np.full((len(q_embs), 0), -np.inf, dtype=np.float32)
+        top_indices = np.zeros((len(q_embs), 0), dtype=np.int64)
+        for offset, emb in self._iter_shards():
+            with span("retrieval.dense.score"):
+                scores = q_embs @ emb.T
+            with span("retrieval.dense.topk"):
+                kk = min(k, scores.shape[1])
+                part = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+                top_scores = np.concatenate(
+                    [top_scores, np.take_along_axis(scores, part, axis=1)], axis=1
+                )
+                top_indices = np.concatenate([top_indices, part + offset], axis=1)
+
+        order = np.argsort(-top_scores, axis=1)[:, :k]
+        return (
+            np.take_along_axis(top_scores, order, axis=1).tolist(),
+            np.take_along_axis(top_indices, order, axis=1).tolist(),
+        )
+
+    def _get_relevant_doc_bulk(
+        self, queries: List, k: Optional[int] = 1
+    ) -> Tuple[List, List]:
+        assert self.p_embedding is not None, "get_dense_embedding()을 먼저 수행해주세요."
+        return self._search_shards(self._encode_queries(queries), k)
+
+    def _get_relevant_doc_bulk_faiss(
+        self, queries: List, k: Optional[int] = 1
+    ) -> Tuple[List, List]:
+        q_embs = self._encode_queries(queries)
+        with span("retrieval.dense.faiss_search"):
+            D, I = self.indexer.search(q_embs, k)
+        return D.tolist(), I.tolist()
+
+
+class HybridRetrieval:
+    def __init__(
+        self,
+        sparse: SparseRetrieval,
+        dense: DenseRetrieval,
+        fusion: str = "rrf",
+        sparse_weight: float = 0.5,
+        rrf_k: int = 60,
+        num_candidates: int = 50,
+    ) -> NoReturn:
+
+        """
+        Arguments:
+            sparse, dense:
+                embedding(과 사용할 경우 faiss indexer)까지 준비된 retriever 입니다. 같은 context 파일을 사용해야 합니다.
+
+            fusion:
+                "rrf"이면 reciprocal rank fusion (sum w / (rrf_k + rank))으로,
+                "weighted"이면 retriever별로 min-max 정규화한 score의 가중합으로 후보를 합칩니다.
+
+            sparse_weight:
+                sparse 결과의 가중치입니다. dense는 1 - sparse_weight를 사용합니다.
+
+            num_candidates:
+                각 retriever에서 가져올 후보 수입니다. topk보다 작으면 topk를 사용합니다.
+
+        Summary:
+            두 retriever를 가지고 있으면서 동시에 검색하고 후보 목록을 합칩니다.
+            BaseRetrieval을 상속하지 않지만 `retrieve` / `retrieve_faiss` 등의 interface는 같습니다.
+        """
+
+        assert fusion in ("rrf", "weighted"), "fusion은 'rrf' 혹은 'weighted' 여야 합니다."
+        assert len(sparse.contexts) == len(dense.contexts), "두 retriever의 passage가 다릅니다."
+
+        self.sparse = sparse
+        self.dense = dense
+        self.fusion = fusion
+        self.weights = (sparse_weight, 1.0 - sparse_weight)
+        self.rrf_k = rrf_k
+        self.num_candidates = num_candidates
+
+        self.data_path = sparse.data_path
+        self.contexts = sparse.contexts
+        self.ids = sparse.ids
+        # 결과 재사용은 각 retriever의 cache가 담당하며, 여기서는 통계 확인용으로만 노출합니다.
+        self.cache = sparse.cache if sparse.cache is not None else dense.cache
+
+    @property
+    def p_embedding(self):
+        if self.sparse.p_embedding is None or self.dense.p_embedding is None:
+            return None
+        return self.sparse.p_embedding
+
+    @property
+    def indexer(self):
+        if self.sparse.indexer is None or self.dense.indexer is None:
+            return None
+        return self.dense.indexer
+
+    def build_faiss(self, num_clusters=64) -> NoReturn:
+        self.sparse.build_faiss(num_clusters=num_clusters)
+        self.dense.build_faiss(num_clusters=num_clusters)
+
+    def save_cache(self) -> NoReturn:
+        self.sparse.save_cache()
+        self.dense.save_cache()
+
+    def retrieve(
+        self, query_or_dataset: Union[str, Dataset], topk: Optional[int] = 1
+    ) -> Union[Tuple[List, List], pd.DataFrame]:
+        # BaseRetrieval.retrieve와 같은 형식으로 반환합니다.
+        assert self.p_embedding is not None, "두 retriever의 embedding을 먼저 준비해주세요."
+        return self._retrieve(
+            query_or_dataset, topk, self.get_relevant_doc, self.get_relevant_doc_bulk
+        )
+
+    def retrieve_faiss(
+        self, query_or_dataset: Union[str, Dataset], topk: Optional[int] = 1
+    ) -> Union[Tuple[List, List], pd.DataFrame]:
+        assert self.indexer is not None, "build_faiss()를 먼저 수행해주세요."
+        return self._retrieve(
+            query_or_dataset, topk, self.get_relevant_doc_faiss, self.get_relevant_doc_bulk_faiss
+        )
+
+    def _retrieve(self, query_or_dataset, topk: int, search, search_bulk):
+        if isinstance(query_or_dataset, str):
+            doc_scores, doc_indices = search(query_or_dataset, k=topk)
+            return (doc_scores, [self.contexts[pid] for pid in doc_indices])
+
+        with timer("query hybrid search"):
+            doc_scores, doc_indices = search_bulk(query_or_dataset["question"], k=topk)
+        total = []
+        for idx, example in enumerate(tqdm(query_or_dataset, desc="Hybrid retrieval: ")):
+            tmp = {
+                "question": example["question"],
+                "id": example["id"],
+                "context_id": doc_indices[idx],
+                "context": " ".join([self.contexts[pid] for pid in doc_indices[idx]]),
+            }
+            if "context" in example.keys() and "answers" in example.keys():
+                # validation 데이터를 사용하면 ground_truth context와 answer도 반환합니다.
+                tmp["original_context"] = example["context"]
+                tmp["answers"] = example["answers"]
+            total.append(tmp)
+        return pd.DataFrame(total)
+
+    def _search(self, use_faiss: bool, queries: List, k: int) -> List[Tuple[List, List]]:
+        n = max(k, self.num_candidates)
+        # 두 retriever를 동시에 검색합니다. pool은 호출이 끝나면 바로 정리됩니다.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = []
+            for retriever in (self.sparse, self.dense):
+                search = (
+                    retriever.get_relevant_doc_bulk_faiss
+                    if use_faiss
+                    else retriever.get_relevant_doc_bulk
+                )
+                futures.append(executor.submit(search, queries, k=n))
+            outputs = [future.result() for future in futures]
+
+        results = []
+        for retriever, (doc_scores, doc_indices) in zip((self.sparse, self.dense), outputs):
+            if use_faiss and retriever.indexer.metric_type == faiss.METRIC_L2:
+                # L2 distance는 작을수록 가까우므로 부호를 바꿔 score처럼 다룹니다.
+                doc_scores = [[-score for score in scores] for scores in doc_scores]
+            results.append((doc_scores, doc_indices))
+        return results
+
+    def _fuse(self, results: List[Tuple[List, List]], k: int) -> Tuple[List, List]:
+        doc_scores, doc_indices = [], []
+        for i in range(len(results[0][0])):
+            fused = {}
+            for weight, (scores, indices) in zip(self.weights, results):
+                # faiss는 후보가 부족하면 -1을 돌려줍니다.
+                pairs = [(s, pid) for s, pid in zip(scores[i], indices[i]) if pid >= 0]
+                if self.fusion == "rrf":
+                    for rank, (_, pid) in enumerate(pairs, start=1):
+                        fused[pid] = fused.get(pid, 0.0) + weight / (self.rrf_k + rank)
+                elif pairs:
+                    values = np.array([s for s, _ in pairs], dtype=np.float64)
+                    value_range = values.max() - values.min()
+                    normed = (
+                        (values - values.min()) / value_range
+                        if value_range > 0
+                        else np.ones_like(values)
+                    )
+                    for value, (_, pid) in zip(normed, pairs):
+                        fused[pid] = fused.get(pid, 0.0) + weight * float(value)
+
+            top = sorted(fused.items(), key=lambda x: x[1], reverse=True)[:k]
+            doc_scores.append([score for _, score in top])
+            doc_indices.append([pid for pid, _ in top])
+        return doc_scores, doc_indices
+
+    def get_relevant_doc(self, query: str, k: Optional[int] = 1) -> Tuple[List, List]:
+        doc_scores, doc_indices = self.get_relevant_doc_bulk([query], k=k)
+        return doc_scores[0], doc_indices[0]
+
+    def get_relevant_doc_bulk(self, queries: List, k: Optional[int] = 1) -> Tuple[List, List]:
+        return self._fuse(self._search(False, queries, k), k)
+
+    def get_relevant_doc_faiss(self, query: str, k: Optional[int] = 1) -> Tuple[List, List]:
+        doc_scores, doc_indices = self.get_relevant_doc_bulk_faiss([query], k=k)
+        return doc_scores[0], doc_indices[0]
+
+    def get_relevant_doc_bulk_faiss(self, queries: List, k: Optional[int] = 1) -> Tuple[List, List]:
+        return self._fuse(self._search(True, queries, k), k)
+
+
+def rank_metrics(doc_indices: List[List[int]], gold: np.ndarray, ks: List[int]) -> dict:
+
+    """
+    Summary:
+        검색된 passage id 목록에서 ground truth passage의 순위를 구해 recall@k와 MRR을 계산합니다.
+        ground truth가 검색 결과에 없는 question은 recall에서 miss, reciprocal rank는 0으로 계산합니다.
+    """
+
+    ranks = np.full(len(gold), np.inf)
+    for i, indices in enumerate(doc_indices):
+        hits = np.nonzero(np.asarray(indices) == gold[i])[0]
+        if len(hits):
+            ranks[i] = hits[0] + 1
+
+    report = {f"recall@{k}": float(np.mean(ranks <= k)) for k in ks}
+    report["mrr"] = float(np.mean(1.0 / ranks))
+    return report
+
+
+def recall_at_k(
+    retriever: Union[BaseRetrieval, HybridRetrieval],
+    dataset: Dataset,
+    ks: List[int] = (1, 5, 10, 20),
+    use_faiss: bool = False,
+) -> dict:
+
+    """
+    Summary:
+        ground truth context가 top-k 안에 있는 question의 비율(recall@k), MRR과 bulk 검색 latency를 계산합니다.
+        passage가 이어붙여지는 `retrieve`의 결과 대신 passage id로 비교하므로 topk > 1에서도 정확합니다.
+    """
+
+    context_to_id = {context: i for i, context in enumerate(retriever.contexts)}
+    gold = np.array([context_to_id.get(c, -1) for c in dataset["context"]])
+
+    search = retriever.get_relevant_doc_bulk_faiss if use_faiss else retriever.get_relevant_doc_bulk
+    t0 = time.perf_counter()
+    _, doc_indices = search(dataset["question"], k=max(ks))
+    elapsed = time.perf_counter() - t0
+
+    report = rank_metrics(doc_indices, gold, ks)
+    report["latency_s"] = round(elapsed, 3)
+    report["ms_per_query"] = round(elapsed / len(gold) * 1000, 3)
+    return report
+
+
 if __name__ == "__main__":
 
     import argparse
+    import sys
 
     parser = argparse.ArgumentParser(description="")
     parser.add_argument(
@@ -398,6 +1059,18 @@ if __name__ == "__main__":
         "--context_path", metavar="wikipedia_documents", type=str, help=""
     )
     parser.add_argument("--use_faiss", metavar=False, type=bool, help="")
+    parser.add_argument(
+        "--dense_encoder",
+        default=None,
+        type=str,
+        help="주어지면 이 encoder로 DenseRetrieval을 테스트합니다. (CPU에서는 작은 BERT 권장)",
+    )
+    parser.add_argument(
+        "--hybrid",
+        action="store_true",
+        help="sparse, dense, hybrid retriever의 recall@k와 latency를 비교합니다. --dense_encoder가 필요합니다.",
+    )
+    parser.add_argument("--fusion", default="rrf", choices=["rrf", "weighted"], help="")
 
     args = parser.parse_args()
 
@@ -416,11 +1089,45 @@ if __name__ == "__main__":
 
     tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path, use_fast=False,)
 
-    retriever = SparseRetrieval(
-        tokenize_fn=tokenizer.tokenize,
-        data_path=args.data_path,
-        context_path=args.context_path,
-    )
+    if args.hybrid:
+        assert args.dense_encoder, "--hybrid에는 --dense_encoder가 필요합니다."
+        sparse = SparseRetrieval(
+            tokenize_fn=tokenizer.tokenize,
+            data_path=args.data_path,
+            context_path=args.context_path,
+        )
+        sparse.get_sparse_embedding()
+        dense = DenseRetrieval(
+            args.dense_encoder,
+            data_path=args.data_path,
+            context_path=args.context_path,
+        )
+        dense.get_dense_embedding()
+        if args.use_faiss:
+            sparse.build_faiss()
+            dense.build_faiss()
+        hybrid = HybridRetrieval(sparse, dense, fusion=args.fusion)
+
+        for name, retriever in [("sparse", sparse), ("dense", dense), (f"hybrid-{args.fusion}", hybrid)]:
+            print(name, recall_at_k(retriever, full_ds, use_faiss=bool(args.use_faiss)))
+        sys.exit(0)
+
+    if args.dense_encoder:
+        retriever = DenseRetrieval(
+            args.dense_encoder,
+            data_path=args.data_path,
+            context_path=args.context_path,
+        )
+        retriever.get_dense_embedding()
+    else:
+        retriever = SparseRetrieval(
+            tokenize_fn=tokenizer.tokenize,
+            data_path=args.data_path,
+            context_path=args.context_path,
+        )
+        retriever.get_sparse_embedding()
+    if args.use_faiss:
+        retriever.build_faiss()
 
     query = "대통령을 포함한 미국의 행정부 견제권을 갖는 국가 기관은?"
 
@@ -431,20 +1138,14 @@ if __name__ == "__main__":
             scores, indices = retriever.retrieve_faiss(query)
 
         # test bulk
-        with timer("bulk query by exhaustive search"):
-            df = retriever.retrieve_faiss(full_ds)
-            df["correct"] = df["original_context"] == df["context"]
-
-            print("correct retrieval result by faiss", df["correct"].sum() / len(df))
+        # passage를 이어붙인 context를 비교하면 topk > 1에서 항상 틀리므로 passage id로 비교합니다.
+        # 자세한 측정(MRR, latency 분포, peak RSS)은 retrieval_benchmark.py를 사용하세요.
+        with timer("bulk query by faiss"):
+            print("retrieval result by faiss", recall_at_k(retriever, full_ds, use_faiss=True))
 
     else:
         with timer("bulk query by exhaustive search"):
-            df = retriever.retrieve(full_ds)
-            df["correct"] = df["original_context"] == df["context"]
-            print(
-                "correct retrieval result by exhaustive search",
-                df["correct"].sum() / len(df),
-            )
+            print("retrieval result by exhaustive search", recall_at_k(retriever, full_ds))
 
         with timer("single query by exhaustive search"):
             scores, indices = retriever.retrieve(query)
@@ -0,0 +1,209 @@
+"""
+retriever backend/설정별 검색 품질과 속도를 측정해 JSON으로 저장하는 benchmark 코드 입니다.
+
+train + validation 의 4192 개 질문에 대해 다음을 측정합니다.
+    - recall@{1,5,10,20,50}, MRR (ground truth passage의 id 기준)
+    - single(질문 하나씩) / bulk(batch) 모드의 queries/sec 와 p50/p95/p99 latency
+    - 각 설정을 실행하는 동안의 peak RSS
+
+    python retrieval_benchmark.py --dataset_name ../data/train_dataset --model_name_or_path klue/bert-base \
+        --backends sparse sparse-faiss --output ./outputs/retrieval_benchmark.json
+"""
+
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+import numpy as np
+from datasets import Dataset, concatenate_datasets, load_from_disk
+from memory_usage import peak_rss_mb, reset_peak_rss
+from retrieval import DenseRetrieval, HybridRetrieval, SparseRetrieval, rank_metrics
+
+KS = (1, 5, 10, 20, 50)
+BACKENDS = (
+    "sparse",
+    "sparse-faiss",
+    "dense",
+    "dense-faiss",
+    "hybrid-rrf",
+    "hybrid-weighted",
+)
+
+
+def latency_summary(latencies: List[float], num_queries: int) -> Dict[str, float]:
+    if not latencies:
+        return {"queries_per_sec": 0.0, "p50_ms": None, "p95_ms": None, "p99_ms": None}
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "queries_per_sec": round(num_queries / max(sum(latencies), 1e-9), 2),
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies_ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 3),
+    }
+
+
+def run_single(search: Callable, questions: List[str], k: int) -> Dict[str, float]:
+    latencies, num_failed = [], 0
+    for question in questions:
+        t0 = time.perf_counter()
+        try:
+            search(question, k=k)
+        except AssertionError:
+            # vocab에 없는 단어로만 이루어진 질문은 sparse retriever에서 assertion이 발생합니다.
+            # 검색 결과가 없으므로 latency 통계에는 넣지 않고 따로 셉니다.
+            num_failed += 1
+            continue
+        latencies.append(time.perf_counter() - t0)
+    report = latency_summary(latencies, len(latencies))
+    report["num_failed"] = num_failed
+    return report
+
+
+def run_bulk(search: Callable, questions: List[str], k: int, batch_size: int):
+    latencies, doc_indices = [], []
+    for start in range(0, len(questions), batch_size):
+        batch = questions[start : start + batch_size]
+        t0 = time.perf_counter()
+        _, indices = search(batch, k=k)
+        latencies.append(time.perf_counter() - t0)
+        doc_indices.extend(indices)
+    report = latency_summary(latencies, len(questions))
+    report["batch_size"] = batch_size
+    return report, doc_indices
+
+
+def benchmark(
+    name: str,
+    retriever: SparseRetrieval,
+    use_faiss: bool,
+    dataset: Dataset,
+    gold: np.ndarray,
+    num_single: int,
+    batch_size: int,
+) -> Dict:
+    k = max(KS)
+    if use_faiss:
+        single_search, bulk_search = retriever.get_relevant_doc_faiss, retriever.get_relevant_doc_bulk_faiss
+    else:
+        single_search, bulk_search = retriever.get_relevant_doc, retriever.get_relevant_doc_bulk
+
+    questions = dataset["question"]
+    reset_peak_rss()
+    # retriever 내부의 print가 latency에 섞이지 않도록 출력을 버립니다.
+    with contextlib.redirect_stdout(io.StringIO()):
+        single = run_single(single_search, questions[:num_single], k)
+        bulk, doc_indices = run_bulk(bulk_search, questions, k, batch_size)
+
+    quality = rank_metrics(doc_indices, gold, KS)
+    result = {"backend": name, **{key: round(value, 4) for key, value in quality.items()}}
+    result["single"] = {"num_queries": min(num_single, len(questions)), **single}
+    result["bulk"] = bulk
+    result["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    print(json.dumps(result, ensure_ascii=False))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument(
+        "--dataset_name", default="../data/train_dataset", type=str, help=""
+    )
+    parser.add_argument(
+        "--model_name_or_path", default="klue/bert-base", type=str, help="sparse retriever의 tokenizer"
+    )
+    parser.add_argument("--data_path", default="../data", type=str, help="")
+    parser.add_argument(
+        "--context_path", default="wikipedia_documents.json", type=str, help=""
+    )
+    parser.add_argument(
+        "--backends", nargs="+", default=["sparse"], choices=BACKENDS, help=""
+    )
+    parser.add_argument("--dense_encoder", default=None, type=str, help="")
+    parser.add_argument("--num_clusters", default=64, type=int, help="")
+    parser.add_argument("--num_single", default=200, type=int, help="single 모드로 측정할 질문 수")
+    parser.add_argument("--batch_size", default=256, type=int, help="bulk 모드의 batch 크기")
+    parser.add_argument(
+        "--output", default="./outputs/retrieval_benchmark.json", type=str, help=""
+    )
+    args = parser.parse_args()
+
+    org_dataset = load_from_disk(args.dataset_name)
+    dataset = concatenate_datasets(
+        [
+            org_dataset["train"].flatten_indices(),
+            org_dataset["validation"].flatten_indices(),
+        ]
+    )  # train dev 를 합친 4192 개 질문
+
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path, use_fast=True)
+
+    retrievers = {}
+
+    def sparse() -> SparseRetrieval:
+        if "sparse" not in retrievers:
+            retrievers["sparse"] = SparseRetrieval(
+                tokenize_fn=tokenizer.tokenize,
+                data_path=args.data_path,
+                context_path=args.context_path,
+            )
+            retrievers["sparse"].get_sparse_embedding()
+        return retrievers["sparse"]
+
+    def dense() -> DenseRetrieval:
+        assert args.dense_encoder, "dense/hybrid backend에는 --dense_encoder가 필요합니다."
+        if "dense" not in retrievers:
+            retrievers["dense"] = DenseRetrieval(
+                args.dense_encoder,
+                data_path=args.data_path,
+                context_path=args.context_path,
+            )
+            retrievers["dense"].get_dense_embedding()
+        return retrievers["dense"]
+
+    results = []
+    for backend in args.backends:
+        use_faiss = backend.endswith("-faiss")
+        if backend.startswith("hybrid"):
+            retriever = HybridRetrieval(sparse(), dense(), fusion=backend.split("-")[1])
+        else:
+            retriever = sparse() if backend.startswith("sparse") else dense()
+        if use_faiss:
+            retriever.build_faiss(num_clusters=args.num_clusters)
+
+        context_to_id = {context: i for i, context in enumerate(retriever.contexts)}
+        gold = np.array([context_to_id.get(c, -1) for c in dataset["context"]])
+
+        result = benchmark(
+            backend, retriever, use_faiss, dataset, gold, args.num_single, args.batch_size
+        )
+        if use_faiss:
+            result["num_clusters"] = args.num_clusters
+        if backend != "sparse" and not backend.startswith("sparse-"):
+            result["dense_encoder"] = args.dense_encoder
+        results.append(result)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "dataset": args.dataset_name,
+        "num_queries": len(dataset),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    print(f"Saved retrieval benchmark to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+online inference를 위한 micro-batching scheduler 입니다.
+
+동시에 들어온 요청들을 최대 `max_wait_ms` 동안 (혹은 `max_batch_size`개가 찰 때까지) 모아
+한 번의 tokenizer 호출과 한 번의 reader forward로 처리한 뒤, 각 요청에는 자신의 후처리 결과만 돌려줍니다.
+
+부하 테스트 (validation의 정답 context 사용, 요청마다 forward 하는 경우와 비교):
+    python scheduler.py --model_name_or_path ./models/train_dataset --concurrency 32 --num_requests 512
+"""
+
+
+import asyncio
+import concurrent.futures
+import itertools
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+from qa_pipeline import QAPipeline
+
+
+@dataclass
+class _Request:
+    id: str
+    question: str
+    context: str
+    future: asyncio.Future
+    enqueued_at: float
+
+
+class MicroBatchScheduler:
+    def __init__(
+        self,
+        pipeline: QAPipeline,
+        model,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5.0,
+        forward_batch_size: Optional[int] = None,
+    ):
+
+        """
+        Arguments:
+            pipeline:
+                reader의 tokenizer로 만든 QAPipeline 입니다.
+            model:
+                eval 모드의 reader 모델입니다.
+            max_batch_size (int):
+                한 번에 처리할 최대 요청 수입니다. 1이면 요청마다 forward 합니다.
+            max_wait_ms (float):
+                첫 요청이 들어온 뒤 다른 요청을 기다리는 최대 시간입니다.
+            forward_batch_size (Optional[int]):
+                None이면 모인 요청의 모든 feature를 한 번의 forward로 처리합니다.
+                feature가 매우 많아 메모리가 부족할 때만 지정하세요.
+
+        Note:
+            tokenize/forward/postprocess는 하나의 worker thread에서 실행되므로
+            event loop는 그동안에도 새 요청을 계속 받을 수 있습니다.
+        """
+
+        self.pipeline = pipeline
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.forward_batch_size = forward_batch_size
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._ids = itertools.count()
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.ensure_future(self._batch_loop())
+
+    async def stop(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._executor.shutdown(wait=True)
+
+    def run_in_background(self) -> None:
+        # 동기 코드(예: ThreadingHTTPServer의 handler)에서 `submit_threadsafe`로 사용할 수 있도록
+        # 별도 thread에서 event loop를 실행합니다.
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.start(), loop).result()
+
+    def submit_threadsafe(self, question: str, context: str) -> concurrent.futures.Future:
+        assert self._loop is not None, "run_in_background()를 먼저 수행해주세요."
+        return asyncio.run_coroutine_threadsafe(
+            self.submit(question, context), self._loop
+        )
+
+    def submit_sync(self, question: str, context: str) -> Dict:
+        return self.submit_threadsafe(question, context).result()
+
+    async def submit(self, question: str, context: str) -> Dict:
+
+        """
+        Arguments:
+            question (str): 질문
+            context (str): retrieval된 passage(들)을 이어붙인 context
+
+        Returns:
+            {"prediction_text", "nbest", "batch_size", "latency_ms"}:
+            latency_ms에는 queue 대기 시간과, 이 요청이 속한 batch의 tokenize/forward/postprocess 시간이 들어갑니다.
+        """
+
+        assert self._queue is not None, "start()를 먼저 수행해주세요."
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(
+            _Request(
+                id=f"mb-{next(self._ids)}",
+                question=question,
+                context=context,
+                future=future,
+                enqueued_at=time.perf_counter(),
+            )
+        )
+        return await future
+
+    async def _batch_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self._run_batch, batch
+                )
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+
+            for request, result in zip(batch, results):
+                if not request.future.done():
+                    request.future.set_result(result)
+
+    def _run_batch(self, batch: List[_Request]) -> List[Dict]:
+        t0 = time.perf_counter()
+        examples = {
+            "id": [request.id for request in batch],
+            "question": [request.question for request in batch],
+            "context": [request.context for request in batch],
+        }
+        features = self.pipeline.prepare_validation_features(examples)
+        t1 = time.perf_counter()
+
+        num_features = len(features["input_ids"])
+        predictions = self.pipeline.predict(
+            self.model,
+            features,
+            batch_size=self.forward_batch_size or max(num_features, 1),
+        )
+        t2 = time.perf_counter()
+
+        all_predictions, all_nbest = self.pipeline.postprocess(
+            examples, features, predictions, output_dir=None, return_nbest=True, nbest_format="json"
+        )
+        t3 = time.perf_counter()
+
+        batch_latency = {
+            "tokenize": round((t1 - t0) * 1000, 3),
+            "forward": round((t2 - t1) * 1000, 3),
+            "postprocess": round((t3 - t2) * 1000, 3),
+        }
+        return [
+            {
+                "prediction_text": all_predictions[request.id],
+                "nbest": all_nbest[request.id],
+                "batch_size": len(batch),
+                "latency_ms": {
+                    "queue": round((t0 - request.enqueued_at) * 1000, 3),
+                    **batch_latency,
+                },
+            }
+            for request in batch
+        ]
+
+
+async def _load_test(scheduler: MicroBatchScheduler, pairs, concurrency: int) -> Dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(question, context):
+        async with semaphore:
+            t0 = time.perf_counter()
+            await scheduler.submit(question, context)
+            latencies.append(time.perf_counter() - t0)
+
+    await scheduler.start()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(q, c) for q, c in pairs))
+    elapsed = time.perf_counter() - t0
+    await scheduler.stop()
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "requests": len(pairs),
+        "throughput_rps": round(len(pairs) / elapsed, 2),
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(latencies_ms, 95)), 2),
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 2),
+    }
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    import torch
+    from arguments import DataTrainingArguments, ModelArguments
+    from datasets import load_from_disk
+    from inference import load_reader
+    from qa_pipeline import uses_token_type_ids
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("--model_name_or_path", type=str, required=True, help="")
+    parser.add_argument(
+        "--dataset_name", default="../data/train_dataset", type=str, help=""
+    )
+    parser.add_argument("--num_requests", default=256, type=int, help="")
+    parser.add_argument("--concurrency", default=32, type=int, help="")
+    parser.add_argument("--max_batch_size", default=16, type=int, help="")
+    parser.add_argument("--max_wait_ms", default=5.0, type=float, help="")
+
+    args = parser.parse_args()
+
+    tokenizer, model = load_reader(ModelArguments(model_name_or_path=args.model_name_or_path))
+    model.to("cuda" if torch.cuda.is_available() else "cpu")
+    model.eval()
+
+    data_args = DataTrainingArguments()
+    pipeline = QAPipeline(
+        tokenizer,
+        data_args,
+        min(data_args.max_seq_length, tokenizer.model_max_length),
+        ["id", "question", "context"],
+        return_token_type_ids=uses_token_type_ids(model.config),
+    )
+
+    validation = load_from_disk(args.dataset_name)["validation"]
+    pairs = list(zip(validation["question"], validation["context"]))
+    pairs = list(itertools.islice(itertools.cycle(pairs), args.num_requests))
+
+    for name, max_batch_size, max_wait_ms in [
+        ("one forward per request", 1, 0.0),
+        ("micro-batching", args.max_batch_size, args.max_wait_ms),
+    ]:
+        scheduler = MicroBatchScheduler(
+            pipeline, model, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms
+        )
+        report = asyncio.run(_load_test(scheduler, pairs, args.concurrency))
+        print(f"[{name}] max_batch_size={max_batch_size} max_wait_ms={max_wait_ms}")
+        print(report)
@@ -0,0 +1,427 @@
+"""
+retriever와 reader를 한 번만 load해두고 HTTP/JSON으로 질문에 답하는 serving 코드 입니다.
+
+inference.py 와 같은 retrieval, 전처리, 후처리를 사용하지만 매 요청마다 모델을 다시 불러오지 않습니다.
+
+    python serve.py --model_name_or_path ./models/train_dataset --port 8000
+
+    curl -X POST localhost:8000/predict -d '{"question": "대통령을 포함한 미국의 행정부 견제권을 갖는 국가 기관은?"}'
+    curl -X POST localhost:8000/predict -d '{"questions": ["...", "..."], "topk": 5}'
+"""
+
+
+import copy
+import json
+import logging
+import sys
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from arguments import DataTrainingArguments, ModelArguments, ServingArguments
+from cache import AnswerCache
+from inference import build_answer_cache, build_retriever, is_cpu_only_reader, load_reader
+from instrumentation import METRICS, span
+from qa_pipeline import QAPipeline, uses_token_type_ids
+from retrieval import SparseRetrieval
+from scheduler import MicroBatchScheduler
+from transformers import HfArgumentParser
+from utils_qa import select_rows
+
+logger = logging.getLogger(__name__)
+
+
+class ODQAService:
+    def __init__(
+        self,
+        retriever: SparseRetrieval,
+        pipeline: QAPipeline,
+        model,
+        topk: int = 10,
+        batch_size: int = 32,
+        n_best_in_response: int = 5,
+        use_faiss: bool = False,
+        scheduler: Optional[MicroBatchScheduler] = None,
+        answer_cache: Optional[AnswerCache] = None,
+    ):
+
+        """
+        Arguments:
+            retriever:
+                get_sparse_embedding() (use_faiss인 경우 build_faiss()까지)이 끝난 retriever 입니다.
+            pipeline:
+                reader의 tokenizer로 만든 QAPipeline 입니다.
+            model:
+                eval 모드로 사용할 reader 모델입니다.
+            topk:
+                요청에 topk가 없을 때 사용할 passage 수입니다.
+            scheduler:
+                주어지면 reader 단계를 동시에 들어온 다른 요청들과 micro-batch로 묶어 처리합니다.
+            answer_cache:
+                주어지면 같은 question과 passage로 이미 답한 요청은 reader를 거치지 않고 cache에서 답합니다.
+
+        Summary:
+            질문(들)을 받아 retrieve -> tokenize -> forward -> postprocess 를 수행하고
+            단계별 소요 시간을 함께 반환합니다.
+        """
+
+        self.retriever = retriever
+        self.pipeline = pipeline
+        self.model = model
+        self.topk = topk
+        self.batch_size = batch_size
+        self.n_best_in_response = n_best_in_response
+        self.use_faiss = use_faiss
+        self.scheduler = scheduler
+        self.answer_cache = answer_cache
+
+        # 하나의 모델을 여러 thread가 동시에 forward 하지 않도록 막습니다. (request 수도 함께 보호합니다.)
+        self._lock = threading.Lock()
+        # fast tokenizer는 호출마다 truncation 설정을 바꾸므로 여러 thread가 동시에 tokenize하지 않게 합니다.
+        self._tokenize_lock = threading.Lock()
+        self._num_requests = 0
+
+    def _retrieve(self, questions: List[str], topk: int) -> Tuple[List, List, List[str]]:
+        if self.use_faiss:
+            doc_scores, doc_indices = self.retriever.get_relevant_doc_bulk_faiss(
+                questions, k=topk
+            )
+        else:
+            doc_scores, doc_indices = self.retriever.get_relevant_doc_bulk(
+                questions, k=topk
+            )
+        contexts = [
+            " ".join(self.retriever.contexts[pid] for pid in indices)
+            for indices in doc_indices
+        ]
+        return doc_scores, doc_indices, contexts
+
+    def answer(self, questions: List[str], topk: Optional[int] = None) -> Dict:
+        topk = self.topk if topk is None else topk
+        if self.scheduler is not None:
+            return self._answer_micro_batched(questions, topk)
+
+        latency = {}
+        with self._lock:
+            request_id = self._num_requests
+            self._num_requests += 1
+
+        t0 = time.perf_counter()
+        doc_scores, doc_indices, contexts = self._retrieve(questions, topk)
+        examples = {
+            "id": [f"request-{request_id}-{i}" for i in range(len(questions))],
+            "question": questions,
+            "context": contexts,
+            "context_id": doc_indices,
+        }
+        t1 = time.perf_counter()
+        latency["retrieve"] = t1 - t0
+
+        cached, missing = self._lookup_answers(examples)
+        reader_examples = select_rows(examples, missing)
+        t2 = time.perf_counter()
+        latency["answer_cache"] = t2 - t1
+
+        all_predictions, all_nbest, num_features = {}, {}, 0
+        if missing:
+            with self._tokenize_lock:
+                features = self.pipeline.prepare_validation_features(reader_examples)
+            num_features = len(features["input_ids"])
+            t3 = time.perf_counter()
+            latency["tokenize"] = t3 - t2
+
+            # 모델 forward만 한 번에 하나씩 실행하고, retrieval과 후처리는 다른 요청과 동시에 진행합니다.
+            with self._lock:
+                t_forward = time.perf_counter()
+                latency["queue"] = t_forward - t3
+                predictions = self.pipeline.predict(
+                    self.model, features, batch_size=self.batch_size
+                )
+            t4 = time.perf_counter()
+            latency["forward"] = t4 - t_forward
+
+            all_predictions, all_nbest = self.pipeline.postprocess(
+                reader_examples,
+                features,
+                predictions,
+                output_dir=None,
+                return_nbest=True,
+                # 응답과 answer cache에는 JSON 형식의 n-best만 사용합니다.
+                nbest_format="json",
+            )
+            latency["postprocess"] = time.perf_counter() - t4
+            if self.answer_cache is not None:
+                self.answer_cache.store(reader_examples, all_predictions, all_nbest)
+
+        for i, (prediction, nbest) in cached.items():
+            all_predictions[examples["id"][i]] = prediction
+            all_nbest[examples["id"][i]] = nbest
+
+        answers = []
+        for i, id_ in enumerate(examples["id"]):
+            answers.append(
+                {
+                    "question": questions[i],
+                    "answer": all_predictions[id_],
+                    "nbest": all_nbest[id_][: self.n_best_in_response],
+                    "context_ids": doc_indices[i],
+                    "context_scores": [float(score) for score in doc_scores[i]],
+                    "cached": i in cached,
+                }
+            )
+
+        return {
+            "answers": answers,
+            "num_features": num_features,
+            "latency_ms": {k: round(v * 1000, 3) for k, v in latency.items()},
+        }
+
+    def _lookup_answers(self, examples: Dict) -> Tuple[Dict, List[int]]:
+        if self.answer_cache is None:
+            return {}, list(range(len(examples["id"])))
+        return self.answer_cache.lookup(examples)
+
+    def _answer_micro_batched(self, questions: List[str], topk: int) -> Dict:
+        # reader 단계는 scheduler가 다른 요청들과 묶어서 처리합니다.
+        # 단계별 latency는 각 질문이 속한 batch 기준이며, 여러 질문 중 가장 오래 걸린 값을 보고합니다.
+        with self._lock:
+            self._num_requests += 1
+
+        t0 = time.perf_counter()
+        doc_scores, doc_indices, contexts = self._retrieve(questions, topk)
+        retrieve_ms = round((time.perf_counter() - t0) * 1000, 3)
+
+        examples = {
+            "id": [str(i) for i in range(len(questions))],
+            "question": questions,
+            "context": contexts,
+            "context_id": doc_indices,
+        }
+        cached, missing = self._lookup_answers(examples)
+
+        futures = {
+            i: self.scheduler.submit_threadsafe(questions[i], contexts[i])
+            for i in missing
+        }
+        results = {i: future.result() for i, future in futures.items()}
+        if self.answer_cache is not None and results:
+            self.answer_cache.store(
+                select_rows(examples, missing),
+                {str(i): results[i]["prediction_text"] for i in missing},
+                {str(i): results[i]["nbest"] for i in missing},
+            )
+
+        latency_ms = {"retrieve": retrieve_ms}
+        for stage in ("queue", "tokenize", "forward", "postprocess"):
+            latency_ms[stage] = max(
+                (result["latency_ms"][stage] for result in results.values()), default=0.0
+            )
+
+        answers = []
+        for i, (question, indices, scores) in enumerate(
+            zip(questions, doc_indices, doc_scores)
+        ):
+            if i in cached:
+                prediction, nbest = cached[i]
+                batch_size = 0
+            else:
+                prediction, nbest = results[i]["prediction_text"], results[i]["nbest"]
+                batch_size = results[i]["batch_size"]
+            answers.append(
+                {
+                    "question": question,
+                    "answer": prediction,
+                    "nbest": nbest[: self.n_best_in_response],
+                    "context_ids": indices,
+                    "context_scores": [float(score) for score in scores],
+                    "batch_size": batch_size,
+                    "cached": i in cached,
+                }
+            )
+        return {"answers": answers, "latency_ms": latency_ms}
+
+    def stats(self) -> Dict:
+        stats = {"requests": self._num_requests}
+        if self.retriever.cache is not None:
+            stats["retrieval_cache"] = self.retriever.cache.stats()
+        if self.answer_cache is not None:
+            stats["answer_cache"] = self.answer_cache.stats()
+        return stats
+
+
+def make_handler(service: ODQAService):
+    class ODQARequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(HTTPStatus.OK, {"status": "ok"})
+            elif self.path == "/stats":
+                self._send_json(HTTPStatus.OK, service.stats())
+            elif self.path == "/metrics":
+                self._send_text(HTTPStatus.OK, METRICS.prometheus_text())
+            else:
+                self._send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+                return
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(body, dict):
+                    raise ValueError("request body는 JSON object여야 합니다.")
+                if "questions" in body:
+                    questions = body["questions"]
+                elif "question" in body:
+                    questions = [body["question"]]
+                else:
+                    raise ValueError('"question" 혹은 "questions"가 필요합니다.')
+                # 문자열을 list로 받으면 글자 단위로 나뉘므로 list인지 먼저 확인합니다.
+                if (
+                    not isinstance(questions, list)
+                    or not questions
+                    or not all(isinstance(q, str) and q for q in questions)
+                ):
+                    raise ValueError('"questions"는 비어있지 않은 문자열의 list여야 합니다.')
+                topk = body.get("topk")
+                # bool은 int의 subclass이므로 따로 제외합니다.
+                if topk is not None and (
+                    not isinstance(topk, int) or isinstance(topk, bool) or topk <= 0
+                ):
+                    raise ValueError('"topk"는 양의 정수여야 합니다.')
+            except ValueError as e:
+                # json.JSONDecodeError도 ValueError 입니다.
+                self._send_json(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+                return
+
+            t0 = time.perf_counter()
+            METRICS.count("serve.requests")
+            try:
+                with span("serve.predict"):
+                    response = service.answer(questions, topk=topk)
+            except AssertionError as e:
+                # vocab에 없는 단어로만 이루어진 query는 retriever에서 assertion이 발생합니다.
+                self._send_json(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+                return
+            except Exception as e:
+                # reader 등에서 발생한 오류도 빈 응답 대신 JSON으로 돌려줍니다.
+                logger.exception("Failed to answer %d questions", len(questions))
+                METRICS.count("serve.errors")
+                self._send_json(
+                    HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"{type(e).__name__}: {e}"}
+                )
+                return
+            response["latency_ms"]["total"] = round(
+                (time.perf_counter() - t0) * 1000, 3
+            )
+            self._send_json(HTTPStatus.OK, response)
+
+        def _send_json(self, status: HTTPStatus, payload: Dict):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self._send(status, data, "application/json; charset=utf-8")
+
+        def _send_text(self, status: HTTPStatus, text: str):
+            # Prometheus text exposition format
+            self._send(status, text.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+
+        def _send(self, status: HTTPStatus, data: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.info("%s - %s", self.address_string(), format % args)
+
+    return ODQARequestHandler
+
+
+def build_service(
+    model_args: ModelArguments,
+    data_args: DataTrainingArguments,
+    serving_args: ServingArguments,
+    data_path: str = "../data",
+    context_path: str = "wikipedia_documents.json",
+) -> ODQAService:
+    tokenizer, model = load_reader(model_args)
+
+    device = serving_args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    if is_cpu_only_reader(model_args):
+        if serving_args.device not in (None, "cpu"):
+            raise ValueError("reader_quantization/exported_reader는 CPU에서만 실행할 수 있습니다.")
+        device = "cpu"
+    model.to(device)
+    model.eval()
+
+    # 요청 thread들이 retrieval과 reader 전처리를 동시에 하므로, retriever에는 reader와 상태를 공유하지 않는 tokenizer를 줍니다.
+    retriever = build_retriever(
+        copy.deepcopy(tokenizer).tokenize, data_args, data_path=data_path, context_path=context_path
+    )
+
+    pipeline = QAPipeline(
+        tokenizer,
+        data_args,
+        min(data_args.max_seq_length, tokenizer.model_max_length),
+        ["id", "question", "context"],
+        return_token_type_ids=uses_token_type_ids(model.config),
+    )
+
+    scheduler = None
+    if serving_args.micro_batching:
+        scheduler = MicroBatchScheduler(
+            pipeline,
+            model,
+            max_batch_size=serving_args.max_batch_size,
+            max_wait_ms=serving_args.max_batch_wait_ms,
+        )
+        scheduler.run_in_background()
+
+    return ODQAService(
+        retriever,
+        pipeline,
+        model,
+        topk=data_args.top_k_retrieval,
+        batch_size=serving_args.batch_size,
+        n_best_in_response=serving_args.n_best_in_response,
+        use_faiss=data_args.use_faiss,
+        scheduler=scheduler,
+        answer_cache=build_answer_cache(model_args, data_args, pipeline.max_seq_length),
+    )
+
+
+def main():
+    parser = HfArgumentParser((ModelArguments, DataTrainingArguments, ServingArguments))
+    model_args, data_args, serving_args = parser.parse_args_into_dataclasses()
+
+    # logging 설정
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+    )
+
+    service = build_service(model_args, data_args, serving_args)
+
+    server = ThreadingHTTPServer(
+        (serving_args.host, serving_args.port), make_handler(service)
+    )
+    print(f"Serving ODQA on http://{serving_args.host}:{serving_args.port}/predict")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.retriever.save_cache()
+        if service.answer_cache is not None:
+            service.answer_cache.save()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+retrieve한 validation/test 질문을 여러 process로 나누어 CPU에서 reader를 실행하는 inference launcher 입니다.
+
+inference.py 는 한 process에서 reader를 실행하므로 torch intra-op thread만으로는 core 수에 비례해 빨라지지 않습니다.
+launcher는 retrieval을 한 번만 한 뒤 질문을 `--num_workers`개의 연속된 shard로 나누고,
+각 worker process가 `--threads_per_worker`개의 torch thread로 reader를 불러와 자기 shard의 전처리, 예측, 후처리를 수행합니다.
+결과는 worker가 끝나는 순서와 관계없이 원래 질문 순서대로 합쳐 predictions.json / nbest_predictions.json 으로 저장합니다.
+
+    python sharded_inference.py --output_dir ./outputs/test_dataset/ --dataset_name ../data/test_dataset/ \
+        --model_name_or_path ./models/train_dataset/ --do_predict --num_workers 4 --threads_per_worker 4
+"""
+
+
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import torch
+from arguments import DataTrainingArguments, ModelArguments, ShardedInferenceArguments
+from datasets import load_from_disk, load_metric
+from early_exit import EarlyExitReader
+from inference import build_window_filter, load_reader, run_sparse_retrieval
+from qa_pipeline import QAPipeline, uses_token_type_ids
+from transformers import AutoTokenizer, HfArgumentParser, TrainingArguments, set_seed
+from utils_qa import save_predictions
+
+logger = logging.getLogger(__name__)
+
+
+def shard_bounds(num_examples: int, num_shards: int) -> List[Tuple[int, int]]:
+    # 앞쪽 shard부터 하나씩 더 가지도록 [start, end) 범위를 나눕니다.
+    size, rest = divmod(num_examples, num_shards)
+    bounds, start = [], 0
+    for i in range(num_shards):
+        end = start + size + (i < rest)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def predict_shard(
+    examples: Dict[str, list],
+    model_args: ModelArguments,
+    data_args: DataTrainingArguments,
+    batch_size: int,
+    num_threads: int,
+) -> Tuple[Dict[str, str], Dict[str, list], Dict[str, float]]:
+
+    """
+    worker process에서 실행됩니다.
+
+    Arguments:
+        examples: id, question, context (eval인 경우 answers까지) column을 가진 shard
+        num_threads: 이 worker가 사용할 torch intra-op thread 수
+
+    Returns:
+        (predictions, nbest predictions, 단계별 소요 시간(초))
+    """
+
+    torch.set_num_threads(num_threads)
+    timings = {}
+
+    t0 = time.perf_counter()
+    tokenizer, model = load_reader(model_args)
+    model.eval()
+    pipeline = QAPipeline(
+        tokenizer,
+        data_args,
+        min(data_args.max_seq_length, tokenizer.model_max_length),
+        list(examples),
+        return_token_type_ids=uses_token_type_ids(model.config),
+    )
+    window_filter = build_window_filter(tokenizer, data_args)
+    if window_filter is not None:
+        pipeline.register_hook("windows", window_filter.windows_hook)
+    if model_args.early_exit_heads is not None:
+        early_exit = EarlyExitReader.load(
+            model_args.early_exit_heads, model, tokenizer, model_args.early_exit_threshold
+        )
+        pipeline.register_hook("predict", early_exit.predict_hook)
+    timings["load_reader"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    features = pipeline.prepare_validation_features(examples)
+    timings["features"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    predictions = pipeline.predict(model, features, batch_size=batch_size)
+    timings["reader"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    all_predictions, all_nbest = pipeline.postprocess(
+        examples, features, predictions, output_dir=None, return_nbest=True
+    )
+    timings["postprocess"] = time.perf_counter() - t0
+    return all_predictions, all_nbest, timings
+
+
+def main():
+    parser = HfArgumentParser(
+        (ModelArguments, DataTrainingArguments, TrainingArguments, ShardedInferenceArguments)
+    )
+    model_args, data_args, training_args, shard_args = parser.parse_args_into_dataclasses()
+
+    # logging 설정
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+    )
+    set_seed(training_args.seed)
+
+    # worker들이 나누어 가질 수 없는 옵션은 무시하지 않고 바로 알립니다.
+    if data_args.answer_cache_size > 0:
+        raise ValueError("answer_cache_size는 sharded inference에서 지원하지 않습니다.")
+    if data_args.profile:
+        raise ValueError("profile은 sharded inference에서 지원하지 않습니다. worker process는 profiling되지 않습니다.")
+
+    # retrieval은 launcher에서 한 번만 하고, worker에는 retrieve된 context만 넘깁니다.
+    datasets = load_from_disk(data_args.dataset_name)
+    if data_args.eval_retrieval:
+        tokenizer = AutoTokenizer.from_pretrained(
+            model_args.tokenizer_name
+            if model_args.tokenizer_name
+            else model_args.model_name_or_path,
+            use_fast=True,
+        )
+        datasets = run_sparse_retrieval(
+            tokenizer.tokenize, datasets, training_args, data_args,
+        )
+    validation = datasets["validation"]
+    has_answers = "answers" in validation.column_names
+    columns = ["id", "question", "context"] + (["answers"] if has_answers else [])
+
+    num_shards = max(1, min(shard_args.num_workers, len(validation)))
+    num_threads = shard_args.threads_per_worker or max(1, (os.cpu_count() or 1) // num_shards)
+    shards = []
+    for start, end in shard_bounds(len(validation), num_shards):
+        rows = validation[start:end]
+        shards.append({k: rows[k] for k in columns})
+
+    # worker마다 tokenizers thread pool까지 만들면 core 수보다 thread가 많아집니다.
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    print(f"{len(validation)} questions -> {num_shards} workers x {num_threads} torch threads")
+
+    t0 = time.perf_counter()
+    # fork한 process에서 torch thread pool을 다시 쓰면 멈출 수 있으므로 spawn으로 새 process를 띄웁니다.
+    with multiprocessing.get_context("spawn").Pool(num_shards) as pool:
+        results = pool.starmap(
+            predict_shard,
+            [
+                (shard, model_args, data_args, training_args.per_device_eval_batch_size, num_threads)
+                for shard in shards
+            ],
+        )
+    elapsed = time.perf_counter() - t0
+
+    # starmap은 shard 순서대로 결과를 돌려주고 shard는 연속된 구간이므로, 합친 결과는 원래 질문 순서와 같습니다.
+    all_predictions, all_nbest = OrderedDict(), OrderedDict()
+    for shard_index, (predictions, nbest, timings) in enumerate(results):
+        all_predictions.update(predictions)
+        all_nbest.update(nbest)
+        print(
+            f"shard {shard_index}: {len(predictions)} questions, "
+            + ", ".join(f"{k} {v:.3f} s" for k, v in timings.items())
+        )
+    logger.info(
+        f"Sharded inference over {len(validation)} questions done in {elapsed:.3f} s "
+        f"({len(validation) / max(elapsed, 1e-9):.2f} questions/s)"
+    )
+
+    os.makedirs(training_args.output_dir, exist_ok=True)
+    save_predictions(
+        all_predictions, all_nbest, training_args.output_dir, nbest_format=data_args.nbest_format
+    )
+
+    if training_args.do_eval and has_answers:
+        metrics = load_metric("squad").compute(
+            predictions=[{"id": k, "prediction_text": v} for k, v in all_predictions.items()],
+            references=[
+                {"id": id_, "answers": answers}
+                for id_, answers in zip(validation["id"], validation["answers"])
+            ],
+        )
+        print(f"***** test metrics *****\n{metrics}")
+    else:
+        print(
+            "No metric can be presented because there is no correct answer given. Job done!"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+window_planner.plan_windows 의 경계 조건 테스트 입니다.
+
+    pytest test_window_planner.py
+"""
+
+
+import numpy as np
+from window_planner import plan_windows
+
+
+def covers(windows, num_tokens):
+    # window가 context 처음부터 끝까지 빠짐없이 이어지고 비어 있지 않은지 확인합니다.
+    assert windows[0][0] == 0
+    assert windows[-1][1] == num_tokens
+    for (start, end), (next_start, _) in zip(windows, windows[1:]):
+        assert start < end
+        assert next_start <= end
+
+
+def test_budget_one():
+    windows = plan_windows(5, np.array([1, 2, 3]), budget=1, overlap=3)
+    assert windows == [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5)]
+
+
+def test_budget_two():
+    windows = plan_windows(5, np.array([2]), budget=2, overlap=3)
+    assert windows == [(0, 2), (2, 4), (3, 5)]
+    covers(windows, 5)
+
+
+def test_no_boundaries():
+    windows = plan_windows(10, np.array([], dtype=np.int64), budget=4, overlap=1)
+    assert windows == [(0, 4), (3, 7), (6, 10)]
+
+
+def test_boundary_at_start():
+    # 다음 window의 start와 같은 경계에서는 자르지 않고 budget만큼 진행합니다.
+    windows = plan_windows(6, np.array([0, 3]), budget=1, overlap=0)
+    assert windows == [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (5, 6)]
+    windows = plan_windows(10, np.array([0, 4]), budget=4, overlap=1)
+    assert windows == [(0, 4), (4, 8), (7, 10)]
+
+
+def test_fits_in_one_window():
+    assert plan_windows(3, np.array([1]), budget=4, overlap=1) == [(0, 3)]
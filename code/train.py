@@ -4,7 +4,7 @@ import sys
 from typing import NoReturn
 
 from arguments import DataTrainingArguments, ModelArguments
-from datasets import DatasetDict, load_from_disk, load_metric, Dataset
+from datasets import DatasetDict, load_from_disk, Dataset
 import pyarrow as pa
 import pyarrow.dataset as ds
 import pandas as pd
@@ -19,102 +19,17 @@ from transformers import (
     TrainingArguments,
     set_seed
 )
-from utils_qa import check_no_error, postprocess_qa_predictions
+from distillation import DistillationTrainer, add_feature_index, precompute_teacher_logits
+from inference import load_reader
+from model import Model
+from qa_pipeline import QAPipeline, uses_token_type_ids
+from profiling import profile_stage
+from utils_qa import check_no_error
 from retrieval import SparseRetrieval
-from transformers.models.roberta.modeling_roberta import RobertaModel, RobertaPreTrainedModel
 import json
-import torch
-import torch.nn as nn
 
 logger = logging.getLogger(__name__)
 
-class Model(RobertaPreTrainedModel):
-    def __init__(self, config):
-        super().__init__(config)
-        self.num_labels = config.num_labels
-
-        self.roberta = RobertaModel(config, add_pooling_layer=False)
-        self.qa_outputs = nn.Linear(config.hidden_size, config.num_labels)
-        self.conv1 = nn.Conv1d(
-            in_channels=config.hidden_size,
-            out_channels=config.hidden_size*2,
-            kernel_size=3,
-            padding=1
-        )
-        self.conv2 = nn.Conv1d(
-            in_channels=config.hidden_size*2,
-            out_channels=config.hidden_size,
-            kernel_size=1,
-        )
-        self.layer_norm = nn.LayerNorm(config.hidden_size)
-        self.init_weights()
-
-    def forward(
-        self,
-        input_ids=None,
-        attention_mask=None,
-        token_type_ids=None,
-        position_ids=None,
-        head_mask=None,
-        inputs_embeds=None,
-        start_positions=None,
-        end_positions=None,
-        output_attentions=None,
-        output_hidden_states=None,
-        return_dict=None,
-    ):
-
-        outputs = self.roberta(
-            input_ids,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
-
-        sequence_output = outputs[0]
-        sequence_output = sequence_output.permute(0,2,1)
-
-        for _ in range(5):
-            out = self.conv1(sequence_output)
-            out = self.conv2(out)
-            out = sequence_output + torch.relu(out)
-            sequence_output = self.layer_norm(out)
-
-        logits = self.qa_outputs(sequence_output)
-        start_logits, end_logits = logits.split(1, dim=-1)
-        start_logits = start_logits.squeeze(-1)
-        end_logits = end_logits.squeeze(-1)
-
-        total_loss = None
-        if start_positions is not None and end_positions is not None:
-            # If we are on multi-GPU, split add a dimension
-            if len(start_positions.size()) > 1:
-                start_positions = start_positions.squeeze(-1)
-            if len(end_positions.size()) > 1:
-                end_positions = end_positions.squeeze(-1)
-            # sometimes the start/end positions are outside our model inputs, we ignore these terms
-            ignored_index = start_logits.size(1)
-            start_positions.clamp_(0, ignored_index)
-            end_positions.clamp_(0, ignored_index)
-
-            loss_fct = CrossEntropyLoss(ignore_index=ignored_index)
-            start_loss = loss_fct(start_logits, start_positions)
-            end_loss = loss_fct(end_logits, end_positions)
-            total_loss = (start_loss + end_loss) / 2
-
-   
-        return QuestionAnsweringModelOutput(
-            loss=total_loss,
-            start_logits=start_logits,
-            end_logits=end_logits,
-            hidden_states=outputs.hidden_states,
-            attentions=outputs.attentions,
-        )
 
 def main():
     # 가능한 arguments 들은 ./arguments.py 나 transformer package 안의 src/transformers/training_args.py 에서 확인 가능합니다.
@@ -185,6 +100,7 @@ def main():
         use_fast=True,
     )
 
+    config.head_gradient_checkpointing = model_args.head_gradient_checkpointing
     model = Model(config=config)
     # model = AutoModelForQuestionAnswering.from_pretrained(
     #     model_args.model_name_or_path,
@@ -212,177 +128,60 @@ def run_mrc(
         column_names = datasets["train"].column_names # ['title', 'context', 'question', 'id', 'answers', 'document_id', '__index_level_0__']
     else:
         column_names = datasets["validation"].column_names # ['title', 'context', 'question', 'id', 'answers', 'document_id', '__index_level_0__']
-    
-    question_column_name = "question" if "question" in column_names else column_names[0] # 'question'
-    context_column_name = "context" if "context" in column_names else column_names[1] # 'context'
-    answer_column_name = "answers" if "answers" in column_names else column_names[2] # 'answer'
-    
-    # Padding에 대한 옵션을 설정합니다.
-    # (question|context) 혹은 (context|question)로 세팅 가능합니다.
-    pad_on_right = tokenizer.padding_side == "right" # True
-    
+
     # 오류가 있는지 확인합니다.
     last_checkpoint, max_seq_length = check_no_error(
         data_args, training_args, datasets, tokenizer
     )
-    # None
-    # max_seq_length
-
-    # Train preprocessing / 전처리를 진행합니다.
-    def prepare_train_features(examples):
-        # truncation과 padding(length가 짧을때만)을 통해 toknization을 진행하며, stride를 이용하여 overflow를 유지합니다.
-        # 각 example들은 이전의 context와 조금씩 겹치게됩니다.
-        tokenized_examples = tokenizer(
-            examples[question_column_name if pad_on_right else context_column_name],
-            examples[context_column_name if pad_on_right else question_column_name],
-            truncation="only_second" if pad_on_right else "only_first",
-            max_length=max_seq_length,
-            stride=data_args.doc_stride,
-            return_overflowing_tokens=True,
-            return_offsets_mapping=True,
-            return_token_type_ids=False, # roberta모델을 사용할 경우 False, bert를 사용할 경우 True로 표기해야합니다.
-            padding="max_length" if data_args.pad_to_max_length else False,
-        )
 
-        # 길이가 긴 context가 등장할 경우 truncate를 진행해야하므로, 해당 데이터셋을 찾을 수 있도록 mapping 가능한 값이 필요합니다.
-        sample_mapping = tokenized_examples.pop("overflow_to_sample_mapping")
-        # token의 캐릭터 단위 position를 찾을 수 있도록 offset mapping을 사용합니다.
-        # start_positions과 end_positions을 찾는데 도움을 줄 수 있습니다.
-        offset_mapping = tokenized_examples.pop("offset_mapping")
-
-        # 데이터셋에 "start position", "enc position" label을 부여합니다.
-        tokenized_examples["start_positions"] = []
-        tokenized_examples["end_positions"] = []
-
-        for i, offsets in enumerate(offset_mapping):
-            input_ids = tokenized_examples["input_ids"][i]
-            cls_index = input_ids.index(tokenizer.cls_token_id)  # cls index
-
-            # sequence id를 설정합니다 (to know what is the context and what is the question).
-            sequence_ids = tokenized_examples.sequence_ids(i)
-
-            # 하나의 example이 여러개의 span을 가질 수 있습니다.
-            sample_index = sample_mapping[i]
-            answers = examples[answer_column_name][sample_index]
-
-            # answer가 없을 경우 cls_index를 answer로 설정합니다(== example에서 정답이 없는 경우 존재할 수 있음).
-            if len(answers["answer_start"]) == 0:
-                tokenized_examples["start_positions"].append(cls_index)
-                tokenized_examples["end_positions"].append(cls_index)
-            else:
-                # text에서 정답의 Start/end character index
-                start_char = answers["answer_start"][0]
-                end_char = start_char + len(answers["text"][0])
-
-                # text에서 current span의 Start token index
-                token_start_index = 0
-                while sequence_ids[token_start_index] != (1 if pad_on_right else 0):
-                    token_start_index += 1
-
-                # text에서 current span의 End token index
-                token_end_index = len(input_ids) - 1
-                while sequence_ids[token_end_index] != (1 if pad_on_right else 0):
-                    token_end_index -= 1
-
-                # 정답이 span을 벗어났는지 확인합니다(정답이 없는 경우 CLS index로 label되어있음).
-                if not (
-                    offsets[token_start_index][0] <= start_char
-                    and offsets[token_end_index][1] >= end_char
-                ):
-                    tokenized_examples["start_positions"].append(cls_index)
-                    tokenized_examples["end_positions"].append(cls_index)
-                else:
-                    # token_start_index 및 token_end_index를 answer의 끝으로 이동합니다.
-                    # Note: answer가 마지막 단어인 경우 last offset을 따라갈 수 있습니다(edge case).
-                    while (
-                        token_start_index < len(offsets)
-                        and offsets[token_start_index][0] <= start_char
-                    ):
-                        token_start_index += 1
-                    tokenized_examples["start_positions"].append(token_start_index - 1)
-                    while offsets[token_end_index][1] >= end_char:
-                        token_end_index -= 1
-                    tokenized_examples["end_positions"].append(token_end_index + 1)
-        '''
-        print(tokenizer.decode(tokenized_examples['input_ids']))
-        print(tokenized_examples['attention_mask'])
-        print(tokenized_examples['token_type_ids'])
-        print(tokenized_examples['start_positions'])
-        print(tokenized_examples['end_positions'])
-        '''
-        return tokenized_examples
-    
-    if training_args.do_train:
-        if "train" not in datasets:
-            raise ValueError("--do_train requires a train dataset")
-        train_dataset = datasets["train"]
-
-        # dataset에서 train feature를 생성합니다.
-        train_dataset = train_dataset.map(
-            prepare_train_features,
-            batched=True,
-            num_proc=data_args.preprocessing_num_workers,
-            remove_columns=column_names,
-            load_from_cache_file=not data_args.overwrite_cache,
-        )
+    # 전처리/후처리는 inference.py와 같은 pipeline을 사용합니다.
+    pipeline = QAPipeline(
+        tokenizer,
+        data_args,
+        max_seq_length,
+        column_names,
+        return_token_type_ids=uses_token_type_ids(model.config),
+    )
 
-    # Validation preprocessing
-    def prepare_validation_features(examples):
-        # truncation과 padding(length가 짧을때만)을 통해 toknization을 진행하며, stride를 이용하여 overflow를 유지합니다.
-        # 각 example들은 이전의 context와 조금씩 겹치게됩니다.
-        tokenized_examples = tokenizer(
-            examples[question_column_name if pad_on_right else context_column_name],
-            examples[context_column_name if pad_on_right else question_column_name],
-            truncation="only_second" if pad_on_right else "only_first",
-            max_length=max_seq_length,
-            stride=data_args.doc_stride,
-            return_overflowing_tokens=True,
-            return_offsets_mapping=True,
-            return_token_type_ids=False, # roberta모델을 사용할 경우 False, bert를 사용할 경우 True로 표기해야합니다.
-            padding="max_length" if data_args.pad_to_max_length else False,
+    with profile_stage(
+        "features",
+        training_args.output_dir,
+        enabled=data_args.profile,
+        top_n=data_args.profile_top_n,
+    ):
+        if training_args.do_train:
+            if "train" not in datasets:
+                raise ValueError("--do_train requires a train dataset")
+            train_dataset = pipeline.train_features(datasets["train"])
+
+        if training_args.do_eval:
+            eval_dataset = pipeline.validation_features(datasets["validation"])
+
+    # distillation: teacher logits은 train feature에 대해 한 번만 계산해 저장하고, 이후에는 파일에서 읽습니다.
+    trainer_cls, trainer_kwargs = QuestionAnsweringTrainer, {}
+    if training_args.do_train and model_args.teacher_model_name_or_path is not None:
+        teacher_tokenizer, teacher = load_reader(
+            ModelArguments(model_name_or_path=model_args.teacher_model_name_or_path)
         )
-
-        # 길이가 긴 context가 등장할 경우 truncate를 진행해야하므로, 해당 데이터셋을 찾을 수 있도록 mapping 가능한 값이 필요합니다.
-        sample_mapping = tokenized_examples.pop("overflow_to_sample_mapping")
-
-        # evaluation을 위해, prediction을 context의 substring으로 변환해야합니다.
-        # corresponding example_id를 유지하고 offset mappings을 저장해야합니다.
-        tokenized_examples["example_id"] = []
-
-        for i in range(len(tokenized_examples["input_ids"])):
-            # sequence id를 설정합니다 (to know what is the context and what is the question).
-            sequence_ids = tokenized_examples.sequence_ids(i)
-            context_index = 1 if pad_on_right else 0
-
-            # 하나의 example이 여러개의 span을 가질 수 있습니다.
-            sample_index = sample_mapping[i]
-            tokenized_examples["example_id"].append(examples["id"][sample_index])
-
-            # Set to None the offset_mapping을 None으로 설정해서 token position이 context의 일부인지 쉽게 판별 할 수 있습니다.
-            tokenized_examples["offset_mapping"][i] = [
-                (o if sequence_ids[k] == context_index else None)
-                for k, o in enumerate(tokenized_examples["offset_mapping"][i])
-            ]
-
-        '''
-        print(tokenizer.decode(tokenized_examples['input_ids']))
-        print(tokenized_examples['attention_mask'])
-        print(tokenized_examples['token_type_ids'])
-        print(tokenized_examples['example_id'])
-        print(tokenized_examples['offset_mapping'])
-        '''
-        return tokenized_examples
-
-    if training_args.do_eval:
-        eval_dataset = datasets["validation"]
-
-        # Validation Feature 생성
-        eval_dataset = eval_dataset.map(
-            prepare_validation_features,
-            batched=True,
-            num_proc=data_args.preprocessing_num_workers,
-            remove_columns=column_names,
-            load_from_cache_file=not data_args.overwrite_cache,
+        if teacher_tokenizer.get_vocab() != tokenizer.get_vocab():
+            raise ValueError("teacher와 student는 같은 tokenizer를 사용해야 합니다.")
+        teacher_logits = precompute_teacher_logits(
+            teacher.to(training_args.device),
+            tokenizer,
+            train_dataset,
+            model_args.teacher_logits_dir
+            or os.path.join(training_args.output_dir, "teacher_logits"),
+            model_args.teacher_model_name_or_path,
+            batch_size=training_args.per_device_eval_batch_size,
+            return_token_type_ids=uses_token_type_ids(teacher.config),
+        )
+        del teacher
+        train_dataset = add_feature_index(train_dataset)
+        trainer_cls = DistillationTrainer
+        trainer_kwargs = dict(
+            teacher_logits=teacher_logits,
+            alpha=model_args.distill_alpha,
+            temperature=model_args.distill_temperature,
         )
 
     # Data collator
@@ -402,70 +201,9 @@ def run_mrc(
                                                               max_length=None, 
                                                               pad_to_multiple_of=None)
     '''
-    
-    # Post-processing:
-    def post_processing_function(examples, features, predictions, training_args):
-        '''
-        <<EXCUTION ONLY WHEN do_eval or do_predict>>
-
-        Dataset({
-            features: ['__index_level_0__', 'answers', 'context', 'document_id', 'id', 'question', 'title'],
-            num_rows: 240
-        })
-        Dataset({
-            features: ['attention_mask', 'example_id', 'input_ids', 'offset_mapping', 'token_type_ids'],
-            num_rows: 474
-        })
-        (array, array, dtype) -> array.shape : (features_num_rows, max_seq_length)
-        '''
-       
-        # Post-processing: start logits과 end logits을 original context의 정답과 match시킵니다.
-        predictions = postprocess_qa_predictions(
-            examples=examples,
-            features=features,
-            predictions=predictions,
-            max_answer_length=data_args.max_answer_length,
-            output_dir=training_args.output_dir,
-        )
-        # Metric을 구할 수 있도록 Format을 맞춰줍니다.
-        formatted_predictions = [
-            {"id": k, "prediction_text": v} for k, v in predictions.items()
-        ]
-        if training_args.do_predict:
-            '''
-            formatted_predictions : [{'id': 'mrc-0-003264', 'prediction_text': '각하 견해를 내었다. 소수의'}, ...]
-            '''
-            
-            return formatted_predictions
-
-        elif training_args.do_eval:
-            references = [
-                {"id": ex["id"], "answers": ex[answer_column_name]}
-                for ex in datasets["validation"]
-            ]
-            
-            '''
-            formatted_predictions : [{'id': 'mrc-0-003264', 'prediction_text': '각하 견해를 내었다. 소수의'}, ...]
-            references : [{'id': 'mrc-0-003264', 'answers': {'answer_start': [284], 'text': ['한보철강']}}, ...]
-            
-            '''
-        
-                
-            return EvalPrediction(
-                predictions=formatted_predictions, label_ids=references
-            )
-
-    metric = load_metric("squad") # Exact Match, F1
-
-    def compute_metrics(p: EvalPrediction):
-        '''
-        p.predictions = formatted_predictions
-        p.label_ids = references
-        '''
-        return metric.compute(predictions=p.predictions, references=p.label_ids)
 
     # Trainer 초기화
-    trainer = QuestionAnsweringTrainer(
+    trainer = trainer_cls(
         model=model,
         args=training_args,
         train_dataset=train_dataset if training_args.do_train else None,
@@ -473,8 +211,9 @@ def run_mrc(
         eval_examples=datasets["validation"] if training_args.do_eval else None,
         tokenizer=tokenizer,
         data_collator=data_collator,
-        post_process_function=post_processing_function,
-        compute_metrics=compute_metrics,
+        post_process_function=pipeline.post_processing_function,
+        compute_metrics=pipeline.compute_metrics,
+        **trainer_kwargs,
     )
 
     # Training
@@ -485,7 +224,15 @@ def run_mrc(
             checkpoint = model_args.model_name_or_path
         else:
             checkpoint = None
-        train_result = trainer.train(resume_from_checkpoint=checkpoint)
+        # 학습 전체를 torch.profiler/tracemalloc으로 기록하면 event가 너무 많고 몇 배 느려지므로 cProfile만 사용합니다.
+        with profile_stage(
+            "train",
+            training_args.output_dir,
+            enabled=data_args.profile,
+            top_n=data_args.profile_top_n,
+            trace_memory=False,
+        ):
+            train_result = trainer.train(resume_from_checkpoint=checkpoint)
  
         trainer.save_model()  # Saves the tokenizer too for easy upload
 
@@ -512,7 +259,14 @@ def run_mrc(
     # Evaluation
     if training_args.do_eval:
         logger.info("*** Evaluate ***")
-        metrics = trainer.evaluate()
+        with profile_stage(
+            "evaluate",
+            training_args.output_dir,
+            enabled=data_args.profile,
+            use_torch=True,
+            top_n=data_args.profile_top_n,
+        ):
+            metrics = trainer.evaluate()
 
         metrics["eval_samples"] = len(eval_dataset)
 
@@ -21,18 +21,26 @@ import json
 import logging
 import os
 import random
-from typing import Any, Optional, Tuple
+from typing import Any, List, Optional, Tuple
 
 import numpy as np
 import torch
 from arguments import DataTrainingArguments, ModelArguments
-from datasets import DatasetDict
+from datasets import DatasetDict, Features, Sequence, Value
+from instrumentation import span
 from tqdm.auto import tqdm
 from transformers import PreTrainedTokenizerFast, TrainingArguments, is_torch_available
 from transformers.trainer_utils import get_last_checkpoint
 
 logger = logging.getLogger(__name__)
 
+# early_exit.py 처럼 reader가 계산을 건너뛴 window의 logits을 채우는 값입니다.
+# postprocess_qa_predictions는 첫 logit이 이 값 이하인 feature를 후보에서 제외합니다.
+NULL_LOGIT = -1e4
+
+# save_predictions가 n-best를 저장할 수 있는 형식입니다.
+NBEST_FORMATS = ("json", "npz", "both")
+
 
 def set_seed(seed: int = 42):
     """
@@ -62,6 +70,8 @@ def postprocess_qa_predictions(
     output_dir: Optional[str] = None,
     prefix: Optional[str] = None,
     is_world_process_zero: bool = True,
+    return_nbest: bool = False,
+    nbest_format: str = "json",
 ):
     """
     Post-processes : qa model의 prediction 값을 후처리하는 함수
@@ -93,21 +103,40 @@ def postprocess_qa_predictions(
             dictionary에 `prefix`가 포함되어 저장됨
         is_world_process_zero (:obj:`bool`, `optional`, defaults to :obj:`True`):
             이 프로세스가 main process인지 여부(logging/save를 수행해야 하는지 여부를 결정하는 데 사용됨)
+        return_nbest (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            True이면 (predictions, nbest predictions) tuple을 반환함 (파일을 거치지 않고 n-best가 필요한 경우)
+        nbest_format (:obj:`str`, `optional`, defaults to :obj:`"json"`):
+            n-best 저장 형식. "json", "npz" 혹은 "both" (`save_predictions` 참고)
     """
     assert (
         len(predictions) == 2
     ), "`predictions` should be a tuple with two elements (start_logits, end_logits)."
     all_start_logits, all_end_logits = predictions
 
-    assert len(predictions[0]) == len(
-        features
-    ), f"Got {len(predictions[0])} predictions and {len(features)} features."
+    num_features = len(features["example_id"])
+    assert (
+        len(predictions[0]) == num_features
+    ), f"Got {len(predictions[0])} predictions and {num_features} features."
 
     # example과 mapping되는 feature 생성
-    example_id_to_index = {k: i for i, k in enumerate(examples["id"])}
+    # Dataset을 row 단위로 순회하면 매번 모든 column을 decode하므로, 필요한 column만 한 번에 가져옵니다.
+    example_ids = examples["id"]
+    contexts = examples["context"]
+    example_id_to_index = {k: i for i, k in enumerate(example_ids)}
     features_per_example = collections.defaultdict(list)
-    for i, feature in enumerate(features):
-        features_per_example[example_id_to_index[feature["example_id"]]].append(i)
+    for i, example_id in enumerate(features["example_id"]):
+        features_per_example[example_id_to_index[example_id]].append(i)
+
+    feature_columns = _column_names(features)
+    all_offset_mapping = features["offset_mapping"]
+    all_context_mask = (
+        features["context_mask"] if "context_mask" in feature_columns else None
+    )
+    all_token_is_max_context = (
+        features["token_is_max_context"]
+        if "token_is_max_context" in feature_columns
+        else None
+    )
 
     # prediction, nbest에 해당하는 OrderedDict 생성합니다.
     all_predictions = collections.OrderedDict()
@@ -118,11 +147,11 @@ def postprocess_qa_predictions(
     # Logging.
     logger.setLevel(logging.INFO if is_world_process_zero else logging.WARN)
     logger.info(
-        f"Post-processing {len(examples)} example predictions split into {len(features)} features."
+        f"Post-processing {len(example_ids)} example predictions split into {len(all_offset_mapping)} features."
     )
 
     # 전체 example들에 대한 main Loop
-    for example_index, example in enumerate(tqdm(examples)):
+    for example_index, example_id in enumerate(tqdm(example_ids)):
         # 해당하는 현재 example index
         feature_indices = features_per_example[example_index]
 
@@ -134,11 +163,18 @@ def postprocess_qa_predictions(
             # 각 featureure에 대한 모든 prediction을 가져옵니다.
             start_logits = all_start_logits[feature_index]
             end_logits = all_end_logits[feature_index]
+            if start_logits[0] <= NULL_LOGIT:
+                continue
             # logit과 original context의 logit을 mapping합니다.
-            offset_mapping = features[feature_index]["offset_mapping"]
+            offset_mapping, context_mask = _feature_offsets(
+                all_offset_mapping[feature_index],
+                None if all_context_mask is None else all_context_mask[feature_index],
+            )
             # Optional : `token_is_max_context`, 제공되는 경우 현재 기능에서 사용할 수 있는 max context가 없는 answer를 제거합니다
-            token_is_max_context = features[feature_index].get(
-                "token_is_max_context", None
+            token_is_max_context = (
+                None
+                if all_token_is_max_context is None
+                else all_token_is_max_context[feature_index]
             )
 
             # minimum null prediction을 업데이트 합니다.
@@ -155,47 +191,48 @@ def postprocess_qa_predictions(
                 }
 
             # `n_best_size`보다 큰 start and end logits을 살펴봅니다.
-            start_indexes = np.argsort(start_logits)[
-                -1 : -n_best_size - 1 : -1
-            ].tolist()
-
-            end_indexes = np.argsort(end_logits)[-1 : -n_best_size - 1 : -1].tolist()
-
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # out-of-scope answers는 고려하지 않습니다.
-                    if (
-                        start_index >= len(offset_mapping)
-                        or end_index >= len(offset_mapping)
-                        or offset_mapping[start_index] is None
-                        or offset_mapping[end_index] is None
-                    ):
-                        continue
-                    # 길이가 < 0 또는 > max_answer_length인 answer도 고려하지 않습니다.
-                    if (
-                        end_index < start_index
-                        or end_index - start_index + 1 > max_answer_length
-                    ):
-                        continue
-                    # 최대 context가 없는 answer도 고려하지 않습니다.
-                    if (
-                        token_is_max_context is not None
-                        and not token_is_max_context.get(str(start_index), False)
-                    ):
-                        continue
-                    prelim_predictions.append(
-                        {
-                            "offsets": (
-                                offset_mapping[start_index][0],
-                                offset_mapping[end_index][1],
-                            ),
-                            "score": start_logits[start_index] + end_logits[end_index],
-                            "start_logit": start_logits[start_index],
-                            "end_logit": end_logits[end_index],
-                        }
+            start_indexes = np.argsort(start_logits)[-1 : -n_best_size - 1 : -1]
+            end_indexes = np.argsort(end_logits)[-1 : -n_best_size - 1 : -1]
+
+            # out-of-scope answers는 고려하지 않습니다.
+            num_tokens = len(context_mask)
+            start_indexes = start_indexes[start_indexes < num_tokens]
+            start_indexes = start_indexes[context_mask[start_indexes]]
+            end_indexes = end_indexes[end_indexes < num_tokens]
+            end_indexes = end_indexes[context_mask[end_indexes]]
+
+            # 최대 context가 없는 answer도 고려하지 않습니다.
+            if token_is_max_context is not None:
+                start_indexes = start_indexes[
+                    np.array(
+                        [token_is_max_context.get(str(i), False) for i in start_indexes],
+                        dtype=bool,
                     )
+                ]
+
+            # 길이가 < 0 또는 > max_answer_length인 answer도 고려하지 않습니다.
+            # (start, end) 조합 전체를 한 번에 검사하며, 순서는 이중 loop와 동일하게 유지됩니다.
+            lengths = end_indexes[None, :] - start_indexes[:, None] + 1
+            valid = (lengths >= 1) & (lengths <= max_answer_length)
+
+            for start_pos, end_pos in zip(*np.nonzero(valid)):
+                start_index = start_indexes[start_pos]
+                end_index = end_indexes[end_pos]
+                prelim_predictions.append(
+                    {
+                        "offsets": (
+                            int(offset_mapping[start_index][0]),
+                            int(offset_mapping[end_index][1]),
+                        ),
+                        "score": start_logits[start_index] + end_logits[end_index],
+                        "start_logit": start_logits[start_index],
+                        "end_logit": end_logits[end_index],
+                    }
+                )
 
-        if version_2_with_negative:
+        # 모든 feature가 건너뛰어졌으면 (NULL_LOGIT) null prediction도 없습니다.
+        has_null_prediction = version_2_with_negative and min_null_prediction is not None
+        if has_null_prediction:
             # minimum null prediction을 추가합니다.
             prelim_predictions.append(min_null_prediction)
             null_score = min_null_prediction["score"]
@@ -206,16 +243,19 @@ def postprocess_qa_predictions(
         )[:n_best_size]
 
         # 낮은 점수로 인해 제거된 경우 minimum null prediction을 다시 추가합니다.
-        if version_2_with_negative and not any(
+        if has_null_prediction and not any(
             p["offsets"] == (0, 0) for p in predictions
         ):
             predictions.append(min_null_prediction)
 
         # offset을 사용하여 original context에서 answer text를 수집합니다.
-        context = example["context"]
+        context = contexts[example_index]
         for pred in predictions:
             offsets = pred.pop("offsets")
             pred["text"] = context[offsets[0] : offsets[1]]
+            # npz에만 답의 문자 위치를 저장하므로 JSON 형식의 n-best에는 남기지 않습니다.
+            if nbest_format != "json":
+                pred["offsets"] = offsets
 
         # rare edge case에는 null이 아닌 예측이 하나도 없으며 failure를 피하기 위해 fake prediction을 만듭니다.
         if len(predictions) == 0 or (
@@ -233,11 +273,15 @@ def postprocess_qa_predictions(
 
         # 예측값에 확률을 포함합니다.
         for prob, pred in zip(probs, predictions):
-            pred["probability"] = prob
+            pred["probability"] = float(prob)
 
         # best prediction을 선택합니다.
         if not version_2_with_negative:
-            all_predictions[example["id"]] = predictions[0]["text"]
+            all_predictions[example_id] = predictions[0]["text"]
+        elif not has_null_prediction:
+            # reader가 모든 window를 답이 없다고 보고 건너뛴 경우이므로 null answer로 답합니다.
+            # 비교할 null score가 없으므로 scores_diff_json에는 기록하지 않습니다.
+            all_predictions[example_id] = ""
         else:
             # else case : 먼저 비어 있지 않은 최상의 예측을 찾아야 합니다
             i = 0
@@ -251,63 +295,209 @@ def postprocess_qa_predictions(
                 - best_non_null_pred["start_logit"]
                 - best_non_null_pred["end_logit"]
             )
-            scores_diff_json[example["id"]] = float(score_diff)  # JSON-serializable 가능
+            scores_diff_json[example_id] = float(score_diff)  # JSON-serializable 가능
             if score_diff > null_score_diff_threshold:
-                all_predictions[example["id"]] = ""
+                all_predictions[example_id] = ""
             else:
-                all_predictions[example["id"]] = best_non_null_pred["text"]
+                all_predictions[example_id] = best_non_null_pred["text"]
 
         # np.float를 다시 float로 casting -> `predictions`은 JSON-serializable 가능
-        all_nbest_json[example["id"]] = [
-            {
-                k: (
-                    float(v)
-                    if isinstance(v, (np.float16, np.float32, np.float64))
-                    else v
-                )
-                for k, v in pred.items()
-            }
-            for pred in predictions
-        ]
+        # n-best의 logit만 바꾸면 되므로 prediction마다 dict를 새로 만들지 않습니다.
+        for pred in predictions:
+            pred["start_logit"] = float(pred["start_logit"])
+            pred["end_logit"] = float(pred["end_logit"])
+        all_nbest_json[example_id] = predictions
 
     # output_dir이 있으면 모든 dicts를 저장합니다.
     if output_dir is not None:
-        assert os.path.isdir(output_dir), f"{output_dir} is not a directory."
-
-        prediction_file = os.path.join(
+        save_predictions(
+            all_predictions,
+            all_nbest_json,
             output_dir,
-            "predictions.json" if prefix is None else f"predictions_{prefix}".json,
+            prefix=prefix,
+            scores_diff_json=scores_diff_json if version_2_with_negative else None,
+            nbest_format=nbest_format,
         )
+
+    if return_nbest:
+        return all_predictions, all_nbest_json
+    return all_predictions
+
+
+def save_predictions(
+    all_predictions,
+    all_nbest_json,
+    output_dir: str,
+    prefix: Optional[str] = None,
+    scores_diff_json=None,
+    nbest_format: str = "json",
+):
+    """
+    `postprocess_qa_predictions`의 결과를 output_dir에 저장합니다.
+
+    여러 번에 나누어 후처리한 결과(streaming, sharding 등)를 합친 뒤 한 번에 저장할 때도 사용합니다.
+    predictions.json은 항상 저장하고, n-best는 `nbest_format`에 따라
+    nbest_predictions.json, nbest_predictions.npz (`write_nbest_npz`) 혹은 둘 다 저장합니다.
+
+    Args:
+        all_predictions: example id -> 최종 answer text
+        all_nbest_json: example id -> n-best prediction list
+        output_dir (:obj:`str`): 저장 경로
+        prefix (:obj:`str`, `optional`): 파일 이름에 `prefix`가 포함되어 저장됨
+        scores_diff_json (`optional`): null answer와 best answer의 점수 차이 (version_2_with_negative인 경우)
+        nbest_format (:obj:`str`, `optional`, defaults to :obj:`"json"`): "json", "npz" 혹은 "both"
+    """
+    assert os.path.isdir(output_dir), f"{output_dir} is not a directory."
+    if nbest_format not in NBEST_FORMATS:
+        raise ValueError(f"지원하지 않는 nbest_format 입니다: {nbest_format}")
+
+    json_nbest = None
+    if nbest_format == "json":
+        json_nbest = all_nbest_json
+    elif nbest_format == "both":
+        # nbest_predictions.json은 기존 형식 그대로 두기 위해 npz용 offsets를 뺍니다.
+        json_nbest = {
+            id_: [{k: v for k, v in pred.items() if k != "offsets"} for pred in nbest]
+            for id_, nbest in all_nbest_json.items()
+        }
+    with span("postprocess.json_output"):
+        _write_predictions(all_predictions, json_nbest, output_dir, prefix, scores_diff_json)
+    if nbest_format != "json":
         nbest_file = os.path.join(
             output_dir,
-            "nbest_predictions.json"
-            if prefix is None
-            else f"nbest_predictions_{prefix}".json,
+            "nbest_predictions.npz" if prefix is None else f"nbest_predictions_{prefix}.npz",
         )
-        if version_2_with_negative:
-            null_odds_file = os.path.join(
-                output_dir,
-                "null_odds.json" if prefix is None else f"null_odds_{prefix}".json,
-            )
+        logger.info(f"Saving nbest_preds to {nbest_file}.")
+        with span("postprocess.npz_output"):
+            write_nbest_npz(all_nbest_json, nbest_file)
 
-        logger.info(f"Saving predictions to {prediction_file}.")
-        with open(prediction_file, "w", encoding="utf-8") as writer:
-            writer.write(
-                json.dumps(all_predictions, indent=4, ensure_ascii=False) + "\n"
-            )
+
+def write_nbest_npz(all_nbest_json, path: str) -> None:
+    """
+    n-best prediction을 column 단위로 npz 파일에 저장합니다. (json.dumps 없이 numpy array로 바로 씁니다.)
+
+    Columns:
+        id: example id (example 수)
+        nbest_start: example i의 n-best는 row nbest_start[i]:nbest_start[i + 1] (example 수 + 1)
+        rank, start_logit, end_logit, probability: n-best row별 값
+        char_start, char_end: context에서 답의 문자 위치. 위치가 없는 fake prediction은 -1
+        text, text_offsets: 모든 답을 이어 붙인 UTF-8 byte와 row별 시작 위치 (row 수 + 1)
+    """
+    ids = list(all_nbest_json)
+    counts = np.array([len(all_nbest_json[id_]) for id_ in ids], dtype=np.int64)
+    nbest_start = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=nbest_start[1:])
+    rows = [pred for id_ in ids for pred in all_nbest_json[id_]]
+
+    texts = [pred["text"].encode("utf-8") for pred in rows]
+    text_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in texts], out=text_offsets[1:])
+    char_offsets = np.array(
+        [pred.get("offsets", (-1, -1)) for pred in rows], dtype=np.int32
+    ).reshape(-1, 2)
+
+    np.savez(
+        path,
+        id=np.array(ids, dtype=str),
+        nbest_start=nbest_start,
+        rank=(np.arange(len(rows)) - np.repeat(nbest_start[:-1], counts)).astype(np.int32),
+        start_logit=np.array([pred["start_logit"] for pred in rows], dtype=np.float32),
+        end_logit=np.array([pred["end_logit"] for pred in rows], dtype=np.float32),
+        probability=np.array([pred["probability"] for pred in rows], dtype=np.float32),
+        char_start=char_offsets[:, 0],
+        char_end=char_offsets[:, 1],
+        text=np.frombuffer(b"".join(texts), dtype=np.uint8),
+        text_offsets=text_offsets,
+    )
+
+
+def _write_predictions(all_predictions, all_nbest_json, output_dir, prefix, scores_diff_json):
+    prediction_file = os.path.join(
+        output_dir,
+        "predictions.json" if prefix is None else f"predictions_{prefix}.json",
+    )
+    nbest_file = os.path.join(
+        output_dir,
+        "nbest_predictions.json"
+        if prefix is None
+        else f"nbest_predictions_{prefix}.json",
+    )
+
+    logger.info(f"Saving predictions to {prediction_file}.")
+    with open(prediction_file, "w", encoding="utf-8") as writer:
+        writer.write(
+            json.dumps(all_predictions, indent=4, ensure_ascii=False) + "\n"
+        )
+    if all_nbest_json is not None:
         logger.info(f"Saving nbest_preds to {nbest_file}.")
         with open(nbest_file, "w", encoding="utf-8") as writer:
             writer.write(
                 json.dumps(all_nbest_json, indent=4, ensure_ascii=False) + "\n"
             )
-        if version_2_with_negative:
-            logger.info(f"Saving null_odds to {null_odds_file}.")
-            with open(null_odds_file, "w", encoding="utf-8") as writer:
-                writer.write(
-                    json.dumps(scores_diff_json, indent=4, ensure_ascii=False) + "\n"
-                )
+    if scores_diff_json is not None:
+        null_odds_file = os.path.join(
+            output_dir,
+            "null_odds.json" if prefix is None else f"null_odds_{prefix}.json",
+        )
+        logger.info(f"Saving null_odds to {null_odds_file}.")
+        with open(null_odds_file, "w", encoding="utf-8") as writer:
+            writer.write(
+                json.dumps(scores_diff_json, indent=4, ensure_ascii=False) + "\n"
+            )
 
-    return all_predictions
+
+def validation_features_schema(with_token_type_ids: bool = False) -> Features:
+    """
+    `prepare_validation_features`가 만드는 feature의 Arrow schema를 반환합니다.
+
+    offset_mapping은 context가 아닌 token을 -1로 채운 int32 offset이며,
+    context 여부는 별도의 `context_mask` column으로 저장합니다.
+
+    Args:
+        with_token_type_ids (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            tokenizer가 `token_type_ids`를 반환하는지 여부
+    """
+    schema = {
+        "input_ids": Sequence(Value("int32")),
+        "attention_mask": Sequence(Value("int8")),
+        "offset_mapping": Sequence(Sequence(Value("int32"))),
+        "context_mask": Sequence(Value("bool")),
+        "example_id": Value("string"),
+    }
+    if with_token_type_ids:
+        schema["token_type_ids"] = Sequence(Value("int8"))
+    return Features(schema)
+
+
+def _column_names(table) -> List[str]:
+    # datasets.Dataset과 dict 형태의 batch(BatchEncoding 포함)를 모두 지원합니다.
+    return table.column_names if hasattr(table, "column_names") else list(table.keys())
+
+
+def select_rows(table, indices: List[int]):
+    """
+    table에서 indices 위치의 row만 골라 같은 형태(Dataset 혹은 dict of lists)로 반환합니다.
+    """
+    if hasattr(table, "select"):
+        return table.select(indices)
+    return {k: [v[i] for i in indices] for k, v in table.items()}
+
+
+def _feature_offsets(offset_mapping, context_mask=None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    하나의 feature에 대한 (offsets, context_mask) numpy array를 반환합니다.
+
+    `context_mask`가 없는 경우, context가 아닌 offset이 None으로 채워진 이전 형식으로 간주합니다.
+    """
+    if context_mask is not None:
+        offsets = np.asarray(offset_mapping, dtype=np.int32).reshape(-1, 2)
+        return offsets, np.asarray(context_mask, dtype=bool)
+
+    context_mask = np.array([o is not None for o in offset_mapping], dtype=bool)
+    offsets = np.array(
+        [o if o is not None else (-1, -1) for o in offset_mapping], dtype=np.int64
+    ).reshape(-1, 2)
+    return offsets, context_mask
 
 
 def check_no_error(
@@ -0,0 +1,184 @@
+"""
+reader에 넣기 전에 질문과 겹치는 단어가 적은 window를 버리는 lexical pre-filter 입니다.
+
+`prepare_validation_features`가 만든 input_ids에서 질문 token과 window의 context token을 바로 비교하므로
+tokenize를 다시 하지 않습니다. 같은 질문의 window들 사이에서 흔한 token일수록 weight를 작게 주고,
+질문마다 점수가 높은 window를 `keep_ratio` 비율만큼 (최소 `min_windows`개) 남깁니다.
+
+keep ratio별 window 수, 정답 window recall (필요하면 EM/F1까지) 비교:
+    python window_filter.py --model_name_or_path ./models/train_dataset --keep_ratios 1.0 0.5 0.3 0.2 --evaluate
+"""
+
+
+import collections
+import math
+from typing import Callable, Dict, List
+
+import numpy as np
+from instrumentation import METRICS
+from utils_qa import select_rows
+
+
+class WindowFilter:
+    def __init__(self, tokenizer, keep_ratio: float = 0.5, min_windows: int = 1):
+
+        """
+        Arguments:
+            tokenizer:
+                special token을 질문 token에서 제외하는 데 사용합니다.
+            keep_ratio (float):
+                질문마다 남길 window의 비율입니다. 1.0이면 모든 window를 남깁니다.
+            min_windows (int):
+                window가 적은 질문도 이 개수만큼은 남깁니다.
+
+        Summary:
+            `QAPipeline.register_hook("windows", window_filter.windows_hook)`로 등록하면
+            validation feature를 만든 직후 window를 걸러 Trainer.predict에 들어가는 feature 수를 줄입니다.
+        """
+
+        assert 0 < keep_ratio <= 1, "keep_ratio는 0보다 크고 1 이하여야 합니다."
+        self.special_ids = set(tokenizer.all_special_ids)
+        self.keep_ratio = keep_ratio
+        self.min_windows = min_windows
+        self.stats = {"windows": 0, "kept": 0}
+
+    def scores(self, features) -> np.ndarray:
+        # window의 context token 중 질문에 나온 token의 idf 합. idf는 같은 질문의 window들로 계산합니다.
+        scores = np.zeros(len(features["input_ids"]), dtype=np.float32)
+        for rows in _rows_per_example(features).values():
+            question, overlaps = None, []
+            for row in rows:
+                input_ids = np.asarray(features["input_ids"][row])
+                context_mask = np.asarray(features["context_mask"][row], dtype=bool)
+                if question is None:
+                    question = set(input_ids[~context_mask].tolist()) - self.special_ids
+                overlaps.append(question.intersection(input_ids[context_mask].tolist()))
+
+            df = collections.Counter(token for overlap in overlaps for token in overlap)
+            for row, overlap in zip(rows, overlaps):
+                scores[row] = sum(math.log(1 + len(rows) / df[token]) for token in overlap)
+        return scores
+
+    def keep_mask(self, features) -> np.ndarray:
+        scores = self.scores(features)
+        keep = np.zeros(len(scores), dtype=bool)
+        for rows in _rows_per_example(features).values():
+            num_keep = max(self.min_windows, math.ceil(self.keep_ratio * len(rows)))
+            # 점수가 같으면 context 앞쪽 window를 남깁니다.
+            order = np.argsort(-scores[rows], kind="stable")[:num_keep]
+            keep[np.asarray(rows)[order]] = True
+        return keep
+
+    def filter(self, features):
+        keep = self.keep_mask(features)
+        self.stats["windows"] += len(keep)
+        self.stats["kept"] += int(keep.sum())
+        METRICS.count("window_filter.windows", len(keep))
+        METRICS.count("window_filter.dropped", int((~keep).sum()))
+        if keep.all():
+            return features
+        return select_rows(features, np.nonzero(keep)[0].tolist())
+
+    def windows_hook(self, fn: Callable) -> Callable:
+        def windows(examples, tokenized_examples):
+            features = fn(examples, tokenized_examples)
+            # 정답 위치로 label을 다는 train feature는 거르지 않습니다.
+            if "context_mask" not in features:
+                return features
+            return self.filter(features)
+
+        return windows
+
+
+def _rows_per_example(features) -> Dict[str, List[int]]:
+    rows = collections.defaultdict(list)
+    for row, example_id in enumerate(features["example_id"]):
+        rows[example_id].append(row)
+    return rows
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    import torch
+    from arguments import DataTrainingArguments, ModelArguments
+    from datasets import load_from_disk
+    from early_exit import window_labels
+    from inference import build_retriever, load_reader
+    from qa_pipeline import QAPipeline, uses_token_type_ids
+    from transformers import EvalPrediction
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("--model_name_or_path", type=str, required=True, help="")
+    parser.add_argument(
+        "--dataset_name", default="../data/train_dataset", type=str, help=""
+    )
+    parser.add_argument("--keep_ratios", nargs="+", default=[1.0, 0.5, 0.3, 0.2], type=float, help="")
+    parser.add_argument("--top_k_retrieval", default=10, type=int, help="")
+    parser.add_argument("--max_questions", default=None, type=int, help="")
+    parser.add_argument("--evaluate", action="store_true", help="reader로 EM/F1까지 계산합니다.")
+    parser.add_argument("--batch_size", default=32, type=int, help="")
+    args = parser.parse_args()
+
+    tokenizer, model = load_reader(ModelArguments(model_name_or_path=args.model_name_or_path))
+    data_args = DataTrainingArguments(
+        dataset_name=args.dataset_name, top_k_retrieval=args.top_k_retrieval
+    )
+    retriever = build_retriever(tokenizer.tokenize, data_args)
+    pipeline = QAPipeline(
+        tokenizer,
+        data_args,
+        min(data_args.max_seq_length, tokenizer.model_max_length),
+        ["id", "question", "context", "answers"],
+        return_token_type_ids=uses_token_type_ids(model.config),
+    )
+
+    validation = load_from_disk(args.dataset_name)["validation"]
+    if args.max_questions is not None:
+        validation = validation.select(range(min(args.max_questions, len(validation))))
+    _, doc_indices = retriever.get_relevant_doc_bulk(validation["question"], k=args.top_k_retrieval)
+    examples = {
+        "id": validation["id"],
+        "question": validation["question"],
+        "context": [
+            " ".join(retriever.contexts[pid] for pid in indices) for indices in doc_indices
+        ],
+        "answers": validation["answers"],
+    }
+    # 모든 keep ratio가 같은 window에서 고르도록 feature는 한 번만 만듭니다.
+    features = pipeline.prepare_validation_features(examples)
+    positive = window_labels(examples, features) > 0
+    example_ids = np.asarray(features["example_id"])
+    answerable = set(example_ids[positive])
+    print(
+        f"{len(validation)} questions, {len(positive)} windows, "
+        f"{positive.mean() * 100:.1f}% windows / {len(answerable) / len(validation) * 100:.1f}% questions "
+        "have an answer string in some window"
+    )
+    if args.evaluate:
+        model.to("cuda" if torch.cuda.is_available() else "cpu")
+
+    for keep_ratio in args.keep_ratios:
+        keep = WindowFilter(tokenizer, keep_ratio).keep_mask(features)
+        report = {
+            "kept_windows": f"{keep.mean() * 100:.1f}%",
+            "answer_window_recall": f"{keep[positive].mean() * 100:.1f}%",
+            "question_recall": f"{len(set(example_ids[positive & keep])) / max(len(answerable), 1) * 100:.1f}%",
+        }
+        if args.evaluate:
+            kept = select_rows(features, np.nonzero(keep)[0].tolist())
+            predictions = pipeline.predict(model, kept, batch_size=args.batch_size)
+            all_predictions = pipeline.postprocess(examples, kept, predictions)
+            metrics = pipeline.compute_metrics(
+                EvalPrediction(
+                    predictions=[{"id": k, "prediction_text": v} for k, v in all_predictions.items()],
+                    label_ids=[
+                        {"id": id_, "answers": answers}
+                        for id_, answers in zip(examples["id"], examples["answers"])
+                    ],
+                )
+            )
+            report["exact_match"] = round(metrics["exact_match"], 2)
+            report["f1"] = round(metrics["f1"], 2)
+        print(f"[keep_ratio {keep_ratio}] {report}")
@@ -0,0 +1,266 @@
+"""
+고정된 doc_stride 대신 문장 경계에 맞춰 window를 나누는 validation window planner 입니다.
+
+tokenizer의 overflow는 max_seq_length마다 doc_stride 만큼 겹치는 window를 만들기 때문에
+doc_stride=128, max_seq_length=384 이면 window의 1/3 정도가 다시 계산됩니다.
+planner는 context를 한 번 tokenize한 뒤, window를 절반 이상 채우는 가장 마지막 문장(혹은 문서) 경계에서 자르고
+다음 window를 그 경계에서 시작하므로 window가 겹치지 않습니다.
+경계가 없는 긴 문장에서만 doc_stride 만큼 겹쳐 자르며, context 끝에 닿으면 더 이상 window를 만들지 않습니다.
+feature는 자른 text를 다시 tokenize하지 않고 처음 tokenize한 token id와 offset으로 만들므로 subword가 바뀌지 않습니다.
+
+고정 stride / planner의 feature 수, reader 시간, EM/F1 비교 (retrieve한 validation context 사용):
+    python window_planner.py --model_name_or_path ./models/train_dataset --top_k_retrieval 10
+"""
+
+
+import re
+from typing import List, Optional, Tuple
+
+import numpy as np
+from transformers import BatchEncoding
+
+# 문장 끝 문장부호 뒤의 공백, 혹은 줄바꿈이 끝나는 위치를 다음 문장의 시작으로 봅니다.
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?。])\s+|\n+")
+
+# DataTrainingArguments.window_planner에 사용할 수 있는 값입니다.
+WINDOW_PLANNERS = ("stride", "sentence")
+
+# plan_validation_windows에서 sequence 위치를 찾기 위한 placeholder token id 입니다. (실제 vocab에는 없는 음수)
+_FIRST, _SECOND = -1, -2
+
+
+def sentence_starts(context: str, offsets: np.ndarray) -> np.ndarray:
+    # 문장의 첫 token index (오름차순) 입니다.
+    starts = [m.end() for m in SENTENCE_BOUNDARY.finditer(context)]
+    return np.nonzero(np.isin(offsets[:, 0], starts))[0]
+
+
+class PlannedWindows(BatchEncoding):
+    # fast tokenizer의 Encoding 없이 만든 feature이므로 sequence_ids를 직접 저장합니다.
+    def __init__(self, data, sequence_ids: List[List[Optional[int]]]):
+        super().__init__(data)
+        self._sequence_ids = sequence_ids
+
+    def sequence_ids(self, batch_index: int = 0) -> List[Optional[int]]:
+        return self._sequence_ids[batch_index]
+
+
+def plan_windows(
+    num_tokens: int, boundaries: np.ndarray, budget: int, overlap: int
+) -> List[Tuple[int, int]]:
+
+    """
+    Arguments:
+        num_tokens (int): context의 token 수
+        boundaries (np.ndarray): 문장이 시작하는 token index (오름차순)
+        budget (int): 한 window에 넣을 수 있는 context token 수
+        overlap (int): 문장 경계 없이 자를 때 다음 window와 겹치는 token 수
+
+    Returns:
+        context token 기준 [start, end) window 목록
+    """
+
+    overlap = min(overlap, budget // 2)
+    windows = []
+    start = 0
+    while True:
+        end = start + budget
+        if end >= num_tokens:
+            windows.append((start, num_tokens))
+            return windows
+        # window를 절반 이상 채우는 가장 마지막 문장 경계에서 자릅니다.
+        # budget이 1이면 budget // 2가 0이므로, start와 같은 경계에서 자르지 않도록 start보다 뒤인지도 확인합니다.
+        i = np.searchsorted(boundaries, end, side="right") - 1
+        if i >= 0 and boundaries[i] > start and boundaries[i] >= start + budget // 2:
+            windows.append((start, int(boundaries[i])))
+            start = int(boundaries[i])
+        else:
+            windows.append((start, end))
+            start = end - overlap
+
+
+def plan_validation_windows(
+    tokenizer,
+    questions: List[str],
+    contexts: List[str],
+    max_seq_length: int,
+    overlap: int,
+    pad_on_right: bool = True,
+    return_token_type_ids: bool = False,
+    padding=False,
+) -> PlannedWindows:
+
+    """
+    Returns:
+        `QAPipeline._tokenize`와 같은 형태의 BatchEncoding.
+        overflow_to_sample_mapping은 example index를, offset_mapping은 원래 context의 문자 위치를 가리킵니다.
+    """
+
+    question_ids = tokenizer(questions, add_special_tokens=False)["input_ids"]
+    context_encodings = tokenizer(
+        contexts, add_special_tokens=False, return_offsets_mapping=True
+    )
+    num_special_tokens = tokenizer.num_special_tokens_to_add(pair=True)
+    context_index = 1 if pad_on_right else 0
+
+    features = {"input_ids": [], "attention_mask": [], "offset_mapping": [], "overflow_to_sample_mapping": []}
+    if return_token_type_ids:
+        features["token_type_ids"] = []
+    all_sequence_ids = []
+
+    for example_index, (context, question, context_ids, offsets) in enumerate(
+        zip(
+            contexts,
+            question_ids,
+            context_encodings["input_ids"],
+            context_encodings["offset_mapping"],
+        )
+    ):
+        # 질문이 너무 길어도 context token이 하나는 들어가도록 질문을 자릅니다.
+        question = question[: max(max_seq_length - num_special_tokens - 1, 0)]
+        offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+        budget = max(max_seq_length - len(question) - num_special_tokens, 1)
+        for start, end in plan_windows(
+            len(offsets), sentence_starts(context, offsets), budget, overlap
+        ):
+            window_ids = context_ids[start:end]
+            pair = (question, window_ids) if pad_on_right else (window_ids, question)
+            input_ids = tokenizer.build_inputs_with_special_tokens(*pair)
+            # 같은 구조를 음수 placeholder로 만들어 각 위치가 어느 sequence인지 구합니다.
+            # (context의 [UNK]처럼 special id와 같은 token도 올바르게 구분됩니다.)
+            layout = tokenizer.build_inputs_with_special_tokens(
+                [_FIRST] * len(pair[0]), [_SECOND] * len(pair[1])
+            )
+
+            sequence_ids, window_offsets = [], []
+            context_offsets = iter(offsets[start:end].tolist())
+            for token in layout:
+                sequence_id = 0 if token == _FIRST else 1 if token == _SECOND else None
+                sequence_ids.append(sequence_id)
+                window_offsets.append(
+                    tuple(next(context_offsets)) if sequence_id == context_index else (0, 0)
+                )
+
+            features["input_ids"].append(input_ids)
+            features["attention_mask"].append([1] * len(input_ids))
+            features["offset_mapping"].append(window_offsets)
+            features["overflow_to_sample_mapping"].append(example_index)
+            if return_token_type_ids:
+                features["token_type_ids"].append(
+                    tokenizer.create_token_type_ids_from_sequences(*pair)
+                )
+            all_sequence_ids.append(sequence_ids)
+
+    if padding == "max_length":
+        _pad_features(tokenizer, features, all_sequence_ids, max_seq_length)
+    return PlannedWindows(features, all_sequence_ids)
+
+
+def _pad_features(tokenizer, features, all_sequence_ids, max_length: int) -> None:
+    pad_values = {
+        "input_ids": tokenizer.pad_token_id,
+        "attention_mask": 0,
+        "token_type_ids": tokenizer.pad_token_type_id,
+        "offset_mapping": (0, 0),
+    }
+    left = tokenizer.padding_side == "left"
+    for i, sequence_ids in enumerate(all_sequence_ids):
+        num_pad = max_length - len(sequence_ids)
+        if num_pad <= 0:
+            continue
+        for key, value in pad_values.items():
+            if key in features:
+                padding = [value] * num_pad
+                row = features[key][i]
+                features[key][i] = padding + row if left else row + padding
+        all_sequence_ids[i] = [None] * num_pad + sequence_ids if left else sequence_ids + [None] * num_pad
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import dataclasses
+    import time
+
+    import torch
+    from arguments import DataTrainingArguments, ModelArguments
+    from datasets import load_from_disk
+    from inference import build_retriever, load_reader
+    from qa_pipeline import QAPipeline, uses_token_type_ids
+    from transformers import EvalPrediction
+
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("--model_name_or_path", type=str, required=True, help="")
+    parser.add_argument(
+        "--dataset_name", default="../data/train_dataset", type=str, help=""
+    )
+    parser.add_argument("--top_k_retrieval", default=10, type=int, help="")
+    parser.add_argument("--max_questions", default=None, type=int, help="")
+    parser.add_argument("--batch_size", default=32, type=int, help="")
+    args = parser.parse_args()
+
+    tokenizer, model = load_reader(ModelArguments(model_name_or_path=args.model_name_or_path))
+    model.to("cuda" if torch.cuda.is_available() else "cpu")
+    data_args = DataTrainingArguments(
+        dataset_name=args.dataset_name, top_k_retrieval=args.top_k_retrieval
+    )
+    retriever = build_retriever(tokenizer.tokenize, data_args)
+
+    validation = load_from_disk(args.dataset_name)["validation"]
+    if args.max_questions is not None:
+        validation = validation.select(range(min(args.max_questions, len(validation))))
+    _, doc_indices = retriever.get_relevant_doc_bulk(validation["question"], k=args.top_k_retrieval)
+    examples = {
+        "id": validation["id"],
+        "question": validation["question"],
+        "context": [
+            " ".join(retriever.contexts[pid] for pid in indices) for indices in doc_indices
+        ],
+        "answers": validation["answers"],
+    }
+
+    results = {}
+    for planner in ("stride", "sentence"):
+        pipeline = QAPipeline(
+            tokenizer,
+            dataclasses.replace(data_args, window_planner=planner),
+            min(data_args.max_seq_length, tokenizer.model_max_length),
+            ["id", "question", "context", "answers"],
+            return_token_type_ids=uses_token_type_ids(model.config),
+        )
+        t0 = time.perf_counter()
+        features = pipeline.prepare_validation_features(examples)
+        features_seconds = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        predictions = pipeline.predict(model, features, batch_size=args.batch_size)
+        reader_seconds = time.perf_counter() - t0
+        all_predictions = pipeline.postprocess(examples, features, predictions)
+        metrics = pipeline.compute_metrics(
+            EvalPrediction(
+                predictions=[{"id": k, "prediction_text": v} for k, v in all_predictions.items()],
+                label_ids=[
+                    {"id": id_, "answers": answers}
+                    for id_, answers in zip(examples["id"], examples["answers"])
+                ],
+            )
+        )
+        results[planner] = {
+            "features": len(features["input_ids"]),
+            "features_seconds": round(features_seconds, 3),
+            "reader_seconds": round(reader_seconds, 3),
+            "exact_match": round(metrics["exact_match"], 2),
+            "f1": round(metrics["f1"], 2),
+        }
+
+    base = results["stride"]
+    print(
+        f"{len(validation)} questions, top {args.top_k_retrieval} passages, "
+        f"max_seq_length {data_args.max_seq_length}, doc_stride {data_args.doc_stride}"
+    )
+    for planner, result in results.items():
+        print(
+            f"[{planner}] {result['features']} features ({result['features'] / base['features']:.2f}x), "
+            f"reader {result['reader_seconds']} s ({result['reader_seconds'] / max(base['reader_seconds'], 1e-9):.2f}x), "
+            f"EM {result['exact_match']:.2f} ({result['exact_match'] - base['exact_match']:+.2f}) "
+            f"F1 {result['f1']:.2f} ({result['f1'] - base['f1']:+.2f})"
+        )
@@ -1,48 +1,197 @@
+"""
+여러 reader의 n-best 예측 파일을 가중치를 주어 합치는 앙상블 코드 입니다.
+
+    python ensemble.py --nbest_files a/nbest_predictions.json b/nbest_predictions.json c/nbest_predictions.json \
+        --weights 1.0 0.5 0.5 --output ./outputs/test_dataset/ensemble.json
+
+--nbest_files를 주지 않으면 --input_dir의 nbest_predictions_1.json ... nbest_predictions_{K}.json 을 사용합니다.
+`--nbest_format npz`로 저장한 nbest_predictions.npz 파일도 (--format npz) 같은 방법으로 합칠 수 있습니다.
+
+각 파일은 한 번에 불러오지 않고 질문 단위로 읽으며, 답 text는 공백/유니코드 정규화한 text를 key로 하는 dict로 합칩니다.
+모든 파일의 질문 순서가 같으면 (같은 test set에서 만든 경우) 한 번에 질문 하나 분량의 memory만 사용합니다.
+"""
+
+import argparse
 import json
-from collections import defaultdict
+import os
+import unicodedata
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+_DECODER = json.JSONDecoder()
+
+
+def iter_json_object(path: str, chunk_size: int = 1 << 20) -> Iterator[Tuple[str, object]]:
+    # {"id": [...], ...} 형태의 JSON 파일을 (key, value) 단위로 읽습니다.
+    with open(path, "r", encoding="utf-8") as f:
+        buffer, pos, eof = "", 0, False
+
+        def fill() -> bool:
+            nonlocal buffer, pos, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            return not eof
+
+        def skip(chars: Optional[str] = None) -> str:
+            # 공백을 건너뛰고 다음 문자를 반환합니다. chars를 주면 그 중 하나인지 확인합니다.
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos < len(buffer):
+                    break
+                if not fill():
+                    raise ValueError(f"{path}: JSON이 중간에 끝났습니다.")
+            char = buffer[pos]
+            if chars is not None and char not in chars:
+                raise ValueError(f"{path}: {chars!r} 중 하나가 필요하지만 {char!r}가 있습니다.")
+            return char
+
+        def decode():
+            nonlocal pos
+            while True:
+                try:
+                    value, end = _DECODER.raw_decode(buffer, pos)
+                    # 숫자는 chunk 경계에서 잘려도 decode되므로 뒤에 문자가 더 있는지 확인합니다.
+                    if end < len(buffer) or eof:
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        skip("{")
+        pos += 1
+        if skip('"}') == "}":
+            return
+        while True:
+            key = decode()
+            skip(":")
+            pos += 1
+            skip()
+            yield key, decode()
+            if skip(",}") == "}":
+                return
+            pos += 1
+            skip('"')
+
+
+def iter_nbest_npz(path: str) -> Iterator[Tuple[str, list]]:
+    # code/utils_qa.py의 write_nbest_npz가 저장한 column들을 (id, n-best list) 단위로 읽습니다.
+    with np.load(path, allow_pickle=False) as data:
+        ids, nbest_start = data["id"], data["nbest_start"]
+        probability = data["probability"].tolist()
+        start_logit, end_logit = data["start_logit"].tolist(), data["end_logit"].tolist()
+        text, text_offsets = data["text"].tobytes(), data["text_offsets"].tolist()
+    for i, id_ in enumerate(ids.tolist()):
+        yield id_, [
+            {
+                "text": text[text_offsets[row] : text_offsets[row + 1]].decode("utf-8"),
+                "probability": probability[row],
+                "start_logit": start_logit[row],
+                "end_logit": end_logit[row],
+            }
+            for row in range(nbest_start[i], nbest_start[i + 1])
+        ]
+
+
+def iter_nbest(path: str) -> Iterator[Tuple[str, list]]:
+    if path.endswith(".npz"):
+        return iter_nbest_npz(path)
+    return iter_json_object(path)
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def ensemble(
+    nbest_files: List[str], weights: List[float]
+) -> Iterator[Tuple[str, str]]:
+
+    """
+    Arguments:
+        nbest_files: `nbest_predictions.json` 형식의 파일들 ({id: [{"text", "probability", ...}, ...]}) 혹은 .npz 파일들
+        weights: 파일별 가중치. 답의 점수는 sum(weight * probability) 입니다.
+
+    Returns:
+        (id, 점수가 가장 높은 답 text)를 모든 파일에서 질문이 나오는 대로 반환합니다.
+    """
+
+    assert len(nbest_files) == len(weights), "n-best 파일 수와 weight 수가 같아야 합니다."
+    streams = [iter_nbest(path) for path in nbest_files]
+    # 아직 일부 파일에서만 읽은 질문의 {정규화한 text: [점수, 대표 text, 대표 text의 파일 index]}
+    pending: Dict[str, Dict[str, list]] = {}
+    seen: Dict[str, int] = {}
+
+    active = list(range(len(streams)))
+    while active:
+        for i in list(active):
+            item = next(streams[i], None)
+            if item is None:
+                active.remove(i)
+                continue
+            id_, predictions = item
+            votes = pending.setdefault(id_, {})
+            for prediction in predictions:
+                key = normalize_text(prediction["text"])
+                vote = votes.get(key)
+                if vote is None:
+                    votes[key] = [weights[i] * prediction["probability"], prediction["text"], i]
+                    continue
+                vote[0] += weights[i] * prediction["probability"]
+                # 질문 순서가 달라도 결과가 같도록 앞쪽 파일의 text를 대표로 사용합니다.
+                if i < vote[2]:
+                    vote[1], vote[2] = prediction["text"], i
+            seen[id_] = seen.get(id_, 0) + 1
+            if seen[id_] == len(streams):
+                del seen[id_]
+                yield id_, _best(pending.pop(id_))
+
+    # 일부 파일에만 있는 질문은 있는 파일들의 점수로 정합니다.
+    for id_, votes in pending.items():
+        yield id_, _best(votes)
+
+
+def _best(votes: Dict[str, list]) -> str:
+    return max(votes.values(), key=lambda vote: vote[0])[1]
+
 
 def main():
-    '''
-    outputs/test_dataset에 앙상블할 K개의 nbest_pred 파일을
-    nbest_predictions_1.json
-    nbest_predictions_2.json
-    ...
-    로 저장
-
-    python ensemble.py 로 실행
-
-    outputs/test_dataset에 앙상블 결과 ensemble.json 생성
-    '''
-    K = 3
-    nbests = []
-    for _ in range(K):
-        with open(f"./outputs/test_dataset/nbest_predictions_{_ + 1}.json", "r") as file:
-            nbests.append(json.load(file))
-
-    d = defaultdict(list)
-    for nbest in nbests:
-        for id_, pred_list in nbest.items():
-            for pred in pred_list:
-                text = pred["text"]
-                probability = pred["probability"]
-                flag = 0
-                for voting_dist in d[id_]:
-                    voting_text = voting_dist["text"]
-                    if text == voting_text:
-                        voting_dist["probability"] += probability
-                        flag = 1
-                        break
-                if not flag:
-                    d[id_].append({"text": text, "probability": probability})
-    
-    ensemble = {}
-    for id_ in d.keys():
-        ensemble[id_] = sorted(d[id_], key = lambda x:-x['probability'])[0]['text']
-
-    with open("./outputs/test_dataset/ensemble.json", "w", encoding="utf-8") as writer:
-            writer.write(
-                json.dumps(ensemble, indent=4, ensure_ascii=False) + "\n"
-            )
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument("--nbest_files", nargs="+", default=None, type=str, help="")
+    parser.add_argument("--weights", nargs="+", default=None, type=float, help="기본값: 모두 1.0")
+    parser.add_argument("--input_dir", default="./outputs/test_dataset", type=str, help="")
+    parser.add_argument("--k", default=3, type=int, help="--nbest_files가 없을 때 사용할 파일 수")
+    parser.add_argument(
+        "--format", default="json", choices=["json", "npz"], help="--nbest_files가 없을 때 사용할 파일 형식"
+    )
+    parser.add_argument(
+        "--output", default="./outputs/test_dataset/ensemble.json", type=str, help=""
+    )
+    args = parser.parse_args()
+
+    nbest_files = args.nbest_files or [
+        os.path.join(args.input_dir, f"nbest_predictions_{i + 1}.{args.format}") for i in range(args.k)
+    ]
+    weights = args.weights or [1.0] * len(nbest_files)
+
+    # 결과도 질문 단위로 바로 씁니다.
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    num_questions = 0
+    with open(args.output, "w", encoding="utf-8") as writer:
+        writer.write("{")
+        for id_, text in ensemble(nbest_files, weights):
+            writer.write("," if num_questions else "")
+            writer.write(f"\n    {json.dumps(id_, ensure_ascii=False)}: {json.dumps(text, ensure_ascii=False)}")
+            num_questions += 1
+        writer.write("\n}\n")
+    print(f"Ensembled {len(nbest_files)} n-best files over {num_questions} questions into {args.output}")
+
 
 if __name__ == "__main__":
     main()